@@ -0,0 +1 @@
+"""Бенчмарки Dice & Destiny SRD Hub (см. benchmarks/README.md)."""
@@ -0,0 +1,99 @@
+"""Общие части бенчмарков: запуск приложения на отдельной БД, статистика, сохранение результатов."""
+import os
+import sys
+import json
+import math
+import platform
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def load_app(db_path=None, page_cache='null'):
+    """Импортирует server.py, направив его на отдельную SQLite-базу.
+
+    server.py создает таблицы и читает конфиг при импорте, поэтому переменные
+    окружения выставляются до импорта. По умолчанию кэш страниц выключен, чтобы
+    мерить рендеринг, а не попадания в кэш.
+    """
+    if 'server' in sys.modules:
+        raise RuntimeError('server.py уже импортирован — бенчмарк должен загрузить его сам')
+    if db_path is None:
+        db_path = os.path.join(tempfile.mkdtemp(prefix='dnd-bench-'), 'bench.db')
+    elif os.path.exists(db_path):
+        os.remove(db_path)
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.abspath(db_path)
+    os.environ['PAGE_CACHE_TYPE'] = page_cache
+    os.environ['INSTRUMENTATION_ENABLED'] = '0'
+    sys.path.insert(0, ROOT_DIR)
+    import server
+    server.app.config['WTF_CSRF_ENABLED'] = False # Для входа тестовым клиентом
+    return server
+
+
+class QueryCounter:
+    """Считает SQL-запросы движка SQLAlchemy."""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+def percentile(sorted_values, pct):
+    """Перцентиль методом ближайшего ранга по уже отсортированному списку."""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(pct / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+
+def summarize_timings(timings_ms):
+    timings = sorted(timings_ms)
+    return {
+        'runs': len(timings),
+        'mean_ms': round(sum(timings) / len(timings), 3),
+        'min_ms': round(timings[0], 3),
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p95_ms': round(percentile(timings, 95), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'max_ms': round(timings[-1], 3),
+    }
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+                                  capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return revision + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_metadata(**extra):
+    return {
+        'revision': git_revision(),
+        'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        **extra,
+    }
+
+
+def save_results(results, kind, output=None):
+    """Сохраняет результаты в JSON: по умолчанию benchmarks/results/<вид>-<ревизия>-<время>.json."""
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')
+        output = os.path.join(RESULTS_DIR, f"{kind}-{results['meta']['revision']}-{stamp}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    return output
@@ -0,0 +1,38 @@
+"""Сравнение двух JSON-результатов бенчмарков (например, до и после коммита).
+
+Пример:
+    python -m benchmarks.compare results/load-abc123-....json results/load-def456-....json
+"""
+import argparse
+import json
+
+METRICS = ('p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request', 'queries_per_call', 'peak_memory_kb')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Сравнивает два прогона бенчмарков.')
+    parser.add_argument('baseline', help='JSON «до».')
+    parser.add_argument('candidate', help='JSON «после».')
+    parser.add_argument('--metric', choices=METRICS, default='p50_ms', help='Метрика для сравнения.')
+    args = parser.parse_args(argv)
+
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.candidate, encoding='utf-8') as f:
+        candidate = json.load(f)
+
+    print(f"{baseline['meta']['revision']} -> {candidate['meta']['revision']}, метрика {args.metric}")
+    for name, result in candidate['scenarios'].items():
+        before = baseline['scenarios'].get(name, {}).get(args.metric)
+        after = result.get(args.metric)
+        if after is None:
+            continue
+        if before is None:
+            print(f"{name:<48} {'—':>10} {after:>10.2f}")
+            continue
+        change = f"{(after - before) / before * 100:+.1f}%" if before else ''
+        print(f"{name:<48} {before:>10.2f} {after:>10.2f} {change:>8}")
+
+
+if __name__ == '__main__':
+    main()
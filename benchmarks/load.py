@@ -0,0 +1,180 @@
+"""Нагрузочный бенчмарк горячих страниц через тестовый клиент Flask.
+
+Пример:
+    python -m benchmarks.load --scale medium --iterations 100
+
+Для каждого сценария меряет задержку (p50/p95/p99), число SQL-запросов на запрос
+и пиковую память (tracemalloc, отдельным проходом — трассировка замедляет код).
+Результат сохраняется в JSON (см. benchmarks/compare.py).
+"""
+import argparse
+import gc
+import itertools
+import time
+import tracemalloc
+
+from benchmarks.common import load_app, QueryCounter, summarize_timings, run_metadata, save_results
+from benchmarks.seed import SCALES, BENCH_PASSWORD, seed_database
+
+
+def most_common(counts):
+    return max(counts.items(), key=lambda item: (item[1], item[0]))[0]
+
+
+def page_cursor(server, page_number):
+    """Курсор страницы page_number форума, как в ссылке «Вперед» с предыдущей страницы."""
+    HomebrewPost = server.HomebrewPost
+    per_page = server.HOMEBREW_POSTS_PER_PAGE
+    with server.app.app_context():
+        last_on_previous = HomebrewPost.query.order_by(HomebrewPost.timestamp.desc(), HomebrewPost.id.desc()) \
+            .offset(max(page_number - 1, 1) * per_page - 1).first()
+        return server.encode_homebrew_cursor(last_on_previous, 'next', page_number)
+
+
+def build_scenarios(server, seeded):
+    """Список (имя, эндпоинт, аргументы url_for, зрители)."""
+    facets = server.SRD_SPELLS_FACETS.counts
+    spell_filters = {
+        'search': 'огонь',
+        'class': most_common(facets['class']),
+        'level': most_common(facets['level']),
+        'school': most_common(facets['school']),
+    }
+    scenarios = []
+    # Все комбинации фильтров списка заклинаний, от «без фильтров» до всех четырех сразу
+    for size in range(len(spell_filters) + 1):
+        for combo in itertools.combinations(spell_filters, size):
+            name = 'spells_list[' + ','.join(combo) + ']' if combo else 'spells_list'
+            scenarios.append((name, 'spells_list', {key: spell_filters[key] for key in combo}, None))
+
+    monster_facets = server.SRD_MONSTERS_FACETS.counts
+    scenarios += [
+        ('monsters_list', 'monsters_list', {}, None),
+        ('monsters_list[type]', 'monsters_list', {'type': most_common(monster_facets['type'])}, None),
+        ('monsters_list[cr,type]', 'monsters_list', {'cr': most_common(monster_facets['cr']),
+                                                     'type': most_common(monster_facets['type'])}, None),
+    ]
+    scenarios += [
+        ('search', 'search', {'q': 'бросок атаки'}, None),
+        ('search[type]', 'search', {'q': 'урон', 'type': 'spell'}, None),
+    ]
+    if seeded['commented_spell_slug']:
+        scenarios.append(('spell_detail[commented]', 'spell_detail',
+                          {'spell_slug': seeded['commented_spell_slug']}, None))
+    scenarios.append(('spell_detail[quiet]', 'spell_detail', {'spell_slug': server.SRD_SPELLS_LIST[-1]['slug']}, None))
+    scenarios += [
+        # Форум Homebrew и профили доступны только после входа
+        ('post_detail[deep]', 'post_detail', {'post_id': seeded['deep_post_id']}, ('user',)),
+        ('post_detail[typical]', 'post_detail', {'post_id': seeded['typical_post_id']}, ('user',)),
+        ('homebrew_index', 'homebrew_index', {}, ('user',)),
+        ('homebrew_index[category]', 'homebrew_index', {'category': next(iter(server.HOMEBREW_TOPICS))}, ('user',)),
+        ('homebrew_index[page=5]', 'homebrew_index', {'cursor': page_cursor(server, 5)}, ('user',)),
+        ('homebrew_index[last]', 'homebrew_index',
+         {'cursor': page_cursor(server, seeded['posts'] // server.HOMEBREW_POSTS_PER_PAGE)}, ('user',)),
+        ('homebrew_index[search]', 'homebrew_index', {'q': 'дракон огонь'}, ('user',)),
+        ('homebrew_index[search,category]', 'homebrew_index',
+         {'q': 'дракон', 'category': next(iter(server.HOMEBREW_TOPICS))}, ('user',)),
+        ('profile', 'profile', {'username_to_view': seeded['profile_username']}, ('user',)),
+    ]
+    return scenarios
+
+
+def make_client(server, viewer):
+    client = server.app.test_client()
+    if viewer == 'user':
+        response = client.post('/login', data={'username': 'bench_user_2', 'password': BENCH_PASSWORD})
+        if response.status_code != 302:
+            raise RuntimeError('Не удалось войти пользователем бенчмарка')
+    return client
+
+
+def run_scenario(client, url, queries, iterations, warmup, memory_iterations):
+    for _ in range(warmup):
+        client.get(url)
+
+    timings = []
+    query_counts = []
+    status = None
+    response_bytes = 0
+    for _ in range(iterations):
+        queries_before = queries.count
+        started_at = time.perf_counter()
+        response = client.get(url)
+        timings.append((time.perf_counter() - started_at) * 1000)
+        query_counts.append(queries.count - queries_before)
+        status = response.status_code
+        response_bytes = len(response.get_data())
+
+    gc.collect()
+    tracemalloc.start()
+    for _ in range(memory_iterations):
+        client.get(url)
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'url': url,
+        'status': status,
+        'response_bytes': response_bytes,
+        **summarize_timings(timings),
+        'queries_per_request': round(sum(query_counts) / len(query_counts), 2),
+        'max_queries': max(query_counts),
+        'peak_memory_kb': round(peak_bytes / 1024, 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочный бенчмарк страниц хаба.')
+    parser.add_argument('--scale', choices=SCALES, default='small', help='Размер синтетической базы.')
+    parser.add_argument('--seed', type=int, default=1, help='Зерно генератора данных.')
+    parser.add_argument('--iterations', type=int, default=50, help='Замеров на сценарий.')
+    parser.add_argument('--warmup', type=int, default=3, help='Прогревочных запросов на сценарий.')
+    parser.add_argument('--memory-iterations', type=int, default=3, help='Запросов в проходе с tracemalloc.')
+    parser.add_argument('--viewers', default='anonymous,user',
+                        help='Кем ходить: anonymous, user или оба через запятую.')
+    parser.add_argument('--page-cache', choices=('null', 'lru'), default='null',
+                        help="'null' меряет рендеринг, 'lru' — работу с прогретым кэшем страниц.")
+    parser.add_argument('--only', default='', help='Подстрока: запускать только совпадающие сценарии.')
+    parser.add_argument('--db', help='Путь к файлу SQLite (по умолчанию временный).')
+    parser.add_argument('--output', help='Куда сохранить JSON (по умолчанию benchmarks/results/).')
+    args = parser.parse_args(argv)
+
+    server = load_app(args.db, page_cache=args.page_cache)
+    scale = SCALES[args.scale]
+    started_at = time.perf_counter()
+    seeded = seed_database(server, seed=args.seed, **scale)
+    print(f"База заполнена за {time.perf_counter() - started_at:.1f} с: "
+          f"{seeded['users']} пользователей, {seeded['posts']} постов, {seeded['comments']} комментариев")
+
+    with server.app.app_context():
+        queries = QueryCounter(server.db.engine)
+    viewers = [viewer.strip() for viewer in args.viewers.split(',') if viewer.strip()]
+    clients = {viewer: make_client(server, viewer) for viewer in viewers}
+
+    results = {
+        'meta': run_metadata(kind='load', scale=args.scale, seed=args.seed, iterations=args.iterations,
+                             page_cache=args.page_cache, dataset={**scale, **seeded}),
+        'scenarios': {},
+    }
+    print(f"{'сценарий':<48} {'p50':>8} {'p95':>8} {'p99':>8} {'SQL':>6} {'память, КБ':>11}")
+    for name, endpoint, url_args, allowed_viewers in build_scenarios(server, seeded):
+        if args.only and args.only not in name:
+            continue
+        with server.app.test_request_context():
+            url = server.url_for(endpoint, **url_args)
+        for viewer in viewers:
+            if allowed_viewers and viewer not in allowed_viewers:
+                continue
+            key = f'{name}@{viewer}'
+            result = run_scenario(clients[viewer], url, queries, args.iterations, args.warmup,
+                                  args.memory_iterations)
+            results['scenarios'][key] = result
+            print(f"{key:<48} {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+                  f"{result['queries_per_request']:>6.1f} {result['peak_memory_kb']:>11.1f}"
+                  + ('' if result['status'] == 200 else f"  (HTTP {result['status']})"))
+
+    print(f"Результаты сохранены: {save_results(results, 'load', args.output)}")
+
+
+if __name__ == '__main__':
+    main()
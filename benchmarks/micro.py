@@ -0,0 +1,112 @@
+"""Микробенчмарки отдельных функций.
+
+Пример:
+    python -m benchmarks.micro --scale small --repeat 20
+
+- srd_preprocess: обработка spells.json (build_srd_spells), полный импорт пакетов
+  (import_srd_spells) и, для сравнения, загрузка готового каталога msgpack;
+- comments_tree: get_comments_with_replies для глубокой ветки, обычного поста
+  и страницы заклинания, с числом SQL-запросов.
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+
+from benchmarks.common import load_app, QueryCounter, summarize_timings, run_metadata, save_results
+from benchmarks.seed import SCALES, seed_database
+
+
+def measure(func, repeat, warmup=1, queries=None):
+    for _ in range(warmup):
+        func()
+    timings = []
+    query_counts = []
+    for _ in range(repeat):
+        queries_before = queries.count if queries else 0
+        started_at = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started_at) * 1000)
+        if queries:
+            query_counts.append(queries.count - queries_before)
+
+    gc.collect()
+    tracemalloc.start()
+    func()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {**summarize_timings(timings), 'peak_memory_kb': round(peak_bytes / 1024, 1)}
+    if queries:
+        result['queries_per_call'] = round(sum(query_counts) / len(query_counts), 2)
+    return result
+
+
+def srd_preprocess_benchmarks(server, repeat):
+    with server.app.test_request_context(): # load_srd_data может вызвать flash()
+        spells_raw = server.load_srd_data('spells.json')
+        results = {
+            'srd_preprocess.json_load': measure(lambda: server.load_srd_data('spells.json'), repeat),
+            'srd_preprocess.build_srd_spells': measure(lambda: server.build_srd_spells(spells_raw), repeat),
+            # Полный импорт: spells.json и data/packs/ со схемой и проверкой слагов, без пула
+            'srd_preprocess.import_srd_spells': measure(server.import_srd_spells, repeat),
+        }
+        if server.os.path.exists(server.SRD_CATALOG_PATH):
+            results['srd_preprocess.load_catalog'] = measure(server.load_srd_catalog, repeat)
+    results['srd_preprocess.build_srd_spells']['records'] = len(spells_raw)
+    return results
+
+
+def comments_tree_benchmarks(server, seeded, repeat, queries):
+    Comment = server.Comment
+    cases = {
+        'comments_tree.deep_post': Comment.post_id == seeded['deep_post_id'],
+        'comments_tree.typical_post': Comment.post_id == seeded['typical_post_id'],
+    }
+    if seeded['commented_spell_slug']:
+        cases['comments_tree.spell_page'] = ((Comment.srd_page_type == 'spell') &
+                                             (Comment.srd_page_slug == seeded['commented_spell_slug']))
+    results = {}
+    with server.app.app_context():
+        for name, query_filter in cases.items():
+            def load_tree():
+                server.get_comments_with_replies(query_filter)
+                server.db.session.expunge_all() # Иначе следующие вызовы берут объекты из identity map
+            results[name] = measure(load_tree, repeat, queries=queries)
+            results[name]['comments'] = server.db.session.scalar(
+                server.db.select(server.db.func.count(Comment.id)).where(query_filter))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Микробенчмарки функций хаба.')
+    parser.add_argument('--scale', choices=SCALES, default='small', help='Размер синтетической базы.')
+    parser.add_argument('--seed', type=int, default=1, help='Зерно генератора данных.')
+    parser.add_argument('--repeat', type=int, default=20, help='Замеров на бенчмарк.')
+    parser.add_argument('--db', help='Путь к файлу SQLite (по умолчанию временный).')
+    parser.add_argument('--output', help='Куда сохранить JSON (по умолчанию benchmarks/results/).')
+    args = parser.parse_args(argv)
+
+    server = load_app(args.db)
+    scale = SCALES[args.scale]
+    seeded = seed_database(server, seed=args.seed, **scale)
+    with server.app.app_context():
+        queries = QueryCounter(server.db.engine)
+
+    results = {
+        'meta': run_metadata(kind='micro', scale=args.scale, seed=args.seed, repeat=args.repeat,
+                             dataset={**scale, **seeded}),
+        'scenarios': {
+            **srd_preprocess_benchmarks(server, args.repeat),
+            **comments_tree_benchmarks(server, seeded, args.repeat, queries),
+        },
+    }
+    print(f"{'бенчмарк':<36} {'p50':>8} {'p95':>8} {'p99':>8} {'память, КБ':>11}")
+    for name, result in results['scenarios'].items():
+        print(f"{name:<36} {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+              f"{result['peak_memory_kb']:>11.1f}")
+    print(f"Результаты сохранены: {save_results(results, 'micro', args.output)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""Заполнение SQLite синтетическими пользователями, постами Homebrew и ветками комментариев.
+
+Генерация детерминирована (random.Random(seed)), поэтому одинаковые параметры дают
+одинаковую базу и прогоны на разных коммитах можно сравнивать.
+"""
+import random
+from datetime import datetime, timedelta
+
+# Пресеты масштаба: users, posts, comments_per_post (в среднем), max_depth,
+# deep_thread (размер одной «глубокой» ветки в первом посте), srd_pages/srd_comments_per_page
+SCALES = {
+    'small': dict(users=50, posts=200, comments_per_post=15, max_depth=6,
+                  deep_thread=300, srd_pages=20, srd_comments_per_page=30),
+    'medium': dict(users=500, posts=2000, comments_per_post=25, max_depth=8,
+                   deep_thread=1500, srd_pages=100, srd_comments_per_page=60),
+    'large': dict(users=5000, posts=20000, comments_per_post=30, max_depth=10,
+                  deep_thread=5000, srd_pages=300, srd_comments_per_page=120),
+}
+
+BENCH_PASSWORD = 'bench-password'
+
+WORDS = ('дракон огонь щит меч заклинание подземелье таверна кость удача инициатива '
+         'проверка спасбросок волшебник жрец плут воин эльф дварф полурослик броня '
+         'ловушка сундук карта портал руна зелье свиток гоблин орк нежить').split()
+
+POST_TEMPLATES = (
+    "## {title}\n\n{para}\n\n* **Эффект:** {short}\n* **Длительность:** 1 минута\n\n{para2}",
+    "{para}\n\n> {short}\n\n1. {short2}\n2. {short3}\n\n```\nУрон: 2к6 + модификатор\n```",
+    "### {title}\n\n{para}\n\n_{short}_\n\n{para2}",
+)
+
+COMMENT_TEMPLATES = (
+    "{short}",
+    "{short} **{word}**!\n\n{short2}",
+    "> {short}\n\n{short2}",
+    "{para}",
+)
+
+
+def _sentence(rng, words=8):
+    text = ' '.join(rng.choice(WORDS) for _ in range(words))
+    return text[0].upper() + text[1:] + '.'
+
+
+def _fill(template, rng):
+    return template.format(
+        title=_sentence(rng, 3).rstrip('.'),
+        word=rng.choice(WORDS),
+        short=_sentence(rng, 6), short2=_sentence(rng, 7), short3=_sentence(rng, 5),
+        para=' '.join(_sentence(rng, rng.randint(6, 14)) for _ in range(rng.randint(2, 5))),
+        para2=' '.join(_sentence(rng, rng.randint(6, 14)) for _ in range(rng.randint(1, 3))),
+    )
+
+
+def _comment_tree(rng, size, max_depth, chain=False):
+    """Возвращает список (индекс родителя или None, глубина) для ветки из size комментариев.
+    chain=True строит одну ветку максимальной глубины с ответвлениями — худший случай для рекурсии."""
+    nodes = []
+    for index in range(size):
+        if chain and index and index < max_depth:
+            parent = index - 1
+        elif not nodes or rng.random() < 0.3:
+            parent = None
+        else:
+            parent = rng.randrange(len(nodes))
+            if nodes[parent][1] + 1 >= max_depth:
+                parent = None
+        nodes.append((parent, 0 if parent is None else nodes[parent][1] + 1))
+    return nodes
+
+
+def seed_database(server, seed=1, users=50, posts=200, comments_per_post=15, max_depth=6,
+                  deep_thread=300, srd_pages=20, srd_comments_per_page=30, batch_size=5000):
+    """Заполняет пустую базу приложения server. Возвращает сводку, нужную сценариям бенчмарков."""
+    db = server.db
+    rng = random.Random(seed)
+    base_time = datetime(2024, 1, 1)
+    markdown_cache = {} # Тексты повторяются — не рендерим одно и то же много раз
+
+    def rendered(text):
+        html = markdown_cache.get(text)
+        if html is None:
+            html = markdown_cache[text] = server.render_markdown(text)
+        return html
+
+    def flush(model, rows):
+        if rows:
+            db.session.execute(db.insert(model), rows)
+            rows.clear()
+
+    with server.app.app_context():
+        password_hash = server.generate_password_hash(BENCH_PASSWORD) # Хешировать дорого — один хеш на всех
+        user_rows = [{
+            'id': user_id,
+            'username': f'bench_user_{user_id}',
+            'username_key': server.normalize_username(f'bench_user_{user_id}'), # db.insert обходит ORM-события
+            'password_hash': password_hash,
+            'avatar_filename': 'default.png',
+            'registered_on': base_time + timedelta(minutes=user_id),
+            'role': 'admin' if user_id == 1 else 'user',
+            'description': _sentence(rng, 12),
+        } for user_id in range(1, users + 1)]
+        flush(server.User, user_rows)
+
+        categories = list(server.HOMEBREW_TOPICS)
+        post_rows = []
+        for post_id in range(1, posts + 1):
+            content = _fill(rng.choice(POST_TEMPLATES), rng)
+            post_rows.append({
+                'id': post_id,
+                'title': _sentence(rng, 4).rstrip('.'),
+                'content': content,
+                'content_html': rendered(content),
+                'content_html_version': server.MARKDOWN_RENDERER_VERSION,
+                'timestamp': base_time + timedelta(hours=post_id),
+                'user_id': rng.randint(1, users),
+                'category': rng.choice(categories),
+            })
+            if len(post_rows) >= batch_size:
+                flush(server.HomebrewPost, post_rows)
+        flush(server.HomebrewPost, post_rows)
+
+        comment_rows = []
+        comment_count = 0
+
+        def add_thread(nodes, thread_start, **page):
+            nonlocal comment_count
+            first_id = comment_count + 1
+            for index, (parent, depth) in enumerate(nodes):
+                comment_count += 1
+                content = _fill(rng.choice(COMMENT_TEMPLATES), rng)
+                comment_rows.append({
+                    'id': comment_count,
+                    'content': content,
+                    'timestamp': thread_start + timedelta(minutes=index),
+                    'user_id': rng.randint(1, users),
+                    'parent_comment_id': None if parent is None else first_id + parent,
+                    **page,
+                })
+                if len(comment_rows) >= batch_size:
+                    flush(server.Comment, comment_rows)
+
+        for post_id in range(1, posts + 1):
+            size = deep_thread if post_id == 1 else rng.randint(0, comments_per_post * 2)
+            add_thread(_comment_tree(rng, size, max_depth, chain=post_id == 1),
+                       base_time + timedelta(hours=post_id), post_id=post_id)
+
+        spell_slugs = [spell['slug'] for spell in server.SRD_SPELLS_LIST[:srd_pages]]
+        for index, slug in enumerate(spell_slugs):
+            add_thread(_comment_tree(rng, srd_comments_per_page, max_depth),
+                       base_time + timedelta(days=index), srd_page_type='spell', srd_page_slug=slug)
+        flush(server.Comment, comment_rows)
+        db.session.commit()
+        server.reconcile_counters() # Массовая вставка идет мимо событий ORM, счетчики считаем разом
+
+    return {
+        'users': users,
+        'posts': posts,
+        'comments': comment_count,
+        'deep_post_id': 1,
+        'typical_post_id': max(posts // 2, 1),
+        'commented_spell_slug': spell_slugs[0] if spell_slugs else None,
+        'profile_username': 'bench_user_1',
+    }
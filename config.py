@@ -1,4 +1,5 @@
 import os
+from datetime import timedelta
 from dotenv import load_dotenv
 
 # Загружаем переменные окружения из .env файла (если он есть)
@@ -12,4 +13,38 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     UPLOAD_FOLDER = os.path.join(basedir, 'static', 'avatars')
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
-    MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # Макс. размер файла 16MB
\ No newline at end of file
+    MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # Макс. размер файла 16MB
+    AVATAR_PENDING_FOLDER = os.path.join(basedir, 'instance', 'avatar_uploads') # Загрузки, ждущие обработки
+    AVATAR_WORKERS = int(os.environ.get('AVATAR_WORKERS') or 2) # Потоков фоновой обработки аватаров
+
+    # Кэш страниц SRD для анонимных посетителей: 'filesystem' (общий для воркеров на одной машине),
+    # 'lru' (в памяти процесса) или 'null' (выключен). Инвалидация по тегам видна только тому
+    # хранилищу, где она сделана, поэтому 'lru' годится лишь для одного воркера: иначе комментарий,
+    # добавленный через другой воркер, не появится до истечения PAGE_CACHE_TIMEOUT
+    PAGE_CACHE_TYPE = os.environ.get('PAGE_CACHE_TYPE') or 'filesystem'
+    PAGE_CACHE_MAX_ENTRIES = int(os.environ.get('PAGE_CACHE_MAX_ENTRIES') or 500)
+    PAGE_CACHE_TIMEOUT = 3600 # Секунд; комментарии сбрасывают кэш своей страницы сразу
+    PAGE_CACHE_DIR = os.path.join(basedir, 'instance', 'page_cache')
+    # Cache-Control: public для страниц анонимов (браузеры и общие кэши/прокси); 0 — только с перепроверкой по ETag
+    ANONYMOUS_PAGE_MAX_AGE = int(os.environ.get('ANONYMOUS_PAGE_MAX_AGE') or 60)
+
+    # Инструментирование запросов (время, SQL, шаблоны, Markdown). Выключено по умолчанию:
+    # включите INSTRUMENTATION_ENABLED=1, сводка доступна админам на /admin/metrics
+    INSTRUMENTATION_ENABLED = os.environ.get('INSTRUMENTATION_ENABLED') == '1'
+    INSTRUMENTATION_LOG = os.path.join(basedir, 'instance', 'logs', 'requests.log') # JSON, по строке на запрос
+    INSTRUMENTATION_LOG_MAX_BYTES = 5 * 1024 * 1024
+    INSTRUMENTATION_LOG_BACKUPS = 5
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE') or 0) # Доля запросов под cProfile (0..1)
+    PROFILE_SLOW_THRESHOLD_MS = int(os.environ.get('PROFILE_SLOW_THRESHOLD_MS') or 500) # Сохраняем профиль только медленных
+    PROFILE_DIR = os.path.join(basedir, 'instance', 'profiles')
+
+    # Статика после flask assets-build: url_for('static') отдает имена с хешем из
+    # static/build/manifest.json (кэшируются навсегда). Без манифеста и в режиме отладки —
+    # исходные файлы; STATIC_FINGERPRINTS_ENABLED=0 выключает подмену совсем
+    STATIC_FINGERPRINTS_ENABLED = os.environ.get('STATIC_FINGERPRINTS_ENABLED') != '0'
+
+    # Сессии: 'database' — данные в таблице server_session, в cookie только идентификатор;
+    # 'cookie' — стандартные подписанные cookie Flask (все данные у клиента)
+    SESSION_BACKEND = os.environ.get('SESSION_BACKEND') or 'database'
+    SESSION_IDLE_TIMEOUT = timedelta(hours=int(os.environ.get('SESSION_IDLE_TIMEOUT_HOURS') or 24)) # Для непостоянных сессий; постоянные живут PERMANENT_SESSION_LIFETIME
+    SESSION_SWEEP_INTERVAL = 600 # Секунд между фоновыми уборками просроченных сессий в воркере
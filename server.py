@@ -2,33 +2,75 @@ import os
 import secrets
 import json
 import re
+import hashlib
+import bisect
+import itertools
+import functools
+import threading
+import time
+import io
+import zlib
+import gzip
+import shutil
+import subprocess
+import mimetypes
+import logging
+import random
+import cProfile
+import unicodedata
+from logging.handlers import RotatingFileHandler
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict, deque
 from datetime import datetime
-from markupsafe import Markup
+from typing import Annotated, Literal
+from markupsafe import Markup, escape
 import markdown
-from PIL import Image
-from flask import Flask, render_template, request, flash, redirect, url_for, abort, session
+import msgspec
+from PIL import Image, ImageOps
+from flask import Flask, render_template, request, flash, redirect, url_for, abort, session, make_response, send_from_directory, stream_with_context, g, has_request_context, before_render_template, template_rendered
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from werkzeug.datastructures import CallbackDict
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
+from flask_login.config import COOKIE_NAME as REMEMBER_COOKIE_NAME
 from flask_wtf import FlaskForm, CSRFProtect
 from wtforms import StringField, PasswordField, BooleanField, SubmitField, TextAreaField, FileField, SelectField
 from wtforms.validators import DataRequired, Length, EqualTo, ValidationError, Optional, Regexp
 from flask_wtf.file import FileAllowed
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from itsdangerous import URLSafeSerializer, BadSignature
+from cachelib import BaseCache, FileSystemCache, NullCache
 from config import Config
 from datetime import datetime, timezone
 import click
+try:
+    import brotli # Необязательно: без него flask assets-build собирает только .gz
+except ImportError:
+    brotli = None
 
 # --- 1. Инициализация приложения и расширений ---
 app = Flask(__name__, instance_relative_config=True)
 app.config.from_object(Config)
 
-@app.template_filter('markdown')
-def markdown_to_html_filter(text):
+# Увеличивайте версию при смене расширений или обновлении Markdown: сохраненный HTML
+# станет устаревшим и будет пересобран командой flask markdown-rerender
+MARKDOWN_EXTENSIONS = ['fenced_code', 'nl2br']
+MARKDOWN_RENDERER_VERSION = 1
+
+def render_markdown(text):
     if text:
-        return Markup(markdown.markdown(text, extensions=['fenced_code', 'nl2br']))
+        started_at = time.perf_counter()
+        html = markdown.markdown(text, extensions=MARKDOWN_EXTENSIONS)
+        record_request_metric('markdown_ms', (time.perf_counter() - started_at) * 1000)
+        return html
     return ''
 
+@app.template_filter('markdown')
+def markdown_to_html_filter(text):
+    return Markup(render_markdown(text))
+
 @app.context_processor
 def inject_now():
     return {'now': datetime.now(timezone.utc)}
@@ -109,11 +151,9 @@ def load_srd_data(filename):
         return []
 
 # --- Загрузка и ПРЕДВАРИТЕЛЬНАЯ ОБРАБОТКА данных SRD ---
-SRD_SPELLS_LIST_RAW = load_srd_data('spells.json')
-SRD_SPELLS_LIST = [] #
-SRD_SPELLS_DICT = {} 
-
-for spell_raw in SRD_SPELLS_LIST_RAW:
+def process_srd_spell(spell_raw):
+    """Готовит одно заклинание из JSON (формат Foundry) к отображению.
+    Возвращает None, если у заклинания нет имени или из него не получается слаг."""
     spell_name_original = spell_raw.get('name') # Исходное название, может быть с англ. в скобках
     slug = None
 
@@ -133,8 +173,7 @@ for spell_raw in SRD_SPELLS_LIST_RAW:
 
 
     if not slug or not spell_name_original:
-        print(f"WARNING: Пропущено заклинание из-за отсутствия имени или невозможности создать слаг: {spell_name_original}")
-        continue
+        return None # Вызывающий код заносит запись в отчет импорта (SpellImportIssue)
 
     # Извлекаем английское название из скобок, если есть
     en_name = None
@@ -146,6 +185,8 @@ for spell_raw in SRD_SPELLS_LIST_RAW:
     system_data = spell_raw.get('system', {}) # Получаем объект system один раз
 
     level_raw = system_data.get('level')
+    if level_raw is None:
+        level_raw = 0 # Схема пакетов допускает заклинания без уровня — считаем их заговорами
     level_display = 'Заговор' # По умолчанию для уровня 0 или 'cantrip'
     if level_raw is not None and str(level_raw).lower() != 'cantrip' and str(level_raw) != '0':
         level_display = f"{level_raw} круг"
@@ -284,9 +325,393 @@ for spell_raw in SRD_SPELLS_LIST_RAW:
         'type': spell_raw.get('type', '?')
     }
 
+    return spell_processed
+
+def build_srd_spells(spells_raw, source='spells.json', issues=None):
+    """Обрабатывает список сырых заклинаний, пропуская битые записи (они попадают в issues)."""
+    spells = []
+    for index, spell_raw in enumerate(spells_raw):
+        spell_processed = process_srd_spell(spell_raw)
+        if spell_processed is not None:
+            spells.append(spell_processed)
+        elif issues is not None:
+            issues.append(SpellImportIssue(source, index, spell_raw.get('name'), 'из названия не получается слаг'))
+    return spells
+
+# --- Импорт пакетов заклинаний (data/spells.json + data/packs/) ---
+# Пакет — файл в формате Foundry: JSON-массив записей (*.json) или по записи на строку
+# (*.db, *.ndjson, *.jsonl, как в компендиумах Foundry). Записи других типов (предметы,
+# умения из того же компендиума) пропускаются, битые попадают в отчет, а не в каталог.
+SRD_SPELLS_PATH = os.path.join(app.root_path, 'data', 'spells.json')
+SRD_PACKS_DIR = os.path.join(app.root_path, 'data', 'packs')
+SRD_PACK_ARRAY_EXTENSIONS = ('.json',)
+SRD_PACK_LINE_EXTENSIONS = ('.db', '.ndjson', '.jsonl')
+
+# Схема: только то, на что опирается process_srd_spell (строки, у которых вызываются
+# .lower()/.replace(), не могут быть null); остальные поля system (damage, save, source...)
+# не проверяются и сохраняются как есть
+PackValue = int | float | str | None
+
+class PackSpellActivation(msgspec.Struct):
+    type: str = ''
+    cost: PackValue = None
+    condition: str | None = None
+
+class PackSpellRange(msgspec.Struct):
+    value: PackValue = None
+    long: PackValue = None
+    units: str = ''
+
+class PackSpellTarget(msgspec.Struct):
+    type: str | None = None
+    value: PackValue = None
+    units: str = ''
+
+class PackSpellComponents(msgspec.Struct):
+    vocal: bool = False
+    somatic: bool = False
+    material: bool = False
+    concentration: bool = False
+    raw: str | None = None
+    materials_needed: list[str] = []
+
+class PackSpellDuration(msgspec.Struct):
+    value: PackValue = None
+    units: str = ''
+
+class PackSpellDescription(msgspec.Struct):
+    value: str = ''
+    higher_levels: str | list[str | None] | None = None
+
+class PackSpellMaterials(msgspec.Struct):
+    value: str | None = None
+
+class PackSpellSystem(msgspec.Struct):
+    level: Annotated[int, msgspec.Meta(ge=0, le=9)] | Literal['cantrip'] | None = None
+    school: str = ''
+    ritual: bool = False
+    activation: PackSpellActivation = msgspec.field(default_factory=PackSpellActivation)
+    range: PackSpellRange = msgspec.field(default_factory=PackSpellRange)
+    target: PackSpellTarget = msgspec.field(default_factory=PackSpellTarget)
+    components: PackSpellComponents = msgspec.field(default_factory=PackSpellComponents)
+    duration: PackSpellDuration = msgspec.field(default_factory=PackSpellDuration)
+    description: PackSpellDescription = msgspec.field(default_factory=PackSpellDescription)
+    materials: PackSpellMaterials = msgspec.field(default_factory=PackSpellMaterials)
+
+class PackSpell(msgspec.Struct):
+    name: Annotated[str, msgspec.Meta(min_length=1)]
+    system: PackSpellSystem
+    type: str = 'spell'
+    classes: list[str] = []
+    tags: list[str] = []
+
+class SpellImportIssue(msgspec.Struct):
+    source: str # Имя файла пакета
+    index: int | None # Номер записи (для построчных пакетов — номер строки с нуля)
+    name: str | None
+    message: str
+
+class SpellPackResult(msgspec.Struct):
+    source: str
+    spells: list
+    issues: list[SpellImportIssue]
+    skipped: int = 0 # Записи не-заклинания
+
+class SpellImportReport(msgspec.Struct):
+    spells: list # Итоговый список без дублей слагов
+    packs: list[SpellPackResult] # Результаты по файлам (spells — уже без дублей)
+    collisions: list[SpellImportIssue]
+
+    def issues(self):
+        return [issue for pack in self.packs for issue in pack.issues] + self.collisions
+
+def srd_spell_source_paths():
+    """spells.json и пакеты из data/packs/ в порядке приоритета: при совпадении слагов
+    побеждает запись из более раннего файла."""
+    paths = [SRD_SPELLS_PATH]
+    if os.path.isdir(SRD_PACKS_DIR):
+        paths.extend(sorted(
+            os.path.join(SRD_PACKS_DIR, filename) for filename in os.listdir(SRD_PACKS_DIR)
+            if filename.endswith(SRD_PACK_ARRAY_EXTENSIONS + SRD_PACK_LINE_EXTENSIONS)
+        ))
+    return paths
+
+def read_spell_pack_records(path, issues):
+    """Пары (номер записи, запись) из файла пакета; нечитаемые строки попадают в issues."""
+    source = os.path.basename(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    if path.endswith(SRD_PACK_ARRAY_EXTENSIONS):
+        records = msgspec.json.decode(data)
+        if not isinstance(records, list):
+            raise ValueError('ожидался JSON-массив записей')
+        return list(enumerate(records))
+    records = []
+    for line_number, line in enumerate(data.splitlines()):
+        if not line.strip():
+            continue
+        try:
+            records.append((line_number, msgspec.json.decode(line)))
+        except msgspec.DecodeError as e:
+            issues.append(SpellImportIssue(source, line_number, None, f'неверный JSON: {e}'))
+    return records
+
+def parse_spell_pack(path):
+    """Читает, проверяет и обрабатывает один пакет. Выполняется в процессе пула (flask srd-compile),
+    поэтому принимает путь и возвращает только сериализуемые данные."""
+    source = os.path.basename(path)
+    issues = []
+    try:
+        records = read_spell_pack_records(path, issues)
+    except (OSError, ValueError, msgspec.DecodeError) as e:
+        return SpellPackResult(source, [], [SpellImportIssue(source, None, None, f'не удалось прочитать файл: {e}')])
+
+    spells = []
+    skipped = 0
+    for index, record in records:
+        name = record.get('name') if isinstance(record, dict) else None
+        try:
+            spell = msgspec.convert(record, PackSpell)
+        except msgspec.ValidationError as e:
+            issues.append(SpellImportIssue(source, index, name if isinstance(name, str) else None, str(e)))
+            continue
+        if spell.type != 'spell':
+            skipped += 1
+            continue
+        spell_processed = process_srd_spell(record)
+        if spell_processed is None:
+            issues.append(SpellImportIssue(source, index, name, 'из названия не получается слаг'))
+            continue
+        spells.append(spell_processed)
+    return SpellPackResult(source, spells, issues, skipped)
+
+def import_srd_spells(paths=None, workers=1):
+    """Импортирует все пакеты и сливает их в один список, отбрасывая повторные слаги.
+    workers > 1 — разбор файлов в пуле процессов (для CLI; в воркерах сервера не используется)."""
+    paths = srd_spell_source_paths() if paths is None else paths
+    if workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as pool:
+            packs = list(pool.map(parse_spell_pack, paths))
+    else:
+        packs = [parse_spell_pack(path) for path in paths]
+
+    spells = []
+    owners = {} # слаг -> файл, откуда взята запись
+    collisions = []
+    for pack in packs:
+        unique_spells = []
+        for spell in pack.spells:
+            owner = owners.get(spell['slug'])
+            if owner is not None:
+                collisions.append(SpellImportIssue(
+                    pack.source, None, spell['name'],
+                    f"слаг '{spell['slug']}' уже занят заклинанием из {owner}, запись пропущена"))
+                continue
+            owners[spell['slug']] = pack.source
+            unique_spells.append(spell)
+        pack.spells = unique_spells
+        spells.extend(unique_spells)
+    return SpellImportReport(spells, packs, collisions)
+
+# --- Скомпилированный каталог заклинаний (см. команду flask srd-compile) ---
+# Увеличивайте версию при любом изменении process_srd_spell или словарей-маппингов,
+# тогда старые артефакты будут проигнорированы и воркеры пересоберут каталог сами.
+SRD_CATALOG_VERSION = 2
+SRD_CATALOG_PATH = os.path.join(app.root_path, 'data', 'spells.catalog.msgpack')
+
+class SrdCatalog(msgspec.Struct):
+    version: int
+    source_hash: str
+    spells: list
+
+def srd_source_hash():
+    """SHA-256 по именам и содержимому spells.json и всех пакетов (None, если файлов нет)."""
+    digest = hashlib.sha256()
+    found = False
+    for path in srd_spell_source_paths():
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            continue
+        found = True
+        digest.update(os.path.basename(path).encode() + b'\0' + hashlib.sha256(data).digest())
+    return digest.hexdigest() if found else None
+
+def compile_srd_catalog(path=SRD_CATALOG_PATH, workers=1):
+    """Импортирует пакеты и сохраняет результат в бинарный msgpack-артефакт.
+    Возвращает (каталог, отчет импорта)."""
+    source_hash = srd_source_hash() or ''
+    report = import_srd_spells(workers=workers)
+    catalog = SrdCatalog(
+        version=SRD_CATALOG_VERSION,
+        source_hash=source_hash,
+        spells=report.spells
+    )
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(msgspec.msgpack.encode(catalog))
+    os.replace(tmp_path, path) # Атомарно, чтобы стартующий воркер не прочитал недописанный файл
+    return catalog, report
+
+def load_srd_catalog(path=SRD_CATALOG_PATH):
+    """Загружает обработанные заклинания из артефакта одним decode.
+    Если артефакта нет, он устарел или пакеты изменились — импортирует их заново."""
+    try:
+        with open(path, 'rb') as f:
+            catalog = msgspec.msgpack.decode(f.read(), type=SrdCatalog)
+        if catalog.version == SRD_CATALOG_VERSION and catalog.source_hash == srd_source_hash():
+            return catalog.spells
+        print(f"INFO: Каталог SRD '{path}' устарел, импортируем заклинания заново.")
+    except FileNotFoundError:
+        pass
+    except (msgspec.DecodeError, msgspec.ValidationError) as e:
+        print(f"WARNING: Не удалось прочитать каталог SRD '{path}': {e}")
+    report = import_srd_spells()
+    issues = report.issues()
+    if issues:
+        print(f"WARNING: При импорте заклинаний пропущено записей: {len(issues)}. Подробности: flask srd-compile")
+    return report.spells
+
+# Список сразу упорядочен по уровню: на этом порядке держатся поисковый и фасетный индексы
+SRD_SPELLS_LIST = sorted(load_srd_catalog(), key=spell_level_sort_key)
+SRD_SPELLS_DICT = {spell['slug']: spell for spell in SRD_SPELLS_LIST}
+
+# --- Поисковый индекс по SRD (инвертированный, строится один раз при старте) ---
+SEARCH_TOKEN_RE = re.compile(r'\w+')
+CYRILLIC_RE = re.compile(r'[а-я]')
+# Типичные окончания русских слов; отсекаем самое длинное подходящее,
+# чтобы "огненный", "огненного" и "огненным" сводились к одной основе
+RUSSIAN_SUFFIXES = sorted([
+    'иями', 'ями', 'ами', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ешь', 'ишь', 'ете', 'ите',
+    'ать', 'ять', 'ить', 'еть', 'ться', 'ует', 'ают', 'яют', 'ей', 'ой', 'ий', 'ый',
+    'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ую', 'юю', 'ах', 'ях', 'ам', 'ям', 'ом', 'ем', 'ов', 'ев',
+    'ию', 'ия', 'ье', 'ья', 'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й'
+], key=len, reverse=True)
+MIN_STEM_LENGTH = 3
+
+def normalize_search_token(token):
+    """Нижний регистр, ё -> е и простой стемминг русских слов."""
+    token = token.lower().replace('ё', 'е')
+    if CYRILLIC_RE.match(token):
+        for suffix in RUSSIAN_SUFFIXES:
+            if token.endswith(suffix) and len(token) - len(suffix) >= MIN_STEM_LENGTH:
+                return token[:-len(suffix)]
+    return token
+
+def tokenize_search_text(text):
+    return [normalize_search_token(token) for token in SEARCH_TOKEN_RE.findall(text or '')]
+
+class SearchIndex:
+    """Инвертированный индекс: основа слова -> {номер документа: вес}.
+    Вес документа — сумма весов полей, в которых встретилась основа.
+    Номер документа совпадает с позицией в списке, по которому строился индекс."""
+
+    EXACT_MATCH_BONUS = 1.0
+    PREFIX_MATCH_FACTOR = 0.6 # Совпадение по началу основы ("огн" -> "огнен") ценится меньше
+
+    def __init__(self, documents, field_weights):
+        self.field_weights = field_weights
+        self.postings = {}
+        for doc_id, document in enumerate(documents):
+            doc_terms = {}
+            for field, weight in field_weights.items():
+                for term in set(tokenize_search_text(document.get(field))):
+                    doc_terms[term] = doc_terms.get(term, 0) + weight
+            for term, score in doc_terms.items():
+                self.postings.setdefault(term, {})[doc_id] = score
+        self.terms = sorted(self.postings) # Для поиска по префиксу через bisect
+        self.size = len(documents)
+
+    def _match_term(self, query_term):
+        """Документы, содержащие основу, начинающуюся с query_term, с их весами."""
+        matches = {}
+        start = bisect.bisect_left(self.terms, query_term)
+        for term in itertools.islice(self.terms, start, None):
+            if not term.startswith(query_term):
+                break
+            factor = self.EXACT_MATCH_BONUS if term == query_term else self.PREFIX_MATCH_FACTOR
+            for doc_id, score in self.postings[term].items():
+                weighted = score * factor
+                if weighted > matches.get(doc_id, 0):
+                    matches[doc_id] = weighted
+        return matches
+
+    def search(self, query):
+        """Номера документов, содержащих все слова запроса, от самых релевантных."""
+        query_terms = tokenize_search_text(query)
+        if not query_terms:
+            return []
+        scores = None
+        for query_term in query_terms:
+            matches = self._match_term(query_term)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {doc_id: score + matches[doc_id] for doc_id, score in scores.items() if doc_id in matches}
+            if not scores:
+                return []
+        return sorted(scores, key=lambda doc_id: (-scores[doc_id], doc_id))
+
+SRD_SPELLS_SEARCH_INDEX = SearchIndex(SRD_SPELLS_LIST, {'name': 3, 'en_name': 2, 'description': 1})
+
+# --- Фасетный индекс (битовые маски для фильтров) ---
+class FacetIndex:
+    """Для каждого значения фасета хранит битовую маску: бит i выставлен,
+    если i-й элемент списка имеет это значение. Комбинация фильтров — это AND масок,
+    а порядок исходного списка при выборке сохраняется."""
+
+    def __init__(self, items, facets):
+        # facets: {имя фасета: функция, возвращающая значения элемента (в нижнем регистре)}
+        self.items = items
+        self.all_mask = (1 << len(items)) - 1
+        self.masks = {facet: {} for facet in facets}
+        for position, item in enumerate(items):
+            bit = 1 << position
+            for facet, get_values in facets.items():
+                facet_masks = self.masks[facet]
+                for value in get_values(item):
+                    facet_masks[value] = facet_masks.get(value, 0) | bit
+        # Количество элементов для каждого значения — для подписей в выпадающих списках
+        self.counts = {
+            facet: {value: bin(mask).count('1') for value, mask in facet_masks.items()}
+            for facet, facet_masks in self.masks.items()
+        }
 
-    SRD_SPELLS_LIST.append(spell_processed)
-    SRD_SPELLS_DICT[slug] = spell_processed
+    def mask(self, selected):
+        """Маска элементов, подходящих под все выбранные значения {фасет: значение}.
+        Пустые значения игнорируются."""
+        result = self.all_mask
+        for facet, value in selected.items():
+            if value:
+                result &= self.masks[facet].get(value.strip().lower(), 0)
+        return result
+
+    def positions(self, mask):
+        """Позиции выставленных битов по возрастанию."""
+        positions = []
+        while mask:
+            lowest_bit = mask & -mask
+            positions.append(lowest_bit.bit_length() - 1)
+            mask ^= lowest_bit
+        return positions
+
+    def select(self, mask):
+        return [self.items[position] for position in self.positions(mask)]
+
+SRD_SPELLS_FACETS = FacetIndex(SRD_SPELLS_LIST, {
+    'class': lambda spell: {cls.lower() for cls in spell.get('classes_raw', [])},
+    'level': lambda spell: [str(spell.get('level_raw', 99)).lower()],
+    'school': lambda spell: [spell['school_raw']] if spell.get('school_raw') else [],
+})
+
+def select_srd_spell_positions(search_query, filters):
+    """Позиции в SRD_SPELLS_LIST под фильтры {'class', 'level', 'school'} и поиск —
+    общий отбор для HTML-списка и API. С поиском порядок по релевантности, без него — по уровню."""
+    filter_mask = SRD_SPELLS_FACETS.mask(filters)
+    if search_query:
+        return [doc_id for doc_id in SRD_SPELLS_SEARCH_INDEX.search(search_query) if filter_mask >> doc_id & 1]
+    return SRD_SPELLS_FACETS.positions(filter_mask)
 
 ALL_HOMEBREW_CATEGORIES_FOR_FILTER = list(HOMEBREW_TOPICS.items())
 
@@ -294,15 +719,65 @@ ALL_SPELL_CLASSES = sorted(list(set(cls for spell in SRD_SPELLS_LIST for cls in
 ALL_SPELL_LEVELS = sorted(list(set(spell.get('level_raw', 99) for spell in SRD_SPELLS_LIST)), key=spell_level_sort_key)
 ALL_SPELL_SCHOOLS = sorted(list(set(spell.get('school_raw') for spell in SRD_SPELLS_LIST if spell.get('school_raw'))))
 
+# --- Аватары: размеры, которые реально выводятся в шаблонах (навбар, ответы, комментарии, профиль) ---
+AVATAR_SIZES = (30, 40, 125)
+AVATAR_FORMATS = ('webp', 'png') # WebP для современных браузеров, PNG — запасной вариант
+AVATAR_FALLBACK_FORMAT = 'png'
+
+AVATAR_VARIANT_RE = re.compile(r'^[0-9a-f]+_\d+\.[a-z]+$')
+
+def avatar_variant_filename(base_name, size, fmt):
+    return f'{base_name}_{size}.{fmt}'
+
 # --- 2. Модели Базы Данных (SQLAlchemy) ---
-class User(UserMixin, db.Model):
+class RenderedContentMixin:
+    """Хранит HTML, отрендеренный из Markdown-поля content, рядом с исходным текстом."""
+    content_html = db.Column(db.Text, nullable=True)
+    content_html_version = db.Column(db.Integer, nullable=True)
+
+    def refresh_rendered_content(self):
+        """Вызывать при каждом создании/изменении content."""
+        self.content_html = render_markdown(self.content)
+        self.content_html_version = MARKDOWN_RENDERER_VERSION
+
+    def rendered_content(self):
+        """HTML из кэша; если кэша нет или он от старого рендерера — рендерим на лету."""
+        if self.content_html is not None and self.content_html_version == MARKDOWN_RENDERER_VERSION:
+            return Markup(self.content_html)
+        return Markup(render_markdown(self.content))
+
+class AvatarMixin:
+    """URL аватара по avatar_filename: общий для модели User и снимка UserIdentity."""
+
+    def has_avatar_variants(self):
+        """Аватары после фоновой обработки хранятся набором файлов без расширения в имени,
+        старые аватары и default.png — одним файлом."""
+        return '.' not in (self.avatar_filename or 'default.png')
+
+    def get_avatar(self, size=max(AVATAR_SIZES), fmt=AVATAR_FALLBACK_FORMAT):
+        if not self.has_avatar_variants():
+            return url_for('static', filename=f'avatars/{self.avatar_filename or "default.png"}')
+        # Имя файла — хеш содержимого, поэтому URL можно кэшировать навсегда (см. avatar_file)
+        return url_for('avatar_file', filename=avatar_variant_filename(self.avatar_filename, size, fmt))
+
+def normalize_username(username):
+    """Ключ для поиска по имени без учета регистра: NFKC + casefold (Unicode, а не только ASCII)."""
+    return unicodedata.normalize('NFKC', username or '').casefold()
+
+class User(AvatarMixin, UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True, nullable=False)
+    # normalize_username(username), заполняется событиями ниже; по нему идут все поиски по имени.
+    # NULL бывает только в старой БД до backfill_username_keys
+    username_key = db.Column(db.String(64), index=True, unique=True, nullable=True)
     password_hash = db.Column(db.String(256))
     avatar_filename = db.Column(db.String(128), default='default.png')
     registered_on = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     role = db.Column(db.String(20), default='user', nullable=False)
     description = db.Column(db.Text, nullable=True)
+    # Денормализованные счетчики, обновляются событиями ниже (см. reconcile_counters)
+    post_count = db.Column(db.Integer, nullable=False, default=0)
+    comment_count = db.Column(db.Integer, nullable=False, default=0)
 
     posts = db.relationship('HomebrewPost', backref='author', lazy='dynamic',
                             cascade="all, delete-orphan")
@@ -317,9 +792,6 @@ class User(UserMixin, db.Model):
             return False
         return check_password_hash(self.password_hash, password)
 
-    def get_avatar(self):
-        return url_for('static', filename=f'avatars/{self.avatar_filename}')
-
     def __repr__(self):
         return f'<User {self.username}>'
 
@@ -328,10 +800,10 @@ class Comment(db.Model):
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    post_id = db.Column(db.Integer, db.ForeignKey('homebrew_post.id'), nullable=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('homebrew_post.id'), nullable=True, index=True)
     srd_page_type = db.Column(db.String(50), nullable=True) 
     srd_page_slug = db.Column(db.String(100), nullable=True) 
-    parent_comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'), nullable=True)
+    parent_comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'), nullable=True, index=True)
     replies = db.relationship(
         'Comment', 
         backref=db.backref('parent_comment_obj', remote_side=[id]), 
@@ -340,16 +812,22 @@ class Comment(db.Model):
         cascade="all, delete-orphan" 
     )
 
+    __table_args__ = (
+        db.Index('ix_comment_srd_page', 'srd_page_type', 'srd_page_slug'),
+    )
+
     def __repr__(self):
         return f'<Comment {self.id} by User {self.user_id}>'
 
-class HomebrewPost(db.Model):
+class HomebrewPost(RenderedContentMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(150), nullable=False)
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    category = db.Column(db.String(50), nullable=False, index=True)
+    category = db.Column(db.String(50), nullable=False)
+    comment_count = db.Column(db.Integer, nullable=False, default=0)
+    last_activity_at = db.Column(db.DateTime, nullable=True) # Публикация/правка или последний комментарий
 
     comments = db.relationship('Comment',
                                backref='post', 
@@ -357,13 +835,285 @@ class HomebrewPost(db.Model):
                                cascade="all, delete-orphan",
                                foreign_keys=[Comment.post_id]) 
 
+    __table_args__ = (
+        # Курсорная пагинация форума по теме: WHERE category = ? AND (timestamp, id) < (?, ?)
+        db.Index('ix_homebrew_post_category_timestamp', 'category', 'timestamp', 'id'),
+    )
+
     def __repr__(self):
         return f'<HomebrewPost {self.title}>'
 
+# --- Денормализованные счетчики ---
+# Обновляются UPDATE-ами на соединении flush-а, то есть в той же транзакции, что и сама
+# вставка/удаление. Каскадные удаления ORM (ветка ответов, комментарии поста, весь контент
+# пользователя) тоже проходят через эти события, поэтому вью ничего считать не нужно.
+def latest_post_activity():
+    """SQL-выражение: время поста или его последнего комментария, что позже."""
+    latest_comment = db.select(db.func.max(Comment.timestamp)).where(
+        Comment.post_id == HomebrewPost.id).scalar_subquery()
+    return db.func.max(HomebrewPost.timestamp, db.func.coalesce(latest_comment, HomebrewPost.timestamp))
+
+@event.listens_for(User, 'before_insert')
+@event.listens_for(User, 'before_update')
+def _user_before_save(mapper, connection, user):
+    user.username_key = normalize_username(user.username)
+
+def find_user_by_username(username):
+    """Пользователь по имени без учета регистра — поиск по уникальному индексу username_key."""
+    return User.query.filter_by(username_key=normalize_username(username)).first()
+
+def backfill_username_keys(batch_size=500):
+    """Заполняет username_key у пользователей, где он пуст или устарел.
+    Возвращает (заполнено, [имена, чей ключ уже занят другим пользователем])."""
+    filled = 0
+    conflicts = []
+    taken = set(db.session.execute(
+        db.select(User.username_key).where(User.username_key.is_not(None))).scalars())
+    last_id = 0
+    while True:
+        batch = db.session.execute(
+            db.select(User.id, User.username, User.username_key)
+            .where(User.id > last_id).order_by(User.id).limit(batch_size)).all()
+        if not batch:
+            break
+        updates = []
+        for user_id, username, current_key in batch:
+            key = normalize_username(username)
+            if key == current_key:
+                continue
+            if key in taken:
+                conflicts.append(username) # Ключ оставляем пустым — разбираться вручную
+                continue
+            taken.discard(current_key)
+            taken.add(key)
+            updates.append({'id': user_id, 'username_key': key})
+        if updates:
+            db.session.execute(db.update(User), updates) # Массовый UPDATE по первичному ключу
+            db.session.commit()
+            filled += len(updates)
+        last_id = batch[-1][0]
+    return filled, conflicts
+
+@event.listens_for(HomebrewPost, 'before_insert')
+def _post_before_insert(mapper, connection, post):
+    post.timestamp = post.timestamp or datetime.utcnow()
+    post.last_activity_at = post.last_activity_at or post.timestamp
+
+@event.listens_for(HomebrewPost, 'after_insert')
+def _post_after_insert(mapper, connection, post):
+    connection.execute(db.update(User).where(User.id == post.user_id)
+                       .values(post_count=User.post_count + 1))
+
+@event.listens_for(HomebrewPost, 'after_delete')
+def _post_after_delete(mapper, connection, post):
+    connection.execute(db.update(User).where(User.id == post.user_id)
+                       .values(post_count=User.post_count - 1))
+
+@event.listens_for(Comment, 'after_insert')
+def _comment_after_insert(mapper, connection, comment):
+    connection.execute(db.update(User).where(User.id == comment.user_id)
+                       .values(comment_count=User.comment_count + 1))
+    if comment.post_id:
+        connection.execute(db.update(HomebrewPost).where(HomebrewPost.id == comment.post_id)
+                           .values(comment_count=HomebrewPost.comment_count + 1,
+                                   last_activity_at=comment.timestamp))
+
+@event.listens_for(Comment, 'after_delete')
+def _comment_after_delete(mapper, connection, comment):
+    connection.execute(db.update(User).where(User.id == comment.user_id)
+                       .values(comment_count=User.comment_count - 1))
+    if comment.post_id:
+        connection.execute(db.update(HomebrewPost).where(HomebrewPost.id == comment.post_id)
+                           .values(comment_count=HomebrewPost.comment_count - 1,
+                                   last_activity_at=latest_post_activity()))
+
+def reconcile_counters():
+    """Пересчитывает все счетчики по таблицам и исправляет расхождения.
+    Возвращает {счетчик: число исправленных строк}."""
+    actual_values = (
+        ('homebrew_post.comment_count', HomebrewPost, HomebrewPost.comment_count,
+         db.select(db.func.count(Comment.id)).where(Comment.post_id == HomebrewPost.id).scalar_subquery()),
+        ('homebrew_post.last_activity_at', HomebrewPost, HomebrewPost.last_activity_at, latest_post_activity()),
+        ('user.post_count', User, User.post_count,
+         db.select(db.func.count(HomebrewPost.id)).where(HomebrewPost.user_id == User.id).scalar_subquery()),
+        ('user.comment_count', User, User.comment_count,
+         db.select(db.func.count(Comment.id)).where(Comment.user_id == User.id).scalar_subquery()),
+    )
+    fixed = {}
+    for name, model, column, actual in actual_values:
+        result = db.session.execute(
+            db.update(model).where(column.is_distinct_from(actual)).values({column: actual})
+            .execution_options(synchronize_session=False)
+        )
+        fixed[name] = result.rowcount
+    db.session.commit()
+    return fixed
+
+# --- Серверные сессии (таблица server_session) ---
+# В cookie лежит только случайный идентификатор, данные — в таблице; в базе хранится
+# SHA-256 идентификатора, так что утечка базы не дает чужих сессий. Запись в таблицу
+# происходит, только если сессию изменили или ее срок пора продлить, поэтому посетители,
+# которые не трогают сессию, не создают ни строк, ни Set-Cookie.
+class ServerSession(db.Model):
+    __tablename__ = 'server_session'
+    id = db.Column(db.String(64), primary_key=True) # SHA-256 идентификатора из cookie
+    data = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, expires_at=None):
+        def on_update(self):
+            self.modified = True
+            self.accessed = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = sid is None
+        self.expires_at = expires_at
+        self.user_id_at_load = self.get('_user_id')
+        self.modified = False
+        self.accessed = False
+
+    def __getitem__(self, key):
+        self.accessed = True
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.accessed = True
+        return super().get(key, default)
+
+    def setdefault(self, key, default=None):
+        self.accessed = True
+        return super().setdefault(key, default)
+
+class DatabaseSessionInterface(SessionInterface):
+    """Сессии в таблице server_session. Работает через отдельное соединение, чтобы не
+    коммитить чужую транзакцию db.session; просроченные строки удаляет sweep_expired_sessions."""
+    session_class = ServerSideSession
+    serializer = session_json_serializer
+    max_sid_length = 64
+
+    def __init__(self):
+        self.last_sweep = time.monotonic()
+
+    @staticmethod
+    def hash_sid(sid):
+        return hashlib.sha256(sid.encode()).hexdigest()
+
+    def lifetime(self, app, session):
+        return app.permanent_session_lifetime if session.permanent else app.config['SESSION_IDLE_TIMEOUT']
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if not sid or len(sid) > self.max_sid_length:
+            return self.session_class()
+        with db.engine.connect() as connection:
+            row = connection.execute(
+                db.select(ServerSession.data, ServerSession.expires_at)
+                .where(ServerSession.id == self.hash_sid(sid), ServerSession.expires_at > datetime.utcnow())
+            ).first()
+        if row is None:
+            return self.session_class()
+        try:
+            data = self.serializer.loads(row.data)
+        except ValueError:
+            return self.session_class()
+        return self.session_class(data, sid=sid, expires_at=row.expires_at)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not session:
+            if session.modified and not session.new: # Сессию очистили (например, выход)
+                self.delete_row(session.sid)
+                response.delete_cookie(name, domain=domain, path=path,
+                                       secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app),
+                                       httponly=self.get_cookie_httponly(app))
+                response.vary.add('Cookie')
+            return
+
+        now = datetime.utcnow()
+        lifetime = self.lifetime(app, session)
+        # Продлеваем срок, когда прошла половина: без этого активную, но неизменяемую сессию
+        # пришлось бы переписывать на каждом запросе
+        needs_refresh = session.expires_at is None or session.expires_at - now < lifetime / 2
+        if not (session.modified or needs_refresh):
+            return
+
+        sid = session.sid
+        if sid is None or session.get('_user_id') != session.user_id_at_load:
+            # Новый идентификатор при входе/выходе — защита от фиксации сессии
+            if sid is not None:
+                self.delete_row(sid)
+            sid = secrets.token_urlsafe(32)
+        expires_at = now + lifetime
+        row = {'id': self.hash_sid(sid), 'expires_at': expires_at}
+        if session.modified or sid != session.sid:
+            row['data'] = self.serializer.dumps(dict(session))
+        with db.engine.begin() as connection:
+            if 'data' in row:
+                connection.execute(db.delete(ServerSession).where(ServerSession.id == row['id']))
+                connection.execute(db.insert(ServerSession).values(row))
+            else:
+                connection.execute(db.update(ServerSession).where(ServerSession.id == row['id'])
+                                   .values(expires_at=expires_at))
+        self.maybe_sweep(app)
+
+        response.set_cookie(
+            name, sid,
+            expires=expires_at.replace(tzinfo=timezone.utc) if session.permanent else None,
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+        response.vary.add('Cookie')
+
+    def delete_row(self, sid):
+        with db.engine.begin() as connection:
+            connection.execute(db.delete(ServerSession).where(ServerSession.id == self.hash_sid(sid)))
+
+    def maybe_sweep(self, app):
+        """Одна пачка просроченных сессий не чаще раза в SESSION_SWEEP_INTERVAL (в пределах воркера);
+        полная уборка — flask sessions-sweep."""
+        if time.monotonic() - self.last_sweep < app.config['SESSION_SWEEP_INTERVAL']:
+            return
+        self.last_sweep = time.monotonic()
+        sweep_expired_sessions(max_batches=1)
+
+def sweep_expired_sessions(batch_size=1000, max_batches=None):
+    """Удаляет просроченные сессии пачками, чтобы не держать блокировку базы долго.
+    Возвращает число удаленных строк."""
+    removed = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        expired_ids = (db.select(ServerSession.id)
+                       .where(ServerSession.expires_at <= datetime.utcnow())
+                       .limit(batch_size))
+        with db.engine.begin() as connection:
+            result = connection.execute(db.delete(ServerSession).where(ServerSession.id.in_(expired_ids)))
+        removed += result.rowcount
+        batches += 1
+        if result.rowcount < batch_size:
+            break
+    return removed
+
+if app.config['SESSION_BACKEND'] == 'database':
+    app.session_interface = DatabaseSessionInterface()
+
 # --- 3. Flask-Login user_loader ---
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    """Снимок пользователя из кэша процесса (см. load_user_identity), а не строка из БД."""
+    try:
+        return load_user_identity(int(user_id))
+    except ValueError:
+        return None
 
 # --- 4. Формы (Flask-WTF) ---
 
@@ -375,7 +1125,7 @@ def validate_username_chars(form, field):
 def validate_username_unique(form, field):
     """Проверяет уникальность username при регистрации или смене."""
     editing_user = getattr(form, '_editing_user', None)
-    user = User.query.filter(User.username.ilike(field.data)).first()
+    user = find_user_by_username(field.data)
     if user:
         if not editing_user or user.id != editing_user.id:
             raise ValidationError('Это имя пользователя уже занято.')
@@ -443,58 +1193,725 @@ class ChangePasswordForm(FlaskForm):
     submit_password = SubmitField('Сменить пароль') 
 
 # --- 5. Helper Функции ---
+def comment_forms():
+    """Формы комментария и ответа. Анонимам на GET они не нужны (вместо форм — ссылка на вход),
+    а создание формы выписало бы CSRF-токен в сессию и сделало кэшируемую страницу уникальной."""
+    if request.method == 'POST' or current_user.is_authenticated:
+        return CommentForm(), ReplyForm()
+    return None, None
+
+
+# Очередь фоновой обработки аватаров: запрос профиля только сохраняет файл и сразу отвечает
+avatar_executor = ThreadPoolExecutor(max_workers=app.config['AVATAR_WORKERS'], thread_name_prefix='avatar')
+
+def render_avatar_variants(source_path):
+    """Обрезает картинку до квадрата и готовит все размеры аватара.
+    Возвращает {(размер, формат): байты}. У анимированных картинок берется первый кадр."""
+    largest = max(AVATAR_SIZES)
+    with Image.open(source_path) as img:
+        img.draft('RGB', (largest * 2, largest * 2)) # JPEG декодируется сразу в уменьшенном масштабе
+        img = ImageOps.exif_transpose(img).convert('RGBA')
+    side = min(img.size)
+    left, top = (img.width - side) // 2, (img.height - side) // 2
+    img = img.crop((left, top, left + side, top + side))
+
+    variants = {}
+    for size in AVATAR_SIZES:
+        resized = img.resize((size, size), Image.LANCZOS)
+        for fmt in AVATAR_FORMATS:
+            buffer = io.BytesIO()
+            resized.save(buffer, format=fmt.upper(), optimize=True)
+            variants[(size, fmt)] = buffer.getvalue()
+    return variants
+
+def avatar_content_hash(variants):
+    """Имя набора аватара — хеш обработанных байтов: одинаковые загрузки дают одни и те же файлы."""
+    digest = hashlib.sha256()
+    for key in sorted(variants):
+        digest.update(variants[key])
+    return digest.hexdigest()[:16]
+
+def process_avatar_upload(user_id, upload_path):
+    """Задача фонового воркера: готовит размеры аватара и подменяет аватар пользователя.
+    Пока задача не закончилась, на сайте показывается старый аватар."""
+    with app.app_context():
+        try:
+            variants = render_avatar_variants(upload_path)
+            base_name = avatar_content_hash(variants)
+            output_dir = os.path.join(app.root_path, app.config['UPLOAD_FOLDER'])
+            os.makedirs(output_dir, exist_ok=True)
+            for (size, fmt), data in variants.items():
+                variant_path = os.path.join(output_dir, avatar_variant_filename(base_name, size, fmt))
+                if os.path.exists(variant_path): # Такой же аватар уже загружали — файлы общие
+                    continue
+                tmp_path = f'{variant_path}.{secrets.token_hex(4)}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, variant_path)
+
+            # Старые файлы не удаляем: на них могут ссылаться закэшированные страницы
+            # и другие пользователи с тем же аватаром. Их убирает flask avatars-gc.
+            user = db.session.get(User, user_id)
+            if user is not None: # Пользователя могли успеть удалить
+                user.avatar_filename = base_name
+                db.session.commit()
+                invalidate_user_identity(user_id)
+                page_cache.invalidate(*user_comment_page_tags(user_id))
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error processing avatar for user {user_id}: {e}")
+        finally:
+            try:
+                os.remove(upload_path)
+            except OSError:
+                pass
+
+def queue_avatar_upload(form_picture, user_id):
+    """Сохраняет загруженный файл как есть и ставит его обработку в очередь.
+    Возвращает future задачи или None, если файл не удалось сохранить."""
+    pending_dir = app.config['AVATAR_PENDING_FOLDER']
+    os.makedirs(pending_dir, exist_ok=True)
+    upload_path = os.path.join(pending_dir, f'{user_id}_{secrets.token_hex(8)}.upload')
+    try:
+        form_picture.save(upload_path)
+    except OSError as e:
+        print(f"Error saving avatar upload: {e}")
+        flash('Ошибка при сохранении аватара.', 'danger')
+        return None
+    return avatar_executor.submit(process_avatar_upload, user_id, upload_path)
+
+def get_comments_with_replies(query_filter, page=None, per_page=None):
+    """Загружает ветки комментариев любой глубины вместе с авторами одним запросом.
+
+    query_filter отбирает комментарии страницы (SRD или поста), page/per_page
+    включают пагинацию по комментариям верхнего уровня. Ответы каждого комментария
+    (по времени) лежат в .loaded_replies, вложенные ответы — в их .loaded_replies.
+    """
+    top_level_ids = db.select(Comment.id).where(
+        query_filter, Comment.parent_comment_id.is_(None)
+    ).order_by(Comment.timestamp.asc(), Comment.id.asc())
+    if per_page:
+        top_level_ids = top_level_ids.limit(per_page).offset((max(page or 1, 1) - 1) * per_page)
+
+    # Рекурсивный CTE: комментарии верхнего уровня + все их потомки по parent_comment_id
+    thread = db.select(Comment.id).where(Comment.id.in_(top_level_ids)).cte('comment_thread', recursive=True)
+    reply_alias = db.aliased(Comment)
+    thread = thread.union_all(
+        db.select(reply_alias.id).where(reply_alias.parent_comment_id == thread.c.id)
+    )
 
-def save_picture(form_picture):
-    """Сохраняет аватарку, удаляет старую (если не дефолтная) и возвращает имя файла."""
-    random_hex = secrets.token_hex(8)
-    _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext.lower()
-    picture_path = os.path.join(app.root_path, app.config['UPLOAD_FOLDER'], picture_fn)
+    comments = db.session.scalars(
+        db.select(Comment)
+        .join(thread, Comment.id == thread.c.id)
+        .options(db.joinedload(Comment.author)) # Авторы тем же запросом, без N+1 в шаблоне
+        .order_by(Comment.timestamp.asc(), Comment.id.asc())
+    ).unique().all()
+
+    comments_by_id = {comment.id: comment for comment in comments}
+    top_level_comments = []
+    for comment in comments:
+        comment.loaded_replies = []
+    for comment in comments:
+        parent = comments_by_id.get(comment.parent_comment_id)
+        if parent is not None:
+            parent.loaded_replies.append(comment)
+        else:
+            top_level_comments.append(comment)
 
-    output_dir = os.path.dirname(picture_path)
-    os.makedirs(output_dir, exist_ok=True)
+    return top_level_comments
 
-    try:
-        output_size = (125, 125)
-        img = Image.open(form_picture)
-        img.thumbnail(output_size)
-        img.save(picture_path)
-
-        if current_user.avatar_filename != 'default.png':
-            old_picture_path = os.path.join(app.root_path, app.config['UPLOAD_FOLDER'], current_user.avatar_filename)
-            if os.path.exists(old_picture_path):
-                try:
-                    os.remove(old_picture_path)
-                except Exception as e:
-                    print(f"Error deleting old avatar '{current_user.avatar_filename}': {e}")
+# --- Кэш готовых страниц для анонимных посетителей ---
+class LRUCache(BaseCache):
+    """Кэш в памяти процесса с ограничением числа записей:
+    при переполнении вытесняются давно не запрашивавшиеся страницы."""
+
+    def __init__(self, max_entries=500, default_timeout=300):
+        super().__init__(default_timeout)
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # ключ -> (время истечения или 0, значение)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at and expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        timeout = self._normalize_timeout(timeout)
+        expires_at = time.time() + timeout if timeout > 0 else 0
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
 
-        return picture_fn
-    except Exception as e:
-         print(f"Error saving avatar: {e}")
-         flash('Ошибка при сохранении аватара.', 'danger')
-         return None
+    def delete(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
 
-def get_comments_with_replies(query_filter):
-    """Общая функция для получения комментариев и их ответов."""
-    top_level_comments = Comment.query.filter(
-        query_filter, Comment.parent_comment_id.is_(None)
-    ).order_by(Comment.timestamp.asc()).all()
-
-    comment_ids = [c.id for c in top_level_comments]
-    replies_dict = {}
-    if comment_ids:
-        replies = Comment.query.filter(
-            Comment.parent_comment_id.in_(comment_ids)
-        ).order_by(Comment.timestamp.asc()).all()
-        for reply in replies:
-            if reply.parent_comment_id not in replies_dict:
-                replies_dict[reply.parent_comment_id] = []
-            replies_dict[reply.parent_comment_id].append(reply)
-
-    for comment in top_level_comments:
-        comment.loaded_replies = replies_dict.get(comment.id, [])
+    def has(self, key):
+        return self.get(key) is not None
 
-    return top_level_comments
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        return True
+
+class PageCache:
+    """Кэш отрендеренных страниц с инвалидацией по тегам.
+
+    У каждого тега (например 'spell:fireball') есть случайный токен, который входит
+    в ключ страницы. invalidate() меняет токен — все страницы с этим тегом сразу
+    перестают находиться и со временем вытесняются самим бэкендом. Так одинаково
+    работают и LRU в памяти, и общий для воркеров FileSystemCache.
+    """
+
+    def __init__(self, app=None):
+        self.backend = NullCache()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        cache_type = app.config.get('PAGE_CACHE_TYPE', 'null')
+        timeout = app.config.get('PAGE_CACHE_TIMEOUT', 300)
+        if cache_type == 'lru':
+            self.backend = LRUCache(app.config.get('PAGE_CACHE_MAX_ENTRIES', 500), timeout)
+        elif cache_type == 'filesystem':
+            self.backend = FileSystemCache(app.config['PAGE_CACHE_DIR'],
+                                           threshold=app.config.get('PAGE_CACHE_MAX_ENTRIES', 500),
+                                           default_timeout=timeout)
+        else:
+            self.backend = NullCache()
+
+    def _tag_token(self, tag):
+        token = self.backend.get(f'tag:{tag}')
+        if token is None:
+            # Токена нет (новый тег или вытеснен) — заводим новый, старые страницы станут недоступны
+            self.backend.add(f'tag:{tag}', secrets.token_hex(8), timeout=0)
+            token = self.backend.get(f'tag:{tag}') or ''
+        return token
+
+    def make_key(self, tags, variant):
+        # Валидаторы conditional_get входят в ключ: тело из кэша всегда соответствует ETag,
+        # который к нему приложен, даже если инвалидация по тегу до этого хранилища не дошла
+        key_source = '|'.join([request.endpoint or '', variant, g.get('page_validator', '')] +
+                              [f'{name}={value}' for name, value in sorted(request.args.items(multi=True))] +
+                              [f'{tag}@{self._tag_token(tag)}' for tag in tags])
+        return 'page:' + hashlib.sha1(key_source.encode('utf-8')).hexdigest()
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            self.backend.set(f'tag:{tag}', secrets.token_hex(8), timeout=0)
+
+    def cached(self, tags=lambda **view_args: []):
+        """Декоратор вью: кэширует GET-ответы анонимным посетителям.
+        tags(**view_args) возвращает теги страницы для инвалидации."""
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(**view_args):
+                # Залогиненным показываем их имя и формы, а flash-сообщения одноразовые — такое не кэшируем.
+                # Без cookie сессии посетитель точно анонимный: сессию и current_user не проверяем вовсе
+                if not is_anonymous_fast_path() and (request.method != 'GET' or current_user.is_authenticated
+                                                     or session.get('_flashes')):
+                    return view(**view_args)
+                key = self.make_key(['srd'] + list(tags(**view_args)), variant='anonymous')
+                cached_page = self.backend.get(key)
+                if cached_page is not None:
+                    body, status, headers = cached_page
+                    return app.response_class(body, status=status, headers=headers)
+                response = make_response(view(**view_args))
+                if response.status_code == 200:
+                    response.headers['Cache-Control'] = anonymous_cache_control()
+                    response.vary.add('Cookie')
+                if response.status_code == 200 and not response.direct_passthrough and 'Set-Cookie' not in response.headers:
+                    headers = [(name, value) for name, value in response.headers if name.lower() != 'content-length']
+                    self.backend.set(key, (response.get_data(), response.status_code, headers))
+                return response
+            return wrapper
+        return decorator
+
+def is_anonymous_fast_path():
+    """GET без cookie сессии и «запомнить меня»: посетитель заведомо анонимный. Такие запросы
+    не трогают ни сессию, ни Flask-Login, а ответ у всех таких посетителей одинаковый."""
+    return (request.method in ('GET', 'HEAD')
+            and app.config['SESSION_COOKIE_NAME'] not in request.cookies
+            and app.config.get('REMEMBER_COOKIE_NAME', REMEMBER_COOKIE_NAME) not in request.cookies)
+
+@app.before_request
+def skip_login_manager_for_anonymous():
+    """Для запросов без cookie сразу подставляем анонима: Flask-Login не ищет пользователя
+    ни в сессии, ни в cookie «запомнить меня» (их заведомо нет)."""
+    if is_anonymous_fast_path():
+        g._login_user = login_manager.anonymous_user()
+
+def anonymous_cache_control():
+    """Страницы анонимов одинаковы для всех, их могут хранить и общие кэши (Vary: Cookie
+    отделяет их от страниц залогиненных); свежие комментарии видны не позже чем через max-age."""
+    max_age = app.config['ANONYMOUS_PAGE_MAX_AGE']
+    return f'public, max-age={max_age}' if max_age > 0 else 'public, no-cache'
+
+def comment_page_tag(page_type, page_slug):
+    """Тег страницы SRD, на которой живут комментарии (см. Comment.srd_page_type/srd_page_slug)."""
+    return f'{page_type}:{page_slug}'
+
+page_cache = PageCache(app)
+
+def user_comment_page_tags(user_id):
+    """Теги страниц SRD с комментариями пользователя: в их HTML его имя и аватар."""
+    rows = db.session.execute(
+        db.select(Comment.srd_page_type, Comment.srd_page_slug)
+        .where(Comment.user_id == user_id, Comment.srd_page_type.is_not(None)).distinct())
+    return [comment_page_tag(page_type, page_slug) for page_type, page_slug in rows]
+
+# --- Кэш пользователей для Flask-Login ---
+# current_user — неизменяемый снимок UserIdentity (id, имя, роль, аватар), а не модель:
+# навбару и проверкам прав больше ничего не нужно, и на каждой странице экономится SELECT.
+# Нужна модель (профиль, изменение данных) — загружайте db.session.get(User, current_user.id).
+# После изменения этих полей вызывайте invalidate_user_identity: она чистит свой кэш и
+# трогает файл-метку, по mtime которой остальные процессы (воркеры, CLI) сбрасывают свои кэши.
+USER_IDENTITY_CACHE_SIZE = 10000
+USER_IDENTITY_CACHE_TTL = 300 # Секунд; страховка на случай, если инвалидацию где-то пропустили
+
+class UserIdentity(AvatarMixin, UserMixin):
+    __slots__ = ('id', 'username', 'role', 'avatar_filename')
+
+    def __init__(self, user):
+        for field in self.__slots__:
+            object.__setattr__(self, field, getattr(user, field))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('UserIdentity не изменяется; обновите User и вызовите invalidate_user_identity')
+
+    def __repr__(self):
+        return f'<UserIdentity {self.username}>'
+
+user_identity_cache = LRUCache(max_entries=USER_IDENTITY_CACHE_SIZE, default_timeout=USER_IDENTITY_CACHE_TTL)
+user_identity_stamp_path = os.path.join(app.instance_path, 'user_identity.stamp')
+user_identity_stamp_seen = [None]
+
+def user_identity_stamp():
+    try:
+        return os.stat(user_identity_stamp_path).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+def load_user_identity(user_id):
+    stamp = user_identity_stamp() # Один stat() вместо SELECT
+    if stamp != user_identity_stamp_seen[0]:
+        user_identity_cache.clear()
+        user_identity_stamp_seen[0] = stamp
+    identity = user_identity_cache.get(user_id)
+    if identity is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        identity = UserIdentity(user)
+        user_identity_cache.set(user_id, identity)
+    return identity
+
+def invalidate_user_identity(user_id):
+    user_identity_cache.delete(user_id)
+    try:
+        with open(user_identity_stamp_path, 'a'):
+            os.utime(user_identity_stamp_path)
+    except OSError as e:
+        print(f"WARNING: Не удалось обновить метку кэша пользователей: {e}")
+
+# --- Курсорная пагинация форума Homebrew ---
+# Вместо OFFSET и COUNT(*) на каждой странице идем от последнего показанного поста
+# по (timestamp, id) — индекс ix_homebrew_post_category_timestamp, глубина страницы не важна.
+HOMEBREW_POSTS_PER_PAGE = 10
+homebrew_cursor_serializer = URLSafeSerializer(app.config['SECRET_KEY'], salt='homebrew-cursor')
+# Общее число постов нужно только для подписи «страница N из ~M»: кэшируем ненадолго,
+# а в этом процессе сбрасываем при создании/удалении постов
+homebrew_count_cache = LRUCache(max_entries=64, default_timeout=60)
+
+class KeysetPage:
+    """Страница списка постов; курсоры уже подписаны и готовы для ссылок."""
+    __slots__ = ('items', 'number', 'total', 'prev_cursor', 'next_cursor')
+
+    def __init__(self, items, number, total, prev_cursor, next_cursor):
+        self.items = items
+        self.number = number
+        self.total = total
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+
+    @property
+    def pages(self):
+        return max((self.total + HOMEBREW_POSTS_PER_PAGE - 1) // HOMEBREW_POSTS_PER_PAGE, 1)
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+def encode_homebrew_cursor(post, direction, page_number):
+    """direction: 'next' — посты старше post, 'prev' — новее. Номер страницы только для подписи."""
+    return homebrew_cursor_serializer.dumps([direction, post.timestamp.isoformat(), post.id, page_number])
+
+def decode_homebrew_cursor(cursor):
+    """(direction, timestamp, id, номер страницы) или None для поддельного/битого курсора."""
+    try:
+        direction, timestamp, post_id, page_number = homebrew_cursor_serializer.loads(cursor)
+        if direction not in ('next', 'prev'):
+            return None
+        return direction, datetime.fromisoformat(timestamp), int(post_id), max(int(page_number), 1)
+    except (BadSignature, ValueError, TypeError):
+        return None
+
+def homebrew_post_count(category=''):
+    key = f'homebrew-count:{category}'
+    count = homebrew_count_cache.get(key)
+    if count is None:
+        query = db.select(db.func.count(HomebrewPost.id))
+        if category:
+            query = query.where(HomebrewPost.category == category)
+        count = db.session.scalar(query)
+        homebrew_count_cache.set(key, count)
+    return count
+
+def invalidate_homebrew_post_counts():
+    homebrew_count_cache.clear()
+
+def paginate_homebrew_posts(category, cursor, per_page=HOMEBREW_POSTS_PER_PAGE):
+    query = HomebrewPost.query.options(db.joinedload(HomebrewPost.author)) # Автор в том же запросе
+    if category:
+        query = query.filter(HomebrewPost.category == category)
+    position = db.tuple_(HomebrewPost.timestamp, HomebrewPost.id)
+
+    decoded = decode_homebrew_cursor(cursor) if cursor else None
+    if decoded is None:
+        direction, page_number = 'next', 1
+        query = query.order_by(HomebrewPost.timestamp.desc(), HomebrewPost.id.desc())
+    else:
+        direction, timestamp, post_id, page_number = decoded
+        if direction == 'next':
+            query = query.filter(position < (timestamp, post_id)).order_by(
+                HomebrewPost.timestamp.desc(), HomebrewPost.id.desc())
+        else:
+            # Назад идем по возрастанию от курсора и разворачиваем результат
+            query = query.filter(position > (timestamp, post_id)).order_by(
+                HomebrewPost.timestamp.asc(), HomebrewPost.id.asc())
+
+    items = query.limit(per_page + 1).all() # Лишний пост показывает, есть ли страница дальше
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if direction == 'prev':
+        items.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = decoded is not None, has_more
+    if direction == 'prev' and not has_prev:
+        page_number = 1 # Дошли до самых новых постов
+
+    return KeysetPage(
+        items=items,
+        number=page_number,
+        total=homebrew_post_count(category),
+        prev_cursor=encode_homebrew_cursor(items[0], 'prev', page_number - 1) if has_prev and items else None,
+        next_cursor=encode_homebrew_cursor(items[-1], 'next', page_number + 1) if has_next and items else None,
+    )
+
+# --- Полнотекстовый поиск по форуму Homebrew (SQLite FTS5) ---
+# Одна FTS5-таблица на посты и комментарии к ним. rowid кодирует источник:
+# пост — id * 2, комментарий — id * 2 + 1, поэтому триггеры удаляют записи по rowid, без сканирования.
+HOMEBREW_SEARCH_PER_PAGE = 20
+
+def fts_fold_sql(expression):
+    """SQL, приводящий ё к е перед индексацией: unicode61 не считает ё диакритикой,
+    а запросы проходят через normalize_search_token, где ё уже заменена."""
+    return f"replace(replace({expression}, 'ё', 'е'), 'Ё', 'Е')"
+
+HOMEBREW_SEARCH_DDL = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS homebrew_search USING fts5(
+        title, content, post_id UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')""",
+    f"""CREATE TRIGGER IF NOT EXISTS homebrew_search_post_insert AFTER INSERT ON homebrew_post BEGIN
+        INSERT INTO homebrew_search(rowid, title, content, post_id)
+        VALUES (new.id * 2, {fts_fold_sql('new.title')}, {fts_fold_sql('new.content')}, new.id);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS homebrew_search_post_update AFTER UPDATE OF title, content ON homebrew_post BEGIN
+        DELETE FROM homebrew_search WHERE rowid = old.id * 2;
+        INSERT INTO homebrew_search(rowid, title, content, post_id)
+        VALUES (new.id * 2, {fts_fold_sql('new.title')}, {fts_fold_sql('new.content')}, new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS homebrew_search_post_delete AFTER DELETE ON homebrew_post BEGIN
+        DELETE FROM homebrew_search WHERE rowid = old.id * 2;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS homebrew_search_comment_insert AFTER INSERT ON comment
+    WHEN new.post_id IS NOT NULL BEGIN
+        INSERT INTO homebrew_search(rowid, title, content, post_id)
+        VALUES (new.id * 2 + 1, '', {fts_fold_sql('new.content')}, new.post_id);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS homebrew_search_comment_update AFTER UPDATE OF content, post_id ON comment BEGIN
+        DELETE FROM homebrew_search WHERE rowid = old.id * 2 + 1;
+        INSERT INTO homebrew_search(rowid, title, content, post_id)
+        SELECT new.id * 2 + 1, '', {fts_fold_sql('new.content')}, new.post_id WHERE new.post_id IS NOT NULL;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS homebrew_search_comment_delete AFTER DELETE ON comment BEGIN
+        DELETE FROM homebrew_search WHERE rowid = old.id * 2 + 1;
+    END""",
+)
+HOMEBREW_SEARCH_TRIGGERS = ('homebrew_search_post_insert', 'homebrew_search_post_update', 'homebrew_search_post_delete',
+                            'homebrew_search_comment_insert', 'homebrew_search_comment_update',
+                            'homebrew_search_comment_delete')
+HOMEBREW_SEARCH_BACKFILL = (
+    f"""INSERT INTO homebrew_search(rowid, title, content, post_id)
+       SELECT id * 2, {fts_fold_sql('title')}, {fts_fold_sql('content')}, id FROM homebrew_post""",
+    f"""INSERT INTO homebrew_search(rowid, title, content, post_id)
+       SELECT id * 2 + 1, '', {fts_fold_sql('content')}, post_id FROM comment WHERE post_id IS NOT NULL""",
+)
+# Маркеры подсветки из управляющих символов: текст экранируем целиком, потом меняем их на <mark>
+FTS_HIGHLIGHT_START, FTS_HIGHLIGHT_END = '\x02', '\x03'
+
+def ensure_homebrew_search_index():
+    """Создает FTS5-таблицу и триггеры синхронизации; новую таблицу заполняет существующими данными.
+    Возвращает False, если SQLite собран без FTS5 (поиск на форуме тогда просто не показывается)."""
+    try:
+        with db.engine.begin() as connection:
+            created = not db.inspect(connection).has_table('homebrew_search')
+            insert_trigger_sql = connection.execute(db.text(
+                "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'homebrew_search_post_insert'"
+            )).scalar()
+            if not created and (insert_trigger_sql is None or 'replace(' not in insert_trigger_sql):
+                # Индекс собран старыми триггерами без замены ё — пересоздаем его целиком
+                for trigger in HOMEBREW_SEARCH_TRIGGERS:
+                    connection.execute(db.text(f'DROP TRIGGER IF EXISTS {trigger}'))
+                connection.execute(db.text('DROP TABLE homebrew_search'))
+                created = True
+            for ddl in HOMEBREW_SEARCH_DDL:
+                connection.execute(db.text(ddl))
+            if created:
+                for backfill in HOMEBREW_SEARCH_BACKFILL:
+                    connection.execute(db.text(backfill))
+                print("INFO: Создан полнотекстовый индекс форума Homebrew.")
+        return True
+    except db.exc.OperationalError as e:
+        print(f"WARNING: Полнотекстовый поиск по форуму недоступен: {e}")
+        return False
+
+def homebrew_match_query(text):
+    """Запрос пользователя -> выражение FTS5 MATCH: все слова (AND) по префиксу основы,
+    чтобы "огненный" находил и "огненного". Кавычки и операторы пользователя не пропускаем."""
+    terms = [f'"{token}"*' for token in tokenize_search_text(text)]
+    return ' '.join(terms) or None
+
+def fts_markup(text):
+    return Markup(str(escape(text or ''))
+                  .replace(FTS_HIGHLIGHT_START, '<mark>')
+                  .replace(FTS_HIGHLIGHT_END, '</mark>'))
+
+class HomebrewSearchHit:
+    """Результат поиска: пост или комментарий к нему, с подсвеченными заголовком и фрагментом."""
+    __slots__ = ('post', 'comment_id', 'title_html', 'snippet_html')
+
+    def __init__(self, post, comment_id, title_html, snippet_html):
+        self.post = post
+        self.comment_id = comment_id
+        self.title_html = title_html
+        self.snippet_html = snippet_html
+
+    @property
+    def is_comment(self):
+        return self.comment_id is not None
+
+def search_homebrew(query_text, category='', page=1, per_page=HOMEBREW_SEARCH_PER_PAGE):
+    """Поиск по постам и комментариям форума с ранжированием BM25 (совпадение в заголовке весит больше).
+    Возвращает (список HomebrewSearchHit, есть ли следующая страница)."""
+    match_query = homebrew_match_query(query_text)
+    if not HOMEBREW_SEARCH_AVAILABLE or not match_query:
+        return [], False
+    sql = """
+        SELECT homebrew_search.rowid, homebrew_search.post_id,
+               highlight(homebrew_search, 0, :start, :end) AS title_html,
+               snippet(homebrew_search, 1, :start, :end, '…', 24) AS snippet_html
+        FROM homebrew_search JOIN homebrew_post ON homebrew_post.id = homebrew_search.post_id
+        WHERE homebrew_search MATCH :match {category_filter}
+        ORDER BY bm25(homebrew_search, 5.0, 1.0, 0.0)
+        LIMIT :limit OFFSET :offset
+    """.format(category_filter='AND homebrew_post.category = :category' if category else '')
+    rows = db.session.execute(db.text(sql), {
+        'start': FTS_HIGHLIGHT_START, 'end': FTS_HIGHLIGHT_END, 'match': match_query,
+        'category': category, 'limit': per_page + 1, 'offset': (max(page, 1) - 1) * per_page,
+    }).all()
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+
+    post_ids = {row.post_id for row in rows}
+    posts = {post.id: post for post in HomebrewPost.query.options(db.joinedload(HomebrewPost.author))
+             .filter(HomebrewPost.id.in_(post_ids))} if post_ids else {}
+    hits = []
+    for row in rows:
+        is_comment = row.rowid % 2 == 1
+        hits.append(HomebrewSearchHit(
+            post=posts[row.post_id],
+            comment_id=row.rowid // 2 if is_comment else None,
+            title_html=fts_markup(row.title_html) if not is_comment else None,
+            snippet_html=fts_markup(row.snippet_html),
+        ))
+    return hits, has_next
+
+# --- Инструментирование запросов (включается INSTRUMENTATION_ENABLED) ---
+class RequestMetrics:
+    """Сводка по эндпоинтам в памяти процесса: число запросов, время, SQL, шаблоны, Markdown.
+    Для перцентилей хранится окно последних durations_window длительностей."""
+
+    FIELDS = ('wall_ms', 'sql_count', 'sql_ms', 'template_ms', 'markdown_ms')
+
+    def __init__(self, durations_window=500):
+        self.durations_window = durations_window
+        self.started_at = datetime.now(timezone.utc)
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, sample):
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = {'count': 0, 'max_ms': 0.0,
+                                                     'durations': deque(maxlen=self.durations_window),
+                                                     **{field: 0 for field in self.FIELDS}}
+            stats['count'] += 1
+            for field in self.FIELDS:
+                stats[field] += sample[field]
+            stats['max_ms'] = max(stats['max_ms'], sample['wall_ms'])
+            stats['durations'].append(sample['wall_ms'])
+
+    def summary(self):
+        """Строки для /admin/metrics, самые затратные эндпоинты первыми."""
+        rows = []
+        with self._lock:
+            for endpoint, stats in self._endpoints.items():
+                durations = sorted(stats['durations'])
+                count = stats['count']
+                rows.append({
+                    'endpoint': endpoint,
+                    'count': count,
+                    'total_ms': stats['wall_ms'],
+                    'avg_ms': stats['wall_ms'] / count,
+                    'p50_ms': durations[int(0.50 * (len(durations) - 1))],
+                    'p95_ms': durations[int(0.95 * (len(durations) - 1))],
+                    'max_ms': stats['max_ms'],
+                    'avg_sql_count': stats['sql_count'] / count,
+                    'avg_sql_ms': stats['sql_ms'] / count,
+                    'avg_template_ms': stats['template_ms'] / count,
+                    'avg_markdown_ms': stats['markdown_ms'] / count,
+                })
+        rows.sort(key=lambda row: row['total_ms'], reverse=True)
+        return rows
+
+request_metrics = RequestMetrics()
+request_log = logging.getLogger('dnd.requests')
+
+def record_request_metric(field, elapsed_ms):
+    """Добавляет время к метрикам текущего запроса (вне запроса или без инструментирования — ничего)."""
+    if has_request_context():
+        metrics = g.get('request_metrics')
+        if metrics is not None:
+            metrics[field] += elapsed_ms
+
+# Время старта храним в контексте выполнения, а не в стеке соединения: у упавшего запроса
+# after_cursor_execute не вызывается, и запись в стеке сбила бы замеры следующих запросов
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_started_at = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started_at = getattr(context, 'query_started_at', None)
+    if started_at is not None and has_request_context():
+        metrics = g.get('request_metrics')
+        if metrics is not None:
+            metrics['sql_count'] += 1
+            metrics['sql_ms'] += (time.perf_counter() - started_at) * 1000
+
+def _before_render_template(sender, template, context, **extra):
+    if g.get('request_metrics') is not None:
+        g.template_started_at = time.perf_counter()
+
+def _template_rendered(sender, template, context, **extra):
+    started_at = g.pop('template_started_at', None)
+    if started_at is not None:
+        record_request_metric('template_ms', (time.perf_counter() - started_at) * 1000)
+
+def start_request_instrumentation():
+    g.request_metrics = {'started_at': time.perf_counter(),
+                         **{field: 0 for field in RequestMetrics.FIELDS}}
+    if random.random() < app.config['PROFILE_SAMPLE_RATE']:
+        g.request_profiler = cProfile.Profile()
+        g.request_profiler.enable()
+
+def finish_request_instrumentation(response):
+    metrics = g.pop('request_metrics', None)
+    if metrics is None:
+        return response
+    metrics['wall_ms'] = (time.perf_counter() - metrics.pop('started_at')) * 1000
+    endpoint = request.endpoint or '<unmatched>'
+
+    profile_path = None
+    profiler = g.pop('request_profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        # Профили быстрых запросов неинтересны — сохраняем только медленные
+        if metrics['wall_ms'] >= app.config['PROFILE_SLOW_THRESHOLD_MS']:
+            profile_path = os.path.join(app.config['PROFILE_DIR'],
+                                        f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}_{endpoint}_{secrets.token_hex(3)}.prof")
+            try:
+                profiler.dump_stats(profile_path)
+            except OSError as e:
+                print(f"Error saving profile {profile_path}: {e}")
+                profile_path = None
+
+    request_metrics.record(endpoint, metrics)
+    request_log.info(json.dumps({
+        'ts': datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+        'method': request.method,
+        'path': request.path,
+        'endpoint': endpoint,
+        'status': response.status_code,
+        **{field: round(value, 2) for field, value in metrics.items()},
+        'profile': profile_path and os.path.basename(profile_path),
+    }, ensure_ascii=False))
+    return response
+
+def init_request_instrumentation(app):
+    os.makedirs(os.path.dirname(app.config['INSTRUMENTATION_LOG']), exist_ok=True)
+    os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+    handler = RotatingFileHandler(app.config['INSTRUMENTATION_LOG'],
+                                  maxBytes=app.config['INSTRUMENTATION_LOG_MAX_BYTES'],
+                                  backupCount=app.config['INSTRUMENTATION_LOG_BACKUPS'],
+                                  encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    request_log.addHandler(handler)
+    request_log.setLevel(logging.INFO)
+    request_log.propagate = False
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(db.engine, 'after_cursor_execute', _after_cursor_execute)
+    before_render_template.connect(_before_render_template, app)
+    template_rendered.connect(_template_rendered, app)
+    app.before_request(start_request_instrumentation)
+    app.after_request(finish_request_instrumentation)
+
+if app.config['INSTRUMENTATION_ENABLED']:
+    init_request_instrumentation(app)
 
 # --- Данные SRD ---
 SRD_CLASSES = {
@@ -946,6 +2363,8 @@ SRD_MONSTERS = {
 }
 
 def challenge_rating_sort_key(cr_str):
+    # Отбрасываем опыт в скобках: "1/4 (50 опыта)" -> "1/4"
+    cr_str = cr_str.split('(')[0].strip()
     if "/" in cr_str:
         try:
             num, den = map(int, cr_str.split('/'))
@@ -957,11 +2376,6 @@ def challenge_rating_sort_key(cr_str):
     except ValueError:
         return 999
 
-ALL_MONSTER_CHALLENGES = sorted(list(set(
-    monster_data.get('challenge', 'Не указан') for monster_data in SRD_MONSTERS.values()
-)), key=challenge_rating_sort_key)
-
-
 # Уникальные типы существ (извлекаем из 'size_type_alignment')
 def extract_monster_type(size_type_alignment_str):
     parts = size_type_alignment_str.split(',')
@@ -990,12 +2404,6 @@ def extract_monster_type(size_type_alignment_str):
             return " ".join(actual_type_words).capitalize()
     return None
 
-ALL_MONSTER_TYPES = sorted(list(set(
-    extract_monster_type(monster_data.get('size_type_alignment', ''))
-    for monster_data in SRD_MONSTERS.values()
-    if extract_monster_type(monster_data.get('size_type_alignment', '')) # Убираем None значения
-)))
-
 # Уникальные мировоззрения (извлекаем из 'size_type_alignment')
 def extract_monster_alignment(size_type_alignment_str):
     parts = size_type_alignment_str.split(',')
@@ -1003,12 +2411,6 @@ def extract_monster_alignment(size_type_alignment_str):
         return parts[-1].strip().capitalize() 
     return None
 
-ALL_MONSTER_ALIGNMENTS = sorted(list(set(
-    extract_monster_alignment(monster_data.get('size_type_alignment', ''))
-    for monster_data in SRD_MONSTERS.values()
-    if extract_monster_alignment(monster_data.get('size_type_alignment', ''))
-)))
-
 # Уникальные размеры (извлекаем из 'size_type_alignment')
 def extract_monster_size(size_type_alignment_str):
     parts = size_type_alignment_str.split(',')
@@ -1019,11 +2421,54 @@ def extract_monster_size(size_type_alignment_str):
             return size_words[0].strip().capitalize()
     return None
 
-ALL_MONSTER_SIZES = sorted(list(set(
-    extract_monster_size(monster_data.get('size_type_alignment', ''))
-    for monster_data in SRD_MONSTERS.values()
-    if extract_monster_size(monster_data.get('size_type_alignment', ''))
-)))
+# Опыт за чудовище: "1/4 (50 опыта)" -> 50, "5 (1 800 опыта)" -> 1800
+MONSTER_XP_RE = re.compile(r'\(([\d\s]+)')
+
+class MonsterRecord:
+    """Карточка чудовища для списка и фильтров, разобранная один раз при загрузке.
+    Полные данные для страницы чудовища остаются в SRD_MONSTERS (доступны через .data)."""
+    __slots__ = ('slug', 'name', 'en_name', 'icon', 'challenge', 'cr', 'xp',
+                 'size', 'type', 'alignment', 'data')
+
+    def __init__(self, slug, data):
+        self.slug = slug
+        self.name = data.get('name', slug)
+        self.en_name = data.get('en_name')
+        self.icon = data.get('icon')
+        self.challenge = data.get('challenge', 'Не указан').strip()
+        self.cr = challenge_rating_sort_key(self.challenge)
+        xp_match = MONSTER_XP_RE.search(self.challenge)
+        xp_digits = re.sub(r'\D', '', xp_match.group(1)) if xp_match else ''
+        self.xp = int(xp_digits) if xp_digits else None
+        size_type_alignment = data.get('size_type_alignment', '')
+        self.size = extract_monster_size(size_type_alignment)
+        self.type = (extract_monster_type(size_type_alignment) or '').strip() or None
+        self.alignment = extract_monster_alignment(size_type_alignment)
+        self.data = data
+
+    def __repr__(self):
+        return f'<MonsterRecord {self.slug} CR {self.challenge}>'
+
+# Записи сразу упорядочены по ПО: фасетный индекс сохраняет этот порядок при фильтрации
+SRD_MONSTER_RECORDS = sorted(
+    (MonsterRecord(slug, monster_data) for slug, monster_data in SRD_MONSTERS.items()),
+    key=lambda record: record.cr
+)
+SRD_MONSTERS_FACETS = FacetIndex(SRD_MONSTER_RECORDS, {
+    'cr': lambda record: [record.challenge.lower()],
+    'type': lambda record: [record.type.lower()] if record.type else [],
+    'alignment': lambda record: [record.alignment.lower()] if record.alignment else [],
+    'size': lambda record: [record.size.lower()] if record.size else [],
+})
+
+ALL_MONSTER_CHALLENGES = list(dict.fromkeys(record.challenge for record in SRD_MONSTER_RECORDS))
+ALL_MONSTER_TYPES = sorted({record.type for record in SRD_MONSTER_RECORDS if record.type})
+ALL_MONSTER_ALIGNMENTS = sorted({record.alignment for record in SRD_MONSTER_RECORDS if record.alignment})
+ALL_MONSTER_SIZES = sorted({record.size for record in SRD_MONSTER_RECORDS if record.size})
+
+def select_srd_monster_positions(filters):
+    """Позиции в SRD_MONSTER_RECORDS под фильтры {'cr', 'type', 'alignment', 'size'} (по ПО)."""
+    return SRD_MONSTERS_FACETS.positions(SRD_MONSTERS_FACETS.mask(filters))
 
 SRD_STATIC_CONTENT = {
     'character_info': """
@@ -1272,6 +2717,776 @@ SRD_STATIC_CONTENT = {
     """,
 }
 
+# --- Единый поиск по SRD: заклинания, чудовища, классы, виды и статьи ---
+SRD_STATIC_PAGE_TITLES = { # Ключ совпадает с ключом SRD_STATIC_CONTENT и именем вью
+    'character_info': 'Персонаж',
+    'equipment': 'Экипировка',
+    'gameplay': 'Игровой процесс',
+    'combat': 'Сражение',
+}
+SEARCH_RESULT_KINDS = { # Тип результата -> подпись (порядок — порядок вкладок на странице поиска)
+    'spell': 'Заклинания',
+    'monster': 'Чудовища',
+    'class': 'Классы',
+    'species': 'Виды',
+    'page': 'Статьи',
+    'homebrew': 'Homebrew',
+}
+SEARCH_RESULTS_LIMIT = 50
+SEARCH_HOMEBREW_PREVIEW = 10 # Сколько постов форума показывать вместе с результатами SRD
+SEARCH_SNIPPET_WIDTH = 200
+# Служебные поля данных SRD, которые не надо индексировать как текст
+SEARCH_SKIPPED_FIELDS = {'slug', 'icon', 'name', 'en_name'}
+
+def html_to_text(html):
+    """HTML -> текст без тегов, с раскрытыми сущностями и схлопнутыми пробелами."""
+    return Markup(html or '').striptags()
+
+def collect_search_text(value):
+    """Все строки из вложенных словарей и списков данных SRD (ключи словарей не берем)."""
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, dict):
+        value = [item for key, item in value.items() if key not in SEARCH_SKIPPED_FIELDS]
+    if isinstance(value, (list, tuple)):
+        return [text for item in value for text in collect_search_text(item)]
+    return []
+
+def build_srd_search_documents():
+    documents = []
+    for spell in SRD_SPELLS_LIST:
+        documents.append({
+            'kind': 'spell', 'title': spell['name'], 'en_name': spell.get('en_name'),
+            'subtitle': ', '.join(part for part in (spell.get('level_display'), spell.get('school_display')) if part),
+            'text': html_to_text(' '.join(collect_search_text([spell.get('description'), spell.get('higher_level_list')]))),
+            'endpoint': 'spell_detail', 'url_args': {'spell_slug': spell['slug']},
+        })
+    for record in SRD_MONSTER_RECORDS:
+        documents.append({
+            'kind': 'monster', 'title': record.name, 'en_name': record.en_name,
+            'subtitle': f"{record.data.get('size_type_alignment', '')}, ПО {record.challenge}".strip(', '),
+            'text': html_to_text(' '.join(collect_search_text(record.data))),
+            'endpoint': 'monster_detail', 'url_args': {'monster_slug': record.slug},
+        })
+    for kind, items, endpoint, slug_arg in (('class', SRD_CLASSES, 'class_detail', 'class_slug'),
+                                            ('species', SRD_SPECIES, 'species_detail', 'species_slug')):
+        for slug, data in items.items():
+            documents.append({
+                'kind': kind, 'title': data.get('name', slug), 'en_name': data.get('en_name'),
+                'subtitle': data.get('en_name') or '',
+                'text': html_to_text(' '.join(collect_search_text(data))),
+                'endpoint': endpoint, 'url_args': {slug_arg: slug},
+            })
+    for key, html in SRD_STATIC_CONTENT.items():
+        documents.append({
+            'kind': 'page', 'title': SRD_STATIC_PAGE_TITLES.get(key, key), 'en_name': None, 'subtitle': '',
+            'text': html_to_text(html), 'endpoint': key, 'url_args': {},
+        })
+    return documents
+
+SRD_SEARCH_DOCUMENTS = build_srd_search_documents()
+SRD_SEARCH_INDEX = SearchIndex(SRD_SEARCH_DOCUMENTS, {'title': 3, 'en_name': 2, 'text': 1})
+
+def search_snippet(text, query, width=SEARCH_SNIPPET_WIDTH):
+    """Фрагмент текста вокруг первого совпадения со словами запроса, совпадения в <mark>."""
+    terms = [term for term in tokenize_search_text(query) if term]
+    folded = text.lower().replace('ё', 'е')
+    if not terms or len(folded) != len(text):
+        return Markup(escape(text[:width] + ('…' if len(text) > width else '')))
+    word_re = re.compile(r'\b(?:' + '|'.join(re.escape(term) for term in terms) + r')\w*')
+    first_match = word_re.search(folded)
+    start = max(first_match.start() - width // 4, 0) if first_match else 0
+    end = min(start + width, len(text))
+
+    parts = ['…' if start else '']
+    position = start
+    for match in word_re.finditer(folded, start, end):
+        parts.append(str(escape(text[position:match.start()])))
+        parts.append(f'<mark>{escape(text[match.start():match.end()])}</mark>')
+        position = match.end()
+    parts.append(str(escape(text[position:end])))
+    parts.append('…' if end < len(text) else '')
+    return Markup(''.join(parts))
+
+def search_srd(query, kind=''):
+    """Результаты SRD по релевантности (не больше SEARCH_RESULTS_LIMIT) и число найденных по типам."""
+    kind_counts = {}
+    results = []
+    for doc_id in SRD_SEARCH_INDEX.search(query):
+        document = SRD_SEARCH_DOCUMENTS[doc_id]
+        kind_counts[document['kind']] = kind_counts.get(document['kind'], 0) + 1
+        if (not kind or document['kind'] == kind) and len(results) < SEARCH_RESULTS_LIMIT:
+            results.append(document)
+    return results, kind_counts
+
+# --- Подсказки при вводе (/api/suggest) ---
+SUGGEST_LIMIT = 8
+SUGGEST_MAX_LIMIT = 20
+SUGGEST_KINDS = ('spell', 'monster', 'class', 'species')
+
+class Suggestion(msgspec.Struct):
+    kind: str
+    name: str
+    en_name: str | None
+    slug: str
+    url: str
+
+class SuggestResponse(msgspec.Struct):
+    query: str
+    suggestions: list[Suggestion]
+
+def normalize_suggest_key(text):
+    """Ключ для сравнения префиксов: слова в нижнем регистре, ё -> е, без пунктуации."""
+    return ' '.join(SEARCH_TOKEN_RE.findall((text or '').lower().replace('ё', 'е')))
+
+class PrefixSuggester:
+    """Отсортированный массив ключей + bisect: все ключи с нужным префиксом лежат подряд.
+    Ключи — полное название, английское название, слаг и «хвосты» названий с каждого
+    следующего слова, чтобы "шар" находил и "Огненный шар"."""
+
+    FULL_NAME, INNER_WORD = 0, 1 # Совпадение с начала названия выше совпадения с середины
+
+    def __init__(self, suggestions):
+        self.suggestions = suggestions
+        entries = set()
+        for index, suggestion in enumerate(suggestions):
+            for text in (suggestion.name, suggestion.en_name, suggestion.slug):
+                words = normalize_suggest_key(text).split()
+                for position in range(len(words)):
+                    entries.add((' '.join(words[position:]),
+                                 self.FULL_NAME if position == 0 else self.INNER_WORD, index))
+        self.entries = sorted(entries)
+        self.keys = [key for key, _, _ in self.entries]
+
+    def suggest(self, query, kind='', limit=SUGGEST_LIMIT):
+        prefix = normalize_suggest_key(query)
+        if not prefix:
+            return []
+        best_ranks = {}
+        start = bisect.bisect_left(self.keys, prefix)
+        for key, match_type, index in itertools.islice(self.entries, start, None):
+            if not key.startswith(prefix):
+                break
+            suggestion = self.suggestions[index]
+            if kind and suggestion.kind != kind:
+                continue
+            rank = (key != prefix, match_type, len(suggestion.name), suggestion.name)
+            if index not in best_ranks or rank < best_ranks[index]:
+                best_ranks[index] = rank
+        return [self.suggestions[index] for index in sorted(best_ranks, key=best_ranks.get)[:limit]]
+
+@functools.cache
+def get_srd_suggester():
+    """Строится при первом запросе: для URL нужен url_for в контексте запроса."""
+    suggestions = [Suggestion('spell', spell['name'], spell.get('en_name'), spell['slug'],
+                              url_for('spell_detail', spell_slug=spell['slug']))
+                   for spell in SRD_SPELLS_LIST]
+    suggestions += [Suggestion('monster', record.name, record.en_name, record.slug,
+                               url_for('monster_detail', monster_slug=record.slug))
+                    for record in SRD_MONSTER_RECORDS]
+    suggestions += [Suggestion('class', data.get('name', slug), data.get('en_name'), slug,
+                               url_for('class_detail', class_slug=slug))
+                    for slug, data in SRD_CLASSES.items()]
+    suggestions += [Suggestion('species', data.get('name', slug), data.get('en_name'), slug,
+                               url_for('species_detail', species_slug=slug))
+                    for slug, data in SRD_SPECIES.items()]
+    return PrefixSuggester(suggestions)
+
+# Готовые JSON-ответы по нормализованному запросу: повторные подсказки — без поиска и кодирования
+suggest_cache = LRUCache(max_entries=4096, default_timeout=0)
+
+# --- JSON API каталога SRD (/api/v1) ---
+# Поля структур названы как ключи обработанных словарей (spell_processed, SRD_MONSTERS и т.д.),
+# поэтому записи переводятся в них одним msgspec.convert; лишние ключи (сырой 'system') отбрасываются.
+API_PER_PAGE = 50
+API_MAX_PER_PAGE = 200
+API_CACHE_MAX_AGE = 3600
+
+class SpellOut(msgspec.Struct):
+    slug: str
+    name: str
+    en_name: str | None
+    level_raw: int | str | None
+    level_display: str
+    school_raw: str | None
+    school_display: str
+    casting_time_display: str
+    range_display: str
+    components_display: str
+    duration_display: str
+    concentration: bool
+    ritual: bool
+    classes_raw: list[str]
+    classes_display: list[str]
+    description: str
+    higher_level_list: list[str]
+    tags: list[str]
+    type: str
+
+class MonsterFeature(msgspec.Struct):
+    name: str
+    desc: str
+
+class MonsterOut(msgspec.Struct):
+    slug: str
+    name: str
+    en_name: str | None
+    icon: str | None
+    size_type_alignment: str
+    armor_class: str
+    hit_points: str
+    speed: str
+    stats: dict[str, str]
+    senses: str
+    languages: str
+    challenge: str
+    description: str = ''
+    skills: str | None = None
+    damage_vulnerabilities: str | None = None
+    damage_immunities: str | None = None
+    condition_immunities: str | None = None
+    abilities: list[MonsterFeature] = []
+    actions: list[MonsterFeature] = []
+    # Разобранные поля MonsterRecord — те же, по которым работают фильтры
+    cr: float = 0.0
+    xp: int | None = None
+    size: str | None = None
+    type: str | None = None
+    alignment: str | None = None
+
+class ClassOut(msgspec.Struct):
+    slug: str
+    name: str
+    en_name: str | None
+    icon: str | None
+    description: str
+    hit_dice: str
+    hp_at_first_level: str
+    hp_at_higher_levels: str
+    proficiencies: dict[str, str]
+    equipment: list[str]
+    features_table: dict[int, list[str]]
+    detailed_features: dict[str, str] = {}
+
+class SubraceOut(msgspec.Struct):
+    name: str
+    traits: dict[str, str]
+
+class SpeciesOut(msgspec.Struct):
+    slug: str
+    name: str
+    en_name: str | None
+    icon: str | None
+    description: str
+    traits: dict[str, str]
+    subraces: dict[str, SubraceOut] = {}
+
+class ApiPage(msgspec.Struct):
+    items: list
+    total: int
+    page: int
+    per_page: int
+    pages: int
+
+class ApiError(msgspec.Struct):
+    error: str
+
+def convert_api_items(records, struct_type):
+    """Записи каталога -> структуры API. Запись, не прошедшая схему, не должна ронять приложение
+    при импорте: вместо нее None, чтобы позиции совпадали с исходным списком (их отдают фильтры)."""
+    items = []
+    for record in records:
+        try:
+            items.append(msgspec.convert(record, struct_type))
+        except msgspec.ValidationError as e:
+            print(f"WARNING: Запись '{record.get('slug')}' пропущена в API ({struct_type.__name__}): {e}")
+            items.append(None)
+    return items
+
+class ApiCollection:
+    """Коллекция SRD для API: записи-структуры в порядке HTML-списка, отбор по фильтрам
+    и готовые JSON полных записей (для /api/v1/<коллекция>/<slug> без fields=)."""
+
+    def __init__(self, struct_type, items, filter_params=(), select_positions=None):
+        self.struct_type = struct_type
+        self.positioned_items = items # С None на месте записей, не прошедших convert_api_items
+        self.items = [item for item in items if item is not None]
+        self.by_slug = {item.slug: item for item in self.items}
+        self.fields = struct_type.__struct_fields__
+        self.filter_params = filter_params
+        self.select_positions = select_positions # args -> позиции в items (или None — все записи)
+        self.item_bodies = {item.slug: msgspec.json.encode(item) for item in self.items}
+
+    def select(self, args):
+        if self.select_positions is None or not any(args.get(param) for param in self.filter_params):
+            return self.items
+        items = (self.positioned_items[position] for position in self.select_positions(args))
+        return [item for item in items if item is not None]
+
+API_COLLECTIONS = {
+    'spells': ApiCollection(
+        SpellOut, convert_api_items(SRD_SPELLS_LIST, SpellOut),
+        filter_params=('search', 'class', 'level', 'school'),
+        select_positions=lambda args: select_srd_spell_positions(
+            args.get('search', '').strip(),
+            {'class': args.get('class', ''), 'level': args.get('level', ''), 'school': args.get('school', '')}),
+    ),
+    'monsters': ApiCollection(
+        MonsterOut, convert_api_items([{**record.data, 'slug': record.slug, 'cr': record.cr, 'xp': record.xp,
+                                        'size': record.size, 'type': record.type, 'alignment': record.alignment}
+                                       for record in SRD_MONSTER_RECORDS], MonsterOut),
+        filter_params=('cr', 'type', 'alignment', 'size'),
+        select_positions=lambda args: select_srd_monster_positions(
+            {param: args.get(param, '') for param in ('cr', 'type', 'alignment', 'size')}),
+    ),
+    'classes': ApiCollection(ClassOut, convert_api_items([{**data, 'slug': slug}
+                                                          for slug, data in SRD_CLASSES.items()], ClassOut)),
+    'species': ApiCollection(SpeciesOut, convert_api_items([{**data, 'slug': slug}
+                                                            for slug, data in SRD_SPECIES.items()], SpeciesOut)),
+}
+
+# Закодированные ответы списков по нормализованным параметрам; первые страницы без фильтров
+# кодируются заранее при старте (см. warm_api_cache)
+api_response_cache = LRUCache(max_entries=1024, default_timeout=0)
+
+class ApiRequestError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+def parse_api_fields(collection, fields_param):
+    """fields=name,level_raw -> кортеж полей (пустой — все поля); неизвестные поля — ошибка 400."""
+    fields = tuple(dict.fromkeys(field.strip() for field in (fields_param or '').split(',') if field.strip()))
+    unknown = [field for field in fields if field not in collection.fields]
+    if unknown:
+        raise ApiRequestError(f"Неизвестные поля: {', '.join(unknown)}. Доступны: {', '.join(collection.fields)}.")
+    return fields
+
+def project_api_item(item, fields):
+    if not fields:
+        return item
+    return {field: getattr(item, field) for field in fields}
+
+def encode_api_page(collection, args, fields, page, per_page):
+    items = collection.select(args)
+    return msgspec.json.encode(ApiPage(
+        items=[project_api_item(item, fields) for item in items[(page - 1) * per_page:page * per_page]],
+        total=len(items),
+        page=page,
+        per_page=per_page,
+        pages=max((len(items) + per_page - 1) // per_page, 1),
+    ))
+
+def warm_api_cache():
+    for name, collection in API_COLLECTIONS.items():
+        api_response_cache.set(f'{name}|||1|{API_PER_PAGE}',
+                               encode_api_page(collection, {}, (), 1, API_PER_PAGE))
+
+warm_api_cache()
+
+def json_api_response(body, status=200):
+    """Публичный JSON-ответ: данные SRD меняются только с деплоем, проверка по слабому ETag."""
+    response = app.response_class(body, status=status, mimetype='application/json')
+    if status == 200:
+        response.headers['Cache-Control'] = f'public, max-age={API_CACHE_MAX_AGE}'
+        response.add_etag(weak=True)
+        return response.make_conditional(request)
+    return response
+
+# --- Выгрузка SRD и форума в NDJSON (flask export, /admin/export) ---
+# Одна JSON-запись на строку: {"type": "...", "data": {...}}. Таблицы читаются потоком
+# (yield_per), поэтому память не растет вместе с базой; gzip сжимает на лету тем же потоком.
+EXPORT_FORMAT_VERSION = 1
+EXPORT_SECTIONS = ('spells', 'monsters', 'users', 'posts', 'comments')
+EXPORT_BATCH_SIZE = 500
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+class ExportRecord(msgspec.Struct):
+    type: str
+    data: object
+
+def iter_export_rows(statement):
+    """Строки запроса пачками по EXPORT_BATCH_SIZE, без загрузки всей таблицы в память."""
+    result = db.session.execute(statement.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    for row in result:
+        yield dict(row._mapping)
+
+def iter_export_records(sections=EXPORT_SECTIONS):
+    yield ExportRecord('meta', {
+        'format_version': EXPORT_FORMAT_VERSION,
+        'exported_at': datetime.utcnow(),
+        'sections': list(sections),
+        'srd_source_hash': srd_source_hash(),
+    })
+    if 'spells' in sections:
+        # Те же записи, что отдает /api/v1/spells
+        for spell in API_COLLECTIONS['spells'].items:
+            yield ExportRecord('spell', spell)
+    if 'monsters' in sections:
+        for monster in API_COLLECTIONS['monsters'].items:
+            yield ExportRecord('monster', monster)
+    if 'users' in sections:
+        # Без хешей паролей: выгрузка предназначена для бэкапа контента и модерации
+        statement = db.select(User.id, User.username, User.role, User.registered_on, User.description,
+                              User.avatar_filename, User.post_count, User.comment_count).order_by(User.id)
+        for row in iter_export_rows(statement):
+            yield ExportRecord('user', row)
+    if 'posts' in sections:
+        statement = (db.select(HomebrewPost.id, HomebrewPost.title, HomebrewPost.category,
+                               HomebrewPost.user_id, User.username.label('author'), HomebrewPost.timestamp,
+                               HomebrewPost.last_activity_at, HomebrewPost.comment_count, HomebrewPost.content)
+                     .join(User, User.id == HomebrewPost.user_id)
+                     .order_by(HomebrewPost.id))
+        for row in iter_export_rows(statement):
+            yield ExportRecord('post', row)
+    if 'comments' in sections:
+        # Комментарии форума и страниц SRD; по post_id (NULL — комментарии SRD) и id
+        statement = (db.select(Comment.id, Comment.post_id, Comment.srd_page_type, Comment.srd_page_slug,
+                               Comment.parent_comment_id, Comment.user_id, User.username.label('author'),
+                               Comment.timestamp, Comment.content)
+                     .join(User, User.id == Comment.user_id)
+                     .order_by(Comment.post_id, Comment.id))
+        for row in iter_export_rows(statement):
+            yield ExportRecord('comment', row)
+
+def iter_export_chunks(sections=EXPORT_SECTIONS, compress=False):
+    """Байтовые куски NDJSON (или gzip-потока) примерно по EXPORT_CHUNK_BYTES."""
+    encoder = msgspec.json.Encoder()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None # wbits=31: формат gzip
+    buffer = bytearray()
+    for record in iter_export_records(sections):
+        encoder.encode_into(record, buffer, len(buffer))
+        buffer.extend(b'\n')
+        if len(buffer) >= EXPORT_CHUNK_BYTES:
+            chunk = compressor.compress(bytes(buffer)) if compressor else bytes(buffer)
+            buffer.clear()
+            if chunk:
+                yield chunk
+    tail = compressor.compress(bytes(buffer)) + compressor.flush() if compressor else bytes(buffer)
+    if tail:
+        yield tail
+
+def parse_export_sections(value):
+    """'posts,comments' -> кортеж разделов в каноническом порядке; пусто — все разделы."""
+    requested = {section.strip() for section in (value or '').split(',') if section.strip()}
+    unknown = requested - set(EXPORT_SECTIONS)
+    if unknown:
+        raise ValueError(f"Неизвестные разделы: {', '.join(sorted(unknown))}. Доступны: {', '.join(EXPORT_SECTIONS)}.")
+    return tuple(section for section in EXPORT_SECTIONS if section in requested) or EXPORT_SECTIONS
+
+# --- Сборка статики: имена с хешем, предсжатые копии, WebP/MP4 из GIF (flask assets-build) ---
+# Результат сборки лежит в static/build/, поэтому его отдает тот же маршрут static.
+# Исходные файлы не трогаются: без манифеста (и в режиме отладки) url_for('static')
+# указывает на них, как раньше.
+STATIC_BUILD_SUBDIR = 'build'
+STATIC_MANIFEST_VERSION = 1
+STATIC_HASH_LENGTH = 12
+STATIC_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+STATIC_BUILD_SKIP_DIRS = {STATIC_BUILD_SUBDIR, 'avatars'} # Результат сборки и загрузки пользователей
+STATIC_COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.json', '.svg', '.txt', '.xml', '.map', '.ico'}
+STATIC_PRECOMPRESSED_ENCODINGS = (('br', '.br'), ('gzip', '.gz')) # В порядке предпочтения
+STATIC_MIN_SAVING = 0.9 # Сжатую/перекодированную копию оставляем, только если она меньше 90% исходника
+# Смешанное (lossy/lossless по кадрам) кодирование: для пиксельных GIF обычный lossy WebP бывает больше исходника
+STATIC_WEBP_OPTIONS = {'quality': 70, 'method': 6, 'allow_mixed': True}
+
+class StaticAsset(msgspec.Struct):
+    path: str # Файл с хешем относительно static/, например build/css/style.1a2b3c4d5e6f.css
+    encodings: list[str] = [] # Есть предсжатые копии рядом: 'br' -> path + '.br', 'gzip' -> path + '.gz'
+    variants: dict[str, str] = {} # Перекодированные версии: MIME-тип -> путь относительно static/
+
+class StaticManifest(msgspec.Struct):
+    version: int
+    assets: dict[str, StaticAsset] # Исходный путь (как в url_for('static', filename=...)) -> сборка
+
+def static_manifest_path():
+    return os.path.join(app.static_folder, STATIC_BUILD_SUBDIR, 'manifest.json')
+
+def write_static_build_file(relative_path, data):
+    """Файлы сборки адресуются хешем, поэтому уже существующий файл не переписываем."""
+    path = os.path.join(app.static_folder, relative_path)
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def precompress_static_file(relative_path, data):
+    encodings = []
+    compressors = [('gzip', lambda raw: gzip.compress(raw, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        compressors.insert(0, ('br', lambda raw: brotli.compress(raw, quality=11)))
+    suffixes = dict(STATIC_PRECOMPRESSED_ENCODINGS)
+    for encoding, compress in compressors:
+        compressed_path = relative_path + suffixes[encoding]
+        if not os.path.exists(os.path.join(app.static_folder, compressed_path)):
+            compressed = compress(data)
+            if len(compressed) >= len(data) * STATIC_MIN_SAVING:
+                continue
+            write_static_build_file(compressed_path, compressed)
+        encodings.append(encoding)
+    return encodings
+
+def transcode_animated_gif(source_path, target_stem):
+    """Анимированный GIF -> WebP (Pillow) и MP4 (ffmpeg, если установлен).
+    Возвращает {MIME-тип: путь относительно static/} для версий, которые получились меньше GIF."""
+    variants = {}
+    gif_size = os.path.getsize(source_path)
+    with Image.open(source_path) as image:
+        if not getattr(image, 'is_animated', False):
+            return variants
+        webp_path = f'{target_stem}.webp'
+        webp_file = os.path.join(app.static_folder, webp_path)
+        if not os.path.exists(webp_file):
+            durations = []
+            for frame_index in range(image.n_frames):
+                image.seek(frame_index)
+                durations.append(image.info.get('duration', 100))
+            image.seek(0)
+            buffer = io.BytesIO()
+            image.save(buffer, 'WEBP', save_all=True, duration=durations, loop=image.info.get('loop', 0),
+                       **STATIC_WEBP_OPTIONS)
+            if buffer.tell() < gif_size * STATIC_MIN_SAVING:
+                write_static_build_file(webp_path, buffer.getvalue())
+        if os.path.exists(webp_file):
+            variants['image/webp'] = webp_path
+
+    ffmpeg = shutil.which('ffmpeg')
+    mp4_path = f'{target_stem}.mp4'
+    mp4_file = os.path.join(app.static_folder, mp4_path)
+    if ffmpeg and not os.path.exists(mp4_file):
+        tmp_file = mp4_file + '.tmp.mp4'
+        try:
+            # yuv420p и четные размеры нужны для совместимости H.264 с браузерами
+            subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-i', source_path, '-an',
+                            '-movflags', '+faststart', '-pix_fmt', 'yuv420p',
+                            '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2', tmp_file],
+                           check=True, timeout=600)
+            if os.path.getsize(tmp_file) < gif_size * STATIC_MIN_SAVING:
+                os.replace(tmp_file, mp4_file)
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"WARNING: ffmpeg не смог перекодировать '{source_path}': {e}")
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    if os.path.exists(mp4_file):
+        variants['video/mp4'] = mp4_path
+    return variants
+
+def build_static_asset(source_path, logical_path):
+    with open(source_path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()[:STATIC_HASH_LENGTH]
+    stem, extension = os.path.splitext(logical_path)
+    target_stem = f'{STATIC_BUILD_SUBDIR}/{stem}.{digest}'
+    target_path = target_stem + extension
+    write_static_build_file(target_path, data)
+    encodings = precompress_static_file(target_path, data) if extension.lower() in STATIC_COMPRESSIBLE_EXTENSIONS else []
+    variants = transcode_animated_gif(source_path, target_stem) if extension.lower() == '.gif' else {}
+    return StaticAsset(target_path, encodings, variants)
+
+def build_static_assets():
+    """Собирает все файлы static/ (кроме сборки и аватаров) и атомарно записывает манифест."""
+    assets = {}
+    for directory, dirnames, filenames in os.walk(app.static_folder):
+        if os.path.samefile(directory, app.static_folder):
+            dirnames[:] = [name for name in dirnames if name not in STATIC_BUILD_SKIP_DIRS]
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.startswith('.'):
+                continue
+            source_path = os.path.join(directory, filename)
+            logical_path = os.path.relpath(source_path, app.static_folder).replace(os.sep, '/')
+            assets[logical_path] = build_static_asset(source_path, logical_path)
+    manifest = StaticManifest(STATIC_MANIFEST_VERSION, assets)
+    write_path = static_manifest_path()
+    os.makedirs(os.path.dirname(write_path), exist_ok=True)
+    with open(write_path + '.tmp', 'wb') as f:
+        f.write(msgspec.json.encode(manifest))
+    os.replace(write_path + '.tmp', write_path)
+    return manifest
+
+def load_static_manifest():
+    if not app.config['STATIC_FINGERPRINTS_ENABLED']:
+        return None
+    try:
+        with open(static_manifest_path(), 'rb') as f:
+            manifest = msgspec.json.decode(f.read(), type=StaticManifest)
+    except FileNotFoundError:
+        return None
+    except (msgspec.DecodeError, msgspec.ValidationError) as e:
+        print(f"WARNING: Не удалось прочитать манифест статики: {e}")
+        return None
+    if manifest.version != STATIC_MANIFEST_VERSION:
+        print("INFO: Манифест статики от старой версии сборки, запустите flask assets-build.")
+        return None
+    return manifest
+
+static_manifest = load_static_manifest()
+# Файлы сборки -> доступные предсжатые копии (для маршрута static)
+static_built_files = {}
+if static_manifest is not None:
+    for asset in static_manifest.assets.values():
+        static_built_files[asset.path] = asset.encodings
+        static_built_files.update({variant_path: [] for variant_path in asset.variants.values()})
+
+def static_fingerprints_active():
+    # В режиме отладки файлы правят на ходу, поэтому всегда отдаем исходники
+    return static_manifest is not None and not app.debug
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    """url_for('static', filename='css/style.css') -> build/css/style.<хеш>.css, если файл собран."""
+    if endpoint == 'static' and static_fingerprints_active():
+        asset = static_manifest.assets.get(values.get('filename'))
+        if asset is not None:
+            values['filename'] = asset.path
+
+@app.template_global()
+def static_variants(filename):
+    """{MIME-тип: URL} перекодированных версий файла (WebP/MP4 для GIF); пусто, если их нет."""
+    if not static_fingerprints_active():
+        return {}
+    asset = static_manifest.assets.get(filename)
+    if asset is None:
+        return {}
+    return {mimetype: url_for('static', filename=path) for mimetype, path in asset.variants.items()}
+
+# --- Условные GET-запросы (ETag / Last-Modified) ---
+def _hash_templates():
+    digest = hashlib.sha256()
+    for root, _, files in sorted(os.walk(os.path.join(app.root_path, 'templates'))):
+        for filename in sorted(files):
+            with open(os.path.join(root, filename), 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+# Отпечаток всего, из чего собираются страницы SRD: каталог заклинаний, словари в коде и шаблоны.
+# Меняется при обновлении данных или деплое новой верстки.
+SRD_ETAG_SEED = hashlib.sha256('|'.join([
+    srd_source_hash() or '',
+    json.dumps([SRD_CLASSES, SRD_SPECIES, SRD_MONSTERS, SRD_STATIC_CONTENT], sort_keys=True, ensure_ascii=False),
+    _hash_templates(),
+]).encode('utf-8')).hexdigest()
+
+def viewer_fingerprint():
+    """Часть страницы, зависящая от посетителя: навбар (имя, аватар) и кнопки модерации.
+    Страницы залогиненных содержат CSRF-токен, поэтому добавляем его состояние: токен сессии
+    (меняется при новом входе) и интервал жизни подписи, чтобы браузер по 304 не оставил
+    себе форму с просроченным или чужим токеном."""
+    if is_anonymous_fast_path() or not current_user.is_authenticated:
+        return 'anonymous'
+    raw_token = session.get(app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'), '')
+    time_limit = app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    csrf_window = int(time.time() // max(time_limit, 1)) if time_limit else 0
+    return (f'{current_user.id}:{current_user.username}:{current_user.role}:{current_user.avatar_filename}:'
+            f'{hashlib.sha1(raw_token.encode("utf-8")).hexdigest()[:16]}:{csrf_window}')
+
+def utc_http_date(value):
+    """Наивное UTC-время из БД -> aware datetime с точностью до секунды (как в HTTP-заголовках)."""
+    if value is None:
+        return None
+    return value.replace(tzinfo=timezone.utc, microsecond=0)
+
+def author_fingerprint_sql():
+    """Имя и аватар автора одной строкой: страница показывает их, поэтому они входят в ETag."""
+    return User.username + ':' + db.func.coalesce(User.avatar_filename, '')
+
+def comment_validators(query_filter):
+    """Дешевый отпечаток комментариев страницы: количество, последний id и время,
+    плюс имена и аватары авторов (после переименования страница должна обновиться)."""
+    count, max_id, newest, authors = db.session.query(
+        db.func.count(Comment.id), db.func.max(Comment.id), db.func.max(Comment.timestamp),
+        db.func.group_concat(db.distinct(author_fingerprint_sql()))
+    ).join(User, User.id == Comment.user_id).filter(query_filter).one()
+    authors_digest = hashlib.sha1((authors or '').encode('utf-8')).hexdigest()[:16]
+    return f'{count}-{max_id}-{newest}-{authors_digest}', newest
+
+def conditional_get(validators):
+    """Декоратор вью: отвечает 304 без рендеринга шаблона, если у клиента актуальная версия.
+
+    validators(**view_args) возвращает (etag, weak, last_modified) и должен быть намного
+    дешевле самой вью: без загрузки деревьев комментариев и рендеринга.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**view_args):
+            anonymous = is_anonymous_fast_path()
+            if not anonymous and (request.method not in ('GET', 'HEAD') or session.get('_flashes')):
+                return view(**view_args)
+            page_etag, weak, last_modified = validators(**view_args)
+            g.page_validator = page_etag # Для ключа PageCache (см. PageCache.make_key)
+            page_key = '|'.join([page_etag, request.full_path, viewer_fingerprint()])
+            etag = hashlib.sha1(page_key.encode('utf-8')).hexdigest()
+            last_modified = utc_http_date(last_modified)
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = bool(last_modified and request.if_modified_since
+                                    and last_modified <= request.if_modified_since)
+
+            if not_modified:
+                response = app.response_class(status=304)
+            else:
+                response = make_response(view(**view_args))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=weak)
+            if last_modified:
+                response.last_modified = last_modified
+            # Страницу залогиненного хранит только его браузер и перепроверяет по ETag
+            if anonymous or not current_user.is_authenticated:
+                response.headers['Cache-Control'] = anonymous_cache_control()
+            else:
+                response.headers['Cache-Control'] = 'private, no-cache'
+            response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
+
+def srd_static_validators(**view_args):
+    return SRD_ETAG_SEED, False, None
+
+def srd_comment_page_validators(page_type):
+    def validators(**view_args):
+        page_slug = next(iter(view_args.values()))
+        comments_etag, newest = comment_validators(
+            (Comment.srd_page_type == page_type) & (Comment.srd_page_slug == page_slug)
+        )
+        return f'{SRD_ETAG_SEED}-{comments_etag}', True, newest
+    return validators
+
+def post_detail_validators(post_id):
+    post_row = db.session.query(HomebrewPost.timestamp, author_fingerprint_sql()).join(
+        User, User.id == HomebrewPost.user_id).filter(HomebrewPost.id == post_id).first()
+    if post_row is None:
+        return 'missing', True, None # Вью сама ответит 404
+    post_timestamp, post_author = post_row
+    comments_etag, newest = comment_validators(Comment.post_id == post_id)
+    return f'{post_timestamp}-{post_author}-{comments_etag}', True, max(filter(None, [post_timestamp, newest]))
+
+def homebrew_index_validators():
+    """Отпечаток самой страницы: посты на ней (правки, авторы, число комментариев) и общее число.
+    Выборка страницы (или результатов поиска) дешевая, вью берет ее из g и не повторяет запрос."""
+    search_query = request.args.get('q', '').strip()
+    if search_query:
+        hits, has_next = g.homebrew_search_results = search_homebrew(
+            search_query, request.args.get('category', ''), request.args.get('page', 1, type=int))
+        fingerprint = ','.join(f'{hit.post.id}:{hit.comment_id}:{hit.post.timestamp}:{hit.post.author.username}'
+                               for hit in hits)
+        return f'search-{has_next}-{fingerprint}', True, None
+
+    posts_page = g.homebrew_posts_page = paginate_homebrew_posts(
+        request.args.get('category', ''), request.args.get('cursor'))
+    fingerprint = ','.join(f'{post.id}:{post.timestamp}:{post.author.username}:{post.comment_count}'
+                           for post in posts_page.items)
+    last_activity = max((post.last_activity_at or post.timestamp for post in posts_page.items), default=None)
+    return f'{posts_page.total}-{fingerprint}', True, last_activity
+
+
 # --- 6. Маршруты (Views) ---
 
 # --- Основные маршруты ---
@@ -1280,6 +3495,94 @@ SRD_STATIC_CONTENT = {
 def index():
     return render_template('index.html', title='Dice & Destiny SRD Hub')
 
+# --- Единый поиск ---
+@app.route('/search')
+@page_cache.cached()
+def search():
+    query = request.args.get('q', '').strip()
+    selected_kind = request.args.get('type', '')
+    if selected_kind not in SEARCH_RESULT_KINDS:
+        selected_kind = ''
+
+    srd_results, kind_counts = [], {}
+    homebrew_hits, homebrew_has_more = [], False
+    if query:
+        srd_results, kind_counts = search_srd(query, selected_kind) # Счетчики вкладок нужны и на вкладке Homebrew
+        # Форум доступен только залогиненным — и в поиске тоже
+        if current_user.is_authenticated and selected_kind in ('', 'homebrew'):
+            homebrew_limit = SEARCH_RESULTS_LIMIT if selected_kind else SEARCH_HOMEBREW_PREVIEW
+            homebrew_hits, homebrew_has_more = search_homebrew(query, per_page=homebrew_limit)
+            kind_counts['homebrew'] = len(homebrew_hits)
+
+    return render_template(
+        'search.html',
+        title=f'Поиск: {query}' if query else 'Поиск',
+        query=query,
+        selected_kind=selected_kind,
+        kinds=SEARCH_RESULT_KINDS,
+        kind_counts=kind_counts,
+        srd_results=[dict(document, url=url_for(document['endpoint'], **document['url_args']),
+                          snippet=search_snippet(document['text'], query)) for document in srd_results],
+        homebrew_hits=homebrew_hits,
+        homebrew_has_more=homebrew_has_more,
+    )
+
+# --- API подсказок ---
+@app.route('/api/suggest')
+def api_suggest():
+    """Подсказки по названиям (русским и английским) и слагам: ?q=огн&kind=spell&limit=8."""
+    query = normalize_suggest_key(request.args.get('q', '')[:100])
+    kind = request.args.get('kind', '')
+    if kind not in SUGGEST_KINDS:
+        kind = ''
+    limit = min(max(request.args.get('limit', SUGGEST_LIMIT, type=int), 1), SUGGEST_MAX_LIMIT)
+
+    cache_key = f'{kind}|{limit}|{query}'
+    body = suggest_cache.get(cache_key)
+    if body is None:
+        body = msgspec.json.encode(SuggestResponse(query, get_srd_suggester().suggest(query, kind, limit)))
+        suggest_cache.set(cache_key, body)
+
+    return json_api_response(body)
+
+# --- JSON API каталога SRD ---
+@app.route('/api/v1/<string:collection_name>')
+def api_collection(collection_name):
+    """Список: фильтры как в HTML (?class=&level=&school=&search= / ?cr=&type=&alignment=&size=),
+    ?fields=name,slug, ?page=, ?per_page= (до API_MAX_PER_PAGE)."""
+    collection = API_COLLECTIONS.get(collection_name)
+    if collection is None:
+        return json_api_response(msgspec.json.encode(ApiError('Неизвестная коллекция.')), 404)
+    try:
+        fields = parse_api_fields(collection, request.args.get('fields'))
+    except ApiRequestError as e:
+        return json_api_response(msgspec.json.encode(ApiError(e.message)), e.status)
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', API_PER_PAGE, type=int), 1), API_MAX_PER_PAGE)
+
+    filters = '&'.join(f'{param}={request.args[param].strip().lower()}'
+                       for param in collection.filter_params if request.args.get(param, '').strip())
+    cache_key = f"{collection_name}|{filters}|{','.join(fields)}|{page}|{per_page}"
+    body = api_response_cache.get(cache_key)
+    if body is None:
+        body = encode_api_page(collection, request.args, fields, page, per_page)
+        api_response_cache.set(cache_key, body)
+    return json_api_response(body)
+
+@app.route('/api/v1/<string:collection_name>/<string:slug>')
+def api_collection_item(collection_name, slug):
+    collection = API_COLLECTIONS.get(collection_name)
+    item = collection.by_slug.get(slug) if collection else None
+    if item is None:
+        return json_api_response(msgspec.json.encode(ApiError('Запись не найдена.')), 404)
+    try:
+        fields = parse_api_fields(collection, request.args.get('fields'))
+    except ApiRequestError as e:
+        return json_api_response(msgspec.json.encode(ApiError(e.message)), e.status)
+    if not fields:
+        return json_api_response(collection.item_bodies[slug])
+    return json_api_response(msgspec.json.encode(project_api_item(item, fields)))
+
 # --- Маршруты аутентификации ---
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -1287,7 +3590,7 @@ def login():
         return redirect(url_for('index'))
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.query.filter(User.username.ilike(form.username.data)).first()
+        user = find_user_by_username(form.username.data)
         if user and user.check_password(form.password.data):
             login_user(user, remember=form.remember_me.data)
             flash(f'Добро пожаловать, {user.username}!', 'success')
@@ -1337,14 +3640,18 @@ def logout_action():
 
 # --- Маршруты SRD ---
 @app.route('/srd/classes')
+@conditional_get(srd_static_validators)
+@page_cache.cached()
 def list_classes():
      return render_template('classes.html', title='Классы', classes=SRD_CLASSES)
 
 @app.route('/srd/class/<string:class_slug>', methods=['GET', 'POST'])
+@conditional_get(srd_comment_page_validators('class'))
+@page_cache.cached(lambda class_slug: [comment_page_tag('class', class_slug)])
 def class_detail(class_slug):
     srd_item = SRD_CLASSES.get(class_slug)
     if not srd_item: abort(404)
-    comment_form = CommentForm(); reply_form = ReplyForm(); page_type = 'class'
+    comment_form, reply_form = comment_forms(); page_type = 'class'
     if request.method == 'POST':
         if not current_user.is_authenticated:
              flash('Нужно войти, чтобы комментировать.', 'warning'); return redirect(url_for('login', next=request.url))
@@ -1355,8 +3662,9 @@ def class_detail(class_slug):
                  parent_comment = Comment.query.get(int(parent_id))
                  if not parent_comment or parent_comment.srd_page_type != page_type or parent_comment.srd_page_slug != class_slug:
                       flash('Не удалось найти родительский комментарий.', 'danger'); return redirect(url_for('class_detail', class_slug=class_slug))
-            comment = Comment(content=form_to_validate.content.data, author=current_user, srd_page_type=page_type, srd_page_slug=class_slug, parent_comment_id=parent_id if parent_id else None)
+            comment = Comment(content=form_to_validate.content.data, user_id=current_user.id, srd_page_type=page_type, srd_page_slug=class_slug, parent_comment_id=parent_id if parent_id else None)
             db.session.add(comment); db.session.commit()
+            page_cache.invalidate(comment_page_tag(page_type, class_slug))
             flash('Комментарий добавлен.' if not parent_id else 'Ответ добавлен.', 'success')
             return redirect(url_for('class_detail', class_slug=class_slug))
         else: flash('Ошибка в форме комментария/ответа.', 'danger')
@@ -1364,14 +3672,18 @@ def class_detail(class_slug):
     return render_template('class_detail.html', title=srd_item['name'], srd_item=srd_item, comments=comments, comment_form=comment_form, reply_form=reply_form, page_type=page_type, page_slug=class_slug)
 
 @app.route('/srd/species')
+@conditional_get(srd_static_validators)
+@page_cache.cached()
 def list_species():
     return render_template('species.html', title='Виды (Расы)', species=SRD_SPECIES)
 
 @app.route('/srd/species/<string:species_slug>', methods=['GET', 'POST'])
+@conditional_get(srd_comment_page_validators('species'))
+@page_cache.cached(lambda species_slug: [comment_page_tag('species', species_slug)])
 def species_detail(species_slug):
     srd_item = SRD_SPECIES.get(species_slug)
     if not srd_item: abort(404)
-    comment_form = CommentForm(); reply_form = ReplyForm(); page_type = 'species'
+    comment_form, reply_form = comment_forms(); page_type = 'species'
     if request.method == 'POST':
         if not current_user.is_authenticated:
              flash('Нужно войти, чтобы комментировать.', 'warning'); return redirect(url_for('login', next=request.url))
@@ -1382,8 +3694,9 @@ def species_detail(species_slug):
                  parent_comment = Comment.query.get(int(parent_id))
                  if not parent_comment or parent_comment.srd_page_type != page_type or parent_comment.srd_page_slug != species_slug:
                       flash('Не удалось найти родительский комментарий.', 'danger'); return redirect(url_for('species_detail', species_slug=species_slug))
-            comment = Comment(content=form_to_validate.content.data, author=current_user, srd_page_type=page_type, srd_page_slug=species_slug, parent_comment_id=parent_id if parent_id else None)
+            comment = Comment(content=form_to_validate.content.data, user_id=current_user.id, srd_page_type=page_type, srd_page_slug=species_slug, parent_comment_id=parent_id if parent_id else None)
             db.session.add(comment); db.session.commit()
+            page_cache.invalidate(comment_page_tag(page_type, species_slug))
             flash('Комментарий добавлен.' if not parent_id else 'Ответ добавлен.', 'success')
             return redirect(url_for('species_detail', species_slug=species_slug))
         else: flash('Ошибка в форме комментария/ответа.', 'danger')
@@ -1393,67 +3706,47 @@ def species_detail(species_slug):
 
 # Другие статичные SRD страницы
 @app.route('/srd/character')
+@conditional_get(srd_static_validators)
+@page_cache.cached()
 def character_info():
      # Получаем HTML контент из словаря
      content = SRD_STATIC_CONTENT.get('character_info', '<p>Контент для этой страницы пока недоступен.</p>')
      # Передаем его в универсальный шаблон
-     return render_template('generic_srd_page.html', title='Персонаж', page_content=content)
+     return render_template('generic_srd_page.html', title=SRD_STATIC_PAGE_TITLES['character_info'], page_content=content)
 
 @app.route('/srd/equipment')
+@conditional_get(srd_static_validators)
+@page_cache.cached()
 def equipment():
      content = SRD_STATIC_CONTENT.get('equipment', '<p>Контент для этой страницы пока недоступен.</p>')
-     return render_template('generic_srd_page.html', title='Экипировка', page_content=content)
+     return render_template('generic_srd_page.html', title=SRD_STATIC_PAGE_TITLES['equipment'], page_content=content)
 
 @app.route('/srd/gameplay')
+@conditional_get(srd_static_validators)
+@page_cache.cached()
 def gameplay():
      content = SRD_STATIC_CONTENT.get('gameplay', '<p>Контент для этой страницы пока недоступен.</p>')
-     return render_template('generic_srd_page.html', title='Игровой процесс', page_content=content)
+     return render_template('generic_srd_page.html', title=SRD_STATIC_PAGE_TITLES['gameplay'], page_content=content)
 
 @app.route('/srd/combat')
+@conditional_get(srd_static_validators)
+@page_cache.cached()
 def combat():
      content = SRD_STATIC_CONTENT.get('combat', '<p>Контент для этой страницы пока недоступен.</p>')
-     return render_template('generic_srd_page.html', title='Сражение', page_content=content)
+     return render_template('generic_srd_page.html', title=SRD_STATIC_PAGE_TITLES['combat'], page_content=content)
 
 @app.route('/srd/spells')
+@conditional_get(srd_static_validators)
 def spells_list():
     search_query = request.args.get('search', '').strip()
     filter_class = request.args.get('class', '')
     filter_level = request.args.get('level', '')
     filter_school = request.args.get('school', '')
 
-    filtered_spells = SRD_SPELLS_LIST # Работаем уже с обработанным списком
-
-    if search_query:
-        search_query_lower = search_query.lower()
-        filtered_spells = [
-            spell for spell in filtered_spells
-            # Ищем в русском названии
-            if search_query_lower in spell.get('name', '').lower()
-        ]
-
-    if filter_class:
-        filtered_spells = [
-            spell for spell in filtered_spells
-            # Ищем в списке raw классов
-            if filter_class.lower() in [cls.lower() for cls in spell.get('classes_raw', [])]
-        ]
-
-    if filter_level:
-        filtered_spells = [
-            spell for spell in filtered_spells
-            # Сравниваем raw уровень (число) с фильтром (строка), приводим к строке
-            if str(spell.get('level_raw', 99)).lower() == filter_level.lower()
-        ]
-
-    if filter_school:
-         filtered_spells = [
-             spell for spell in filtered_spells
-             # Сравниваем raw школу
-             if spell.get('school_raw', '').lower() == filter_school.lower()
-         ]
-
-    # Сортируем ОТФИЛЬТРОВАННЫЙ список по уровню (используем универсальную функцию)
-    sorted_spells = sorted(filtered_spells, key=spell_level_sort_key)
+    # Все фильтры сразу: пересечение битовых масок; поиск по индексу (название, английское
+    # название, описание) сохраняет порядок по релевантности, иначе порядок по уровню
+    sorted_spells = [SRD_SPELLS_LIST[position] for position in select_srd_spell_positions(
+        search_query, {'class': filter_class, 'level': filter_level, 'school': filter_school})]
 
     return render_template(
         'spells_list.html',
@@ -1469,19 +3762,22 @@ def spells_list():
         all_levels=ALL_SPELL_LEVELS,
         all_schools=ALL_SPELL_SCHOOLS,
 
+        facet_counts=SRD_SPELLS_FACETS.counts,
+
         class_names_map=CLASS_NAMES,
         school_names_map=SCHOOL_NAMES
     )
 
 # Маршрут для деталей заклинания
 @app.route('/srd/spell/<string:spell_slug>', methods=['GET', 'POST'])
+@conditional_get(srd_comment_page_validators('spell'))
+@page_cache.cached(lambda spell_slug: [comment_page_tag('spell', spell_slug)])
 def spell_detail(spell_slug):
     spell = SRD_SPELLS_DICT.get(spell_slug)
     if not spell:
         abort(404)
 
-    comment_form = CommentForm()
-    reply_form = ReplyForm()
+    comment_form, reply_form = comment_forms()
     page_type = 'spell'
     page_slug = spell.get('slug') # Используем наш сгенерированный слаг из объекта spell
 
@@ -1508,13 +3804,14 @@ def spell_detail(spell_slug):
 
             comment = Comment(
                 content=form_to_validate.content.data,
-                author=current_user,
+                user_id=current_user.id,
                 srd_page_type=page_type,
                 srd_page_slug=page_slug,
                 parent_comment_id=int(parent_id) if parent_id and is_reply else None
             )
             db.session.add(comment)
             db.session.commit()
+            page_cache.invalidate(comment_page_tag(page_type, page_slug))
             flash('Комментарий добавлен.' if is_new_comment else 'Ответ добавлен.', 'success')
 
             redirect_url = url_for('spell_detail', spell_slug=page_slug)
@@ -1541,6 +3838,7 @@ def spell_detail(spell_slug):
     )
 
 @app.route('/srd/monsters')
+@conditional_get(srd_static_validators)
 def monsters_list():
     # Получаем параметры фильтров из URL
     filter_cr = request.args.get('cr', '')
@@ -1548,37 +3846,10 @@ def monsters_list():
     filter_alignment = request.args.get('alignment', '')
     filter_size = request.args.get('size', '')
 
-    # Начинаем с полного списка чудовищ (значений словаря)
-    filtered_monsters_list = list(SRD_MONSTERS.values()) # Преобразуем в список для фильтрации
-
-    # Применяем фильтры
-    if filter_cr:
-        filtered_monsters_list = [
-            monster for monster in filtered_monsters_list
-            if monster.get('challenge', '').strip().lower() == filter_cr.lower()
-        ]
-
-    if filter_type:
-        filtered_monsters_list = [
-            monster for monster in filtered_monsters_list
-            if extract_monster_type(monster.get('size_type_alignment', '')).lower() == filter_type.lower()
-        ]
-
-    if filter_alignment:
-        filtered_monsters_list = [
-            monster for monster in filtered_monsters_list
-            if extract_monster_alignment(monster.get('size_type_alignment', '')).lower() == filter_alignment.lower()
-        ]
-
-    if filter_size:
-        filtered_monsters_list = [
-            monster for monster in filtered_monsters_list
-            if extract_monster_size(monster.get('size_type_alignment', '')).lower() == filter_size.lower()
-        ]
-
-    # Сортируем отфильтрованный список по ПО
-    sorted_monsters = sorted(filtered_monsters_list, key=lambda m: challenge_rating_sort_key(m.get('challenge', '999')))
-
+    # Все фильтры — пересечение битовых масок; записи уже отсортированы по ПО
+    sorted_monsters = [SRD_MONSTER_RECORDS[position] for position in select_srd_monster_positions({
+        'cr': filter_cr, 'type': filter_type, 'alignment': filter_alignment, 'size': filter_size
+    })]
 
     return render_template(
         'monsters_list.html',
@@ -1599,13 +3870,14 @@ def monsters_list():
     )
 
 @app.route('/srd/monster/<string:monster_slug>', methods=['GET', 'POST'])
+@conditional_get(srd_comment_page_validators('monster'))
+@page_cache.cached(lambda monster_slug: [comment_page_tag('monster', monster_slug)])
 def monster_detail(monster_slug):
     monster = SRD_MONSTERS.get(monster_slug)
     if not monster:
         abort(404)
 
-    comment_form = CommentForm()
-    reply_form = ReplyForm()
+    comment_form, reply_form = comment_forms()
     page_type = 'monster'
     page_slug = monster_slug
 
@@ -1633,13 +3905,14 @@ def monster_detail(monster_slug):
 
             comment = Comment(
                 content=form_to_validate.content.data,
-                author=current_user,
+                user_id=current_user.id,
                 srd_page_type=page_type,
                 srd_page_slug=page_slug,
                 parent_comment_id=int(parent_id) if parent_id and is_reply else None
             )
             db.session.add(comment)
             db.session.commit()
+            page_cache.invalidate(comment_page_tag(page_type, page_slug))
             flash('Комментарий добавлен.' if is_new_comment else 'Ответ добавлен.', 'success')
 
             redirect_url = url_for('monster_detail', monster_slug=page_slug)
@@ -1670,8 +3943,8 @@ def delete_comment(comment_id):
     comment_to_delete = Comment.query.get_or_404(comment_id)
 
     # Проверка прав: автор ИЛИ модератор/админ
-    can_delete = (comment_to_delete.author == current_user or 
-                  (current_user.is_authenticated and current_user.role in ['admin', 'moderator']))
+    can_delete = (comment_to_delete.user_id == current_user.id or
+                  current_user.role in ['admin', 'moderator'])
 
     if not can_delete:
         flash('У вас нет прав для удаления этого комментария.', 'danger')
@@ -1705,6 +3978,8 @@ def delete_comment(comment_id):
 
         db.session.delete(comment_to_delete)
         db.session.commit()
+        if comment_to_delete.srd_page_type and comment_to_delete.srd_page_slug:
+            page_cache.invalidate(comment_page_tag(comment_to_delete.srd_page_type, comment_to_delete.srd_page_slug))
         flash('Комментарий успешно удален.', 'success')
     except Exception as e:
         db.session.rollback()
@@ -1717,18 +3992,20 @@ def delete_comment(comment_id):
 # --- Маршруты Homebrew ---
 @app.route('/homebrew/', methods=['GET'])
 @login_required
+@conditional_get(homebrew_index_validators)
 def homebrew_index():
-    page = request.args.get('page', 1, type=int)
     selected_category_key = request.args.get('category', '')
+    search_query = request.args.get('q', '').strip()
+    search_page = request.args.get('page', 1, type=int)
 
-    query = HomebrewPost.query 
-
-    if selected_category_key:
-        query = query.filter_by(category=selected_category_key)
-
-    posts_pagination = query.order_by(HomebrewPost.timestamp.desc()).paginate(
-        page=page, per_page=10, error_out=False
-    )
+    posts_page = None
+    search_hits, search_has_next = [], False
+    if search_query:
+        search_hits, search_has_next = g.pop('homebrew_search_results', None) or search_homebrew(
+            search_query, selected_category_key, search_page)
+    else:
+        posts_page = g.pop('homebrew_posts_page', None) or paginate_homebrew_posts(
+            selected_category_key, request.args.get('cursor'))
 
     community_rules = """
     <h4>Правила Сообщества Homebrew Раздела:</h4>
@@ -1745,7 +4022,12 @@ def homebrew_index():
     return render_template(
         'homebrew_index.html',
         title='Homebrew Форум',
-        posts_pagination=posts_pagination,
+        posts_page=posts_page,
+        search_available=HOMEBREW_SEARCH_AVAILABLE,
+        search_query=search_query,
+        search_hits=search_hits,
+        search_page=search_page,
+        search_has_next=search_has_next,
         all_categories=ALL_HOMEBREW_CATEGORIES_FOR_FILTER,
         selected_category=selected_category_key,
         community_rules=Markup(community_rules),
@@ -1756,7 +4038,7 @@ def homebrew_index():
 @login_required
 def edit_homebrew_post(post_id):
     post_to_edit = HomebrewPost.query.get_or_404(post_id)
-    if post_to_edit.author != current_user:
+    if post_to_edit.user_id != current_user.id:
         flash('Вы можете редактировать только свои посты.', 'danger')
         return redirect(url_for('post_detail', post_id=post_id))
 
@@ -1764,10 +4046,13 @@ def edit_homebrew_post(post_id):
     if form.validate_on_submit():
         post_to_edit.title = form.title.data
         post_to_edit.content = form.content.data
+        post_to_edit.refresh_rendered_content()
         post_to_edit.category = form.category.data
         post_to_edit.timestamp = datetime.utcnow()
+        post_to_edit.last_activity_at = post_to_edit.timestamp
         try:
             db.session.commit()
+            invalidate_homebrew_post_counts() # Тема могла смениться
             flash('Пост успешно обновлен!', 'success')
             return redirect(url_for('post_detail', post_id=post_to_edit.id))
         except Exception as e:
@@ -1779,10 +4064,10 @@ def edit_homebrew_post(post_id):
 
 @app.route('/homebrew/post/<int:post_id>', methods=['GET', 'POST'])
 @login_required
+@conditional_get(post_detail_validators)
 def post_detail(post_id):
     post = HomebrewPost.query.get_or_404(post_id)
-    comment_form = CommentForm() 
-    reply_form = ReplyForm()  
+    comment_form, reply_form = comment_forms()
 
     # --- Обработка POST-запросов ---
     if request.method == 'POST':
@@ -1803,7 +4088,7 @@ def post_detail(post_id):
         if form_to_validate and form_to_validate.validate_on_submit():
             new_db_comment = Comment(
                 content=form_to_validate.content.data,
-                author=current_user,
+                user_id=current_user.id,
                 post_id=post.id
             )
 
@@ -1850,10 +4135,12 @@ def create_post():
             title=form.title.data,
             content=form.content.data,
             category=form.category.data, 
-            author=current_user 
+            user_id=current_user.id 
         )
+        post.refresh_rendered_content()
         db.session.add(post)
         db.session.commit()
+        invalidate_homebrew_post_counts()
         flash('Ваш Homebrew пост успешно создан!', 'success')
         return redirect(url_for('post_detail', post_id=post.id)) # Редирект на созданный пост
     return render_template('create_post.html', title='Создать Homebrew пост', form=form)
@@ -1862,8 +4149,8 @@ def create_post():
 def delete_homebrew_post(post_id):
     post_to_delete = HomebrewPost.query.get_or_404(post_id)
     
-    can_delete = (post_to_delete.author == current_user or 
-                  (current_user.is_authenticated and current_user.role in ['admin', 'moderator']))
+    can_delete = current_user.is_authenticated and (post_to_delete.user_id == current_user.id or
+                                                    current_user.role in ['admin', 'moderator'])
 
     if not can_delete:
         flash('У вас нет прав для удаления этого поста.', 'danger')
@@ -1873,6 +4160,7 @@ def delete_homebrew_post(post_id):
         try:
             db.session.delete(post_to_delete)
             db.session.commit()
+            invalidate_homebrew_post_counts()
             flash('Пост успешно удален.', 'success')
             return redirect(url_for('homebrew_index'))
         except Exception as e:
@@ -1883,6 +4171,45 @@ def delete_homebrew_post(post_id):
     
     return redirect(url_for('post_detail', post_id=post_id))
 
+# --- Файлы статики ---
+def serve_static_file(filename):
+    """Замена стандартного маршрута static. Файлы сборки (хеш в имени) кэшируются навсегда
+    и отдаются предсжатыми, если клиент принимает br/gzip; Range работает для всех файлов
+    (запрос с Range получает несжатый файл, чтобы диапазон относился к нему)."""
+    encodings = static_built_files.get(filename)
+    if encodings is None:
+        return app.send_static_file(filename)
+
+    response = None
+    if encodings and 'Range' not in request.headers:
+        for encoding, suffix in STATIC_PRECOMPRESSED_ENCODINGS:
+            if encoding in encodings and encoding in request.accept_encodings:
+                response = send_from_directory(app.static_folder, filename + suffix,
+                                               mimetype=mimetypes.guess_type(filename)[0],
+                                               max_age=STATIC_IMMUTABLE_MAX_AGE)
+                response.headers['Content-Encoding'] = encoding
+                break
+    if response is None:
+        response = send_from_directory(app.static_folder, filename, max_age=STATIC_IMMUTABLE_MAX_AGE)
+    if encodings:
+        response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+app.view_functions['static'] = serve_static_file
+
+# --- Файлы аватаров ---
+AVATAR_CACHE_MAX_AGE = 365 * 24 * 3600
+
+@app.route('/avatars/<string:filename>')
+def avatar_file(filename):
+    """Обработанные аватары адресуются хешем содержимого и никогда не меняются."""
+    response = send_from_directory(app.config['UPLOAD_FOLDER'], filename, max_age=AVATAR_CACHE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
 # --- Маршрут профиля ---
 @app.route('/profile/', methods=['GET', 'POST'])
 @app.route('/profile/<string:username_to_view>', methods=['GET', 'POST'])
@@ -1893,12 +4220,14 @@ def profile(username_to_view=None):
 
     if username_to_view:
         # Ищем пользователя по имени, нечувствительно к регистру
-        user_to_display = User.query.filter(User.username.ilike(username_to_view)).first_or_404()
+        user_to_display = find_user_by_username(username_to_view)
+        if user_to_display is None:
+            abort(404)
         # Проверяем, является ли просматриваемый профиль профилем текущего пользователя
         if current_user.is_authenticated and user_to_display.id == current_user.id:
             is_own_profile = True
     elif current_user.is_authenticated: # Если username_to_view не указан, показываем профиль текущего пользователя
-        user_to_display = current_user
+        user_to_display = db.session.get(User, current_user.id) # Модель, а не снимок из кэша
         is_own_profile = True
     else:
         # Если пользователь не аутентифицирован и не указано имя для просмотра, перенаправляем на вход
@@ -1920,10 +4249,11 @@ def profile(username_to_view=None):
         if profile_update_submitted and form.validate_on_submit():
             try:
                 new_username_data = form.username.data.lower()
+                username_changed = new_username_data != user_to_display.username
                 # Проверяем, изменилось ли имя и не занято ли оно другим пользователем
-                if new_username_data != user_to_display.username:
-                    existing_user = User.query.filter(User.username == new_username_data).first()
-                    if existing_user:
+                if username_changed:
+                    existing_user = find_user_by_username(new_username_data)
+                    if existing_user and existing_user.id != user_to_display.id:
                         flash('Это имя пользователя уже занято.', 'danger')
                         # Остаемся на странице, чтобы показать ошибку (нужно передать все переменные снова)
                         user_posts = user_to_display.posts.order_by(HomebrewPost.timestamp.desc()).limit(10).all()
@@ -1934,13 +4264,15 @@ def profile(username_to_view=None):
                     user_to_display.username = new_username_data
 
                 user_to_display.description = form.description.data
-                if form.avatar.data:
-                    picture_file = save_picture(form.avatar.data)
-                    if picture_file:
-                        user_to_display.avatar_filename = picture_file
-                
                 db.session.commit()
+                invalidate_user_identity(user_to_display.id)
+                if username_changed: # Новое имя должно появиться и в закэшированных комментариях
+                    page_cache.invalidate(*user_comment_page_tags(user_to_display.id))
                 flash('Ваш профиль успешно обновлен!', 'success')
+
+                # Аватар обрабатывается в фоне, пока показываем старый
+                if form.avatar.data and queue_avatar_upload(form.avatar.data, user_to_display.id):
+                    flash('Новый аватар обрабатывается и появится через несколько секунд.', 'info')
                 return redirect(url_for('profile', username_to_view=user_to_display.username))
             except Exception as e:
                 db.session.rollback()
@@ -1999,8 +4331,12 @@ def delete_user_by_admin(user_id):
 
     try:
         username_deleted = user_to_delete.username
+        comment_page_tags = user_comment_page_tags(user_id) # После удаления их уже не найти
         db.session.delete(user_to_delete)
         db.session.commit()
+        invalidate_user_identity(user_id)
+        page_cache.invalidate(*comment_page_tags) # Комментарии удалены и со страниц SRD в кэше
+        invalidate_homebrew_post_counts() # Вместе с пользователем удалены его посты
         flash(f'Пользователь {username_deleted} и весь его контент были успешно удалены.', 'success')
         return redirect(url_for('index'))
     except Exception as e:
@@ -2009,6 +4345,44 @@ def delete_user_by_admin(user_id):
         print(f"Error deleting user {user_id}: {e}")
         return redirect(url_for('profile', username_to_view=user_to_delete.username))
 
+# --- Метрики запросов (только для админов) ---
+@app.route('/admin/metrics')
+@login_required
+def admin_metrics():
+    if current_user.role != 'admin':
+        flash('Доступ запрещен. Метрики доступны только администраторам.', 'danger')
+        return redirect(url_for('index'))
+    return render_template('admin_metrics.html', title='Метрики запросов',
+                           enabled=app.config['INSTRUMENTATION_ENABLED'],
+                           rows=request_metrics.summary(),
+                           started_at=request_metrics.started_at,
+                           log_path=app.config['INSTRUMENTATION_LOG'],
+                           profile_dir=app.config['PROFILE_DIR'],
+                           sample_rate=app.config['PROFILE_SAMPLE_RATE'],
+                           slow_threshold_ms=app.config['PROFILE_SLOW_THRESHOLD_MS'])
+
+# --- Выгрузка данных (только для админов) ---
+@app.route('/admin/export')
+@login_required
+def admin_export():
+    """Потоковая выгрузка NDJSON: ?sections=posts,comments (по умолчанию все), ?gzip=1."""
+    if current_user.role != 'admin':
+        flash('Доступ запрещен. Выгрузка доступна только администраторам.', 'danger')
+        return redirect(url_for('index'))
+    try:
+        sections = parse_export_sections(request.args.get('sections'))
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('admin_metrics'))
+    compress = request.args.get('gzip') == '1'
+
+    filename = f"dice-destiny-export-{datetime.utcnow():%Y%m%d-%H%M%S}.ndjson" + ('.gz' if compress else '')
+    response = app.response_class(stream_with_context(iter_export_chunks(sections, compress)),
+                                  mimetype='application/gzip' if compress else 'application/x-ndjson')
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
 # --- 7. Обработчики ошибок ---
 @app.errorhandler(404)
 def not_found_error(error):
@@ -2031,8 +4405,45 @@ def unauthorized_error(error):
 
 
 # --- 8. Создание таблиц БД (если их нет) ---
+def upgrade_db_schema():
+    """db.create_all() не трогает существующие таблицы, поэтому новые колонки
+    и индексы моделей добавляем в старую БД сами (только добавление, без удаления)."""
+    added_columns = []
+    inspector = db.inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            ddl = f"ALTER TABLE {preparer.quote(table.name)} ADD COLUMN {preparer.quote(column.name)} {column_type}"
+            if column.default is not None and column.default.is_scalar:
+                ddl += f" DEFAULT {column.default.arg!r}"
+            with db.engine.begin() as connection:
+                connection.execute(db.text(ddl))
+            print(f"INFO: В таблицу '{table.name}' добавлена колонка '{column.name}'.")
+            added_columns.append(f'{table.name}.{column.name}')
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    return added_columns
+
 with app.app_context():
     db.create_all()
+    added_columns = set(upgrade_db_schema())
+    if added_columns & {'user.post_count', 'user.comment_count',
+                                   'homebrew_post.comment_count', 'homebrew_post.last_activity_at'}:
+        # Счетчики только что появились в старой БД — заполняем их по существующим данным
+        print(f"INFO: Счетчики заполнены: {reconcile_counters()}")
+    if 'user.username_key' in added_columns:
+        # Ключи имен только что появились — без них вход по имени не найдет старых пользователей.
+        # Дальше ключи ставят ORM-события; вставки в обход ORM должны заполнять их сами
+        # (см. benchmarks/seed.py), а конфликты разбирают через flask usernames-backfill
+        filled, conflicts = backfill_username_keys()
+        print(f"INFO: Ключи имен заполнены: {filled}, конфликтов: {len(conflicts)}.")
+    HOMEBREW_SEARCH_AVAILABLE = ensure_homebrew_search_index()
 @app.cli.command("set-role")
 @click.argument("username")
 @click.argument("role")
@@ -2041,7 +4452,7 @@ def set_role_command(username, role):
     Роли: user, moderator, admin.
     Пример: flask set-role someuser admin
     """
-    user = User.query.filter_by(username=username).first()
+    user = find_user_by_username(username)
     if not user:
         click.echo(f"Ошибка: Пользователь '{username}' не найден.")
         return
@@ -2054,11 +4465,193 @@ def set_role_command(username, role):
     user.role = role
     try:
         db.session.commit()
+        invalidate_user_identity(user.id) # Воркеры сбросят кэш по метке
         click.echo(f"Пользователю '{username}' успешно назначена роль '{role}'.")
     except Exception as e:
         db.session.rollback()
         click.echo(f"Ошибка при назначении роли: {e}")
 
+@app.cli.command("markdown-rerender")
+@click.option("--batch-size", default=200, show_default=True, help="Сколько записей рендерить за одну транзакцию.")
+@click.option("--force", is_flag=True, help="Перерендерить все записи, а не только устаревшие.")
+def markdown_rerender_command(batch_size, force):
+    """Пересобирает сохраненный HTML постов из Markdown.
+    Нужна после смены MARKDOWN_EXTENSIONS/MARKDOWN_RENDERER_VERSION и для старых записей.
+    Пример: flask markdown-rerender --batch-size 500
+    """
+    for model in (HomebrewPost,): # Комментарии выводятся как текст, Markdown в них нет
+        query = model.query.order_by(model.id)
+        if not force:
+            query = query.filter(db.or_(model.content_html.is_(None),
+                                        model.content_html_version.is_(None),
+                                        model.content_html_version != MARKDOWN_RENDERER_VERSION))
+        last_id = 0
+        rendered = 0
+        while True:
+            batch = query.filter(model.id > last_id).limit(batch_size).all()
+            if not batch:
+                break
+            for obj in batch:
+                obj.refresh_rendered_content()
+            last_id = batch[-1].id
+            try:
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                click.echo(f"Ошибка при сохранении ({model.__tablename__}, id до {last_id}): {e}")
+                return
+            rendered += len(batch)
+            db.session.expunge_all() # Не копим объекты в сессии между пачками
+        click.echo(f"{model.__tablename__}: перерендерено записей: {rendered}.")
+
+@app.cli.command("avatars-gc")
+@click.option("--grace-hours", default=24, show_default=True,
+              help="Не трогать файлы моложе этого срока (их могут еще показывать закэшированные страницы).")
+@click.option("--dry-run", is_flag=True, help="Только показать, что будет удалено.")
+def avatars_gc_command(grace_hours, dry_run):
+    """Удаляет файлы аватаров, на которые не ссылается ни один пользователь,
+    и зависшие необработанные загрузки.
+    Пример: flask avatars-gc --grace-hours 48
+    """
+    referenced = {filename for (filename,) in db.session.query(User.avatar_filename).distinct() if filename}
+    referenced.add('default.png')
+    cutoff = time.time() - grace_hours * 3600
+    avatar_dir = os.path.join(app.root_path, app.config['UPLOAD_FOLDER'])
+
+    candidates = []
+    for directory, is_pending in ((avatar_dir, False), (app.config['AVATAR_PENDING_FOLDER'], True)):
+        if not os.path.isdir(directory):
+            continue
+        for filename in os.listdir(directory):
+            path = os.path.join(directory, filename)
+            if not os.path.isfile(path) or os.path.getmtime(path) > cutoff:
+                continue
+            if not is_pending:
+                # Набор размеров "<хеш>_<размер>.<формат>" принадлежит аватару "<хеш>"
+                base_name = filename.rsplit('_', 1)[0] if AVATAR_VARIANT_RE.match(filename) else filename
+                if base_name in referenced:
+                    continue
+            candidates.append(path)
+
+    removed = 0
+    for path in candidates:
+        if dry_run:
+            click.echo(f"Будет удален: {path}")
+            continue
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError as e:
+            click.echo(f"Не удалось удалить '{path}': {e}")
+    click.echo(f"Найдено неиспользуемых файлов: {len(candidates)}, удалено: {removed}.")
+
+@app.cli.command("srd-compile")
+@click.option("--workers", default=os.cpu_count() or 1, show_default=True,
+              help="Сколько процессов разбирают пакеты параллельно (1 — без пула).")
+@click.option("--show-issues", default=50, show_default=True, help="Сколько проблемных записей вывести.")
+def srd_compile_command(workers, show_issues):
+    """Импортирует data/spells.json и пакеты из data/packs/ (*.json, *.db, *.ndjson, *.jsonl)
+    в бинарный каталог для быстрого старта воркеров и выводит отчет о битых записях и дублях.
+    Запускайте после каждого изменения заклинаний (например, при деплое).
+    Пример: flask srd-compile --workers 4
+    """
+    try:
+        catalog, report = compile_srd_catalog(workers=workers)
+    except OSError as e:
+        click.echo(f"Ошибка при записи каталога: {e}")
+        return
+    for pack in report.packs:
+        click.echo(f"{pack.source}: заклинаний {len(pack.spells)}, с ошибками {len(pack.issues)}"
+                   + (f", других записей пропущено {pack.skipped}" if pack.skipped else ""))
+    issues = report.issues()
+    for issue in issues[:show_issues]:
+        location = f"#{issue.index}" if issue.index is not None else ""
+        click.echo(f"  {issue.source}{location} {issue.name or '(без названия)'}: {issue.message}")
+    if len(issues) > show_issues:
+        click.echo(f"  ...и еще {len(issues) - show_issues}.")
+    click.echo(f"Каталог SRD сохранен в '{SRD_CATALOG_PATH}': "
+               f"{len(catalog.spells)} заклинаний, хеш {catalog.source_hash[:12]}.")
+
+@app.cli.command("counters-reconcile")
+def counters_reconcile_command():
+    """Пересчитывает счетчики постов и комментариев (у постов и пользователей)
+    по реальным данным и исправляет расхождения.
+    Пример: flask counters-reconcile
+    """
+    fixed = reconcile_counters()
+    for name, rows in fixed.items():
+        click.echo(f"{name}: исправлено строк — {rows}")
+    click.echo("Счетчики в порядке." if not any(fixed.values()) else "Счетчики пересчитаны.")
+
+@app.cli.command("usernames-backfill")
+@click.option("--batch-size", default=500, show_default=True, help="Сколько пользователей обновлять за одну транзакцию.")
+def usernames_backfill_command(batch_size):
+    """Заполняет username_key (нормализованное имя для входа и поиска профилей)
+    у пользователей, где он пуст или не совпадает с текущей нормализацией.
+    Пример: flask usernames-backfill
+    """
+    filled, conflicts = backfill_username_keys(batch_size)
+    click.echo(f"Заполнено ключей имен: {filled}.")
+    for username in conflicts:
+        click.echo(f"  Конфликт: '{username}' совпадает с другим пользователем без учета регистра — переименуйте одного из них.")
+    if conflicts:
+        click.echo(f"Пропущено пользователей: {len(conflicts)}; они не смогут войти, пока конфликт не устранен.")
+
+@app.cli.command("export")
+@click.option("--output", "-o", default="-", show_default=True,
+              help="Файл для выгрузки; '-' — стандартный вывод. Имя на .gz включает сжатие.")
+@click.option("--gzip", "compress", is_flag=True, help="Сжать выгрузку gzip.")
+@click.option("--sections", default="", help=f"Разделы через запятую: {', '.join(EXPORT_SECTIONS)} (по умолчанию все).")
+def export_command(output, compress, sections):
+    """Выгружает каталог SRD, пользователей, посты и комментарии в NDJSON.
+    Пример: flask export -o backup.ndjson.gz --sections posts,comments
+    """
+    try:
+        sections = parse_export_sections(sections)
+    except ValueError as e:
+        click.echo(f"Ошибка: {e}", err=True)
+        return
+    compress = compress or output.endswith('.gz')
+    written = 0
+    with click.open_file(output, 'wb') as stream:
+        for chunk in iter_export_chunks(sections, compress):
+            stream.write(chunk)
+            written += len(chunk)
+    if output != '-':
+        click.echo(f"Выгрузка сохранена в '{output}' ({written} байт, разделы: {', '.join(sections)}).")
+
+@app.cli.command("assets-build")
+def assets_build_command():
+    """Собирает статику: копии файлов с хешем в имени, .gz/.br (brotli — если установлен)
+    и WebP/MP4 (MP4 — если есть ffmpeg) для анимированных GIF. Пишет static/build/manifest.json.
+    Запускайте при деплое и перезапускайте воркеры: url_for('static') начнет отдавать новые имена.
+    Пример: flask assets-build
+    """
+    try:
+        manifest = build_static_assets()
+    except OSError as e:
+        click.echo(f"Ошибка при сборке статики: {e}")
+        return
+    for logical_path, asset in manifest.assets.items():
+        extras = asset.encodings + sorted(asset.variants)
+        click.echo(f"{logical_path} -> {asset.path}" + (f" ({', '.join(extras)})" if extras else ""))
+    if brotli is None:
+        click.echo("brotli не установлен: собраны только .gz (pip install brotli).")
+    if shutil.which('ffmpeg') is None:
+        click.echo("ffmpeg не найден: GIF перекодированы только в WebP.")
+    click.echo(f"Собрано файлов: {len(manifest.assets)}. Манифест: '{static_manifest_path()}'.")
+
+@app.cli.command("sessions-sweep")
+@click.option("--batch-size", default=1000, show_default=True, help="Сколько сессий удалять за одну транзакцию.")
+def sessions_sweep_command(batch_size):
+    """Удаляет просроченные серверные сессии (таблица server_session).
+    Удобно запускать по cron; воркеры тоже понемногу чистят таблицу сами.
+    Пример: flask sessions-sweep
+    """
+    removed = sweep_expired_sessions(batch_size=batch_size)
+    remaining = db.session.scalar(db.select(db.func.count()).select_from(ServerSession))
+    click.echo(f"Удалено просроченных сессий: {removed}, осталось: {remaining}.")
+
 # --- 9. Запуск приложения (для локальной разработки) ---
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
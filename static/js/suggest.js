@@ -0,0 +1,87 @@
+// Подсказки при вводе для полей с атрибутом data-suggest-url (ответ /api/suggest).
+// data-suggest-kind ограничивает тип (spell, monster, class, species).
+(function () {
+    const KIND_NAMES = { spell: 'Заклинание', monster: 'Чудовище', class: 'Класс', species: 'Вид' };
+    const DEBOUNCE_MS = 120;
+
+    function attach(input) {
+        const menu = document.createElement('div');
+        menu.className = 'dropdown-menu suggest-menu';
+        input.parentNode.classList.add('position-relative');
+        input.parentNode.appendChild(menu);
+        input.setAttribute('autocomplete', 'off');
+
+        let timer = null;
+        let controller = null;
+        let activeIndex = -1;
+
+        function close() {
+            menu.classList.remove('show');
+            activeIndex = -1;
+        }
+
+        function render(suggestions) {
+            menu.replaceChildren();
+            suggestions.forEach((suggestion) => {
+                const item = document.createElement('a');
+                item.className = 'dropdown-item';
+                item.href = suggestion.url;
+                item.textContent = suggestion.name;
+                const kind = document.createElement('small');
+                kind.className = 'text-muted ms-2';
+                kind.textContent = KIND_NAMES[suggestion.kind] || suggestion.kind;
+                item.appendChild(kind);
+                menu.appendChild(item);
+            });
+            menu.classList.toggle('show', suggestions.length > 0);
+            activeIndex = -1;
+        }
+
+        async function load() {
+            const query = input.value.trim();
+            if (!query) {
+                close();
+                return;
+            }
+            if (controller) controller.abort(); // Ответ на устаревший запрос не нужен
+            controller = new AbortController();
+            const params = new URLSearchParams({ q: query });
+            if (input.dataset.suggestKind) params.set('kind', input.dataset.suggestKind);
+            try {
+                const response = await fetch(`${input.dataset.suggestUrl}?${params}`, { signal: controller.signal });
+                if (response.ok) render((await response.json()).suggestions);
+            } catch (error) {
+                if (error.name !== 'AbortError') console.error('Suggest request failed:', error);
+            }
+        }
+
+        function highlight(index) {
+            const items = menu.querySelectorAll('.dropdown-item');
+            if (!items.length) return;
+            activeIndex = (index + items.length) % items.length;
+            items.forEach((item, i) => item.classList.toggle('active', i === activeIndex));
+        }
+
+        input.addEventListener('input', () => {
+            clearTimeout(timer);
+            timer = setTimeout(load, DEBOUNCE_MS);
+        });
+        input.addEventListener('keydown', (event) => {
+            if (!menu.classList.contains('show')) return;
+            if (event.key === 'ArrowDown' || event.key === 'ArrowUp') {
+                event.preventDefault();
+                highlight(activeIndex + (event.key === 'ArrowDown' ? 1 : -1));
+            } else if (event.key === 'Enter' && activeIndex >= 0) {
+                event.preventDefault(); // Переходим к подсказке вместо отправки формы
+                window.location.href = menu.querySelectorAll('.dropdown-item')[activeIndex].href;
+            } else if (event.key === 'Escape') {
+                close();
+            }
+        });
+        input.addEventListener('blur', () => setTimeout(close, 150)); // Даем сработать клику по подсказке
+    }
+
+    document.addEventListener('DOMContentLoaded', () => {
+        document.querySelectorAll('input[data-suggest-url]').forEach(attach);
+    });
+})();
@@ -0,0 +1,99 @@
+"""Общие фикстуры тестов: приложение на временной SQLite-базе.
+
+server.py настраивается при импорте (подключение к БД, кэш страниц), поэтому
+переменные окружения выставляем до импорта, а между тестами чистим таблицы и кэши.
+"""
+import os
+import re
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import pytest
+
+TEST_DIR = tempfile.mkdtemp(prefix='dnd-hub-tests-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(TEST_DIR, 'app.db')
+os.environ['PAGE_CACHE_TYPE'] = 'lru' # Тесты идут в одном процессе, общий кэш на диске не нужен
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+PASSWORD = 'secret1'
+CSRF_INPUT_RE = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"|'
+                           r'name="csrf_token" value="([^"]+)"')
+
+
+@pytest.fixture
+def app():
+    server.app.config.update(TESTING=True, WTF_CSRF_ENABLED=False, WTF_CSRF_TIME_LIMIT=3600)
+    yield server.app
+    with server.app.app_context():
+        for model in (server.Comment, server.HomebrewPost, server.User, server.ServerSession):
+            server.db.session.execute(server.db.delete(model))
+        server.db.session.commit()
+    server.page_cache.backend.clear()
+    server.user_identity_cache.clear()
+    server.invalidate_homebrew_post_counts()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def make_user(app):
+    def make_user(username, role='user'):
+        with app.app_context():
+            user = server.User(username=username, role=role)
+            user.set_password(PASSWORD)
+            server.db.session.add(user)
+            server.db.session.commit()
+            return user.id
+    return make_user
+
+
+@pytest.fixture
+def login(app):
+    """Клиент, вошедший под пользователем (с CSRF или без — как настроено приложение)."""
+    def login(username):
+        client = app.test_client()
+        data = {'username': username, 'password': PASSWORD}
+        if app.config['WTF_CSRF_ENABLED']:
+            data['csrf_token'] = csrf_token_from(client.get('/login').get_data(as_text=True))
+        response = client.post('/login', data=data)
+        assert response.status_code == 302
+        return client
+    return login
+
+
+@pytest.fixture
+def make_post(app):
+    def make_post(user_id, title='Пост для тестов', content='Содержимое поста для тестов.',
+                  category='spells', timestamp=None):
+        with app.app_context():
+            post = server.HomebrewPost(title=title, content=content, category=category,
+                                       user_id=user_id, timestamp=timestamp or datetime.utcnow())
+            server.db.session.add(post)
+            server.db.session.commit()
+            return post.id
+    return make_post
+
+
+@pytest.fixture
+def make_comment(app):
+    def make_comment(user_id, content='Комментарий', **page):
+        with app.app_context():
+            comment = server.Comment(content=content, user_id=user_id,
+                                     timestamp=datetime.utcnow() + timedelta(seconds=1), **page)
+            server.db.session.add(comment)
+            server.db.session.commit()
+            return comment.id
+    return make_comment
+
+
+def csrf_token_from(html):
+    match = CSRF_INPUT_RE.search(html)
+    assert match, 'В странице нет CSRF-токена'
+    return match.group(1) or match.group(2)
@@ -0,0 +1,47 @@
+import server
+
+
+def test_fields_projection(client):
+    response = client.get('/api/v1/spells', query_string={'fields': 'slug,name', 'per_page': 3})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert len(body['items']) == 3
+    assert all(set(item) == {'slug', 'name'} for item in body['items'])
+
+
+def test_unknown_field_is_rejected(client):
+    response = client.get('/api/v1/spells', query_string={'fields': 'name,password_hash'})
+    assert response.status_code == 400
+    assert 'password_hash' in response.get_json()['error']
+
+
+def test_unknown_collection_and_slug(client):
+    assert client.get('/api/v1/items').status_code == 404
+    assert client.get('/api/v1/spells/no-such-spell').status_code == 404
+
+
+def test_item_revalidates_with_etag(client):
+    slug = server.API_COLLECTIONS['monsters'].items[0].slug
+    response = client.get(f'/api/v1/monsters/{slug}')
+    assert response.status_code == 200
+    assert response.get_json()['slug'] == slug
+    assert client.get(f'/api/v1/monsters/{slug}',
+                      headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+
+def test_per_page_is_capped(client):
+    body = client.get('/api/v1/spells', query_string={'per_page': 10000}).get_json()
+    assert body['per_page'] == server.API_MAX_PER_PAGE
+
+
+def test_invalid_records_are_skipped_not_fatal():
+    spell = server.SRD_SPELLS_LIST[0]
+    items = server.convert_api_items([{'slug': 'broken'}, spell], server.SpellOut)
+    assert items[0] is None and items[1].slug == spell['slug']
+    collection = server.ApiCollection(server.SpellOut, items, ('search',), lambda args: [0, 1])
+    assert [item.slug for item in collection.select({'search': 'x'})] == [spell['slug']]
+
+
+def test_spell_without_level_is_a_cantrip():
+    spell = server.process_srd_spell({'name': 'Без уровня [No Level]', 'system': {}})
+    assert spell['level_raw'] == 0 and spell['level_display'] == 'Заговор'
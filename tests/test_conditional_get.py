@@ -0,0 +1,71 @@
+import time
+
+from conftest import csrf_token_from
+
+import server
+
+
+def test_anonymous_srd_page_is_public_and_revalidates(make_user, make_comment, client):
+    response = client.get('/srd/class/cleric')
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'].startswith('public')
+    assert 'Set-Cookie' not in response.headers
+    etag = response.headers['ETag']
+
+    assert client.get('/srd/class/cleric', headers={'If-None-Match': etag}).status_code == 304
+
+    make_comment(make_user('bob'), srd_page_type='class', srd_page_slug='cleric')
+    response = client.get('/srd/class/cleric', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_author_rename_changes_post_etag(app, make_user, make_post, login):
+    author_id = make_user('bob')
+    post_id = make_post(author_id)
+    client = login('bob')
+    client.get(f'/homebrew/post/{post_id}') # Съедаем flash о входе: с ним страница не валидируется
+    etag = client.get(f'/homebrew/post/{post_id}').headers['ETag']
+
+    with app.app_context():
+        server.db.session.get(server.User, author_id).username = 'robert'
+        server.db.session.commit()
+    server.invalidate_user_identity(author_id)
+
+    response = client.get(f'/homebrew/post/{post_id}', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert 'robert' in response.get_data(as_text=True)
+
+
+def test_logged_in_page_is_not_reused_after_csrf_token_expires(app, make_user, make_post, login, monkeypatch):
+    app.config.update(WTF_CSRF_ENABLED=True, WTF_CSRF_TIME_LIMIT=60)
+    post_id = make_post(make_user('bob'))
+    client = login('bob')
+    url = f'/homebrew/post/{post_id}'
+    client.get(url)
+    response = client.get(url)
+    etag = response.headers['ETag']
+    assert response.headers['Cache-Control'] == 'private, no-cache'
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 120) # Токен на странице уже просрочен
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    token = csrf_token_from(response.get_data(as_text=True))
+    response = client.post(url, data={'content': 'Свежий комментарий', 'submit_comment': 'true',
+                                      'csrf_token': token})
+    assert response.status_code == 302
+
+
+def test_new_session_gets_new_etag(app, make_user, make_post, login):
+    app.config['WTF_CSRF_ENABLED'] = True
+    post_id = make_post(make_user('bob'))
+    url = f'/homebrew/post/{post_id}'
+    first = login('bob')
+    first.get(url)
+    etag = first.get(url).headers['ETag']
+
+    second = login('bob') # Новая сессия — другой CSRF-токен в форме
+    second.get(url)
+    assert second.get(url, headers={'If-None-Match': etag}).status_code == 200
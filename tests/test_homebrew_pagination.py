@@ -0,0 +1,59 @@
+from datetime import datetime, timedelta
+
+import server
+
+
+def make_posts(make_user, make_post, count, category='spells'):
+    author_id = make_user('bob')
+    base_time = datetime(2024, 1, 1)
+    # Пары постов с одинаковым временем: порядок между ними решает id
+    return [make_post(author_id, title=f'Пост {index}', category=category,
+                      timestamp=base_time + timedelta(hours=index // 2))
+            for index in range(count)]
+
+
+def ids(page):
+    return [post.id for post in page.items]
+
+
+def test_pages_walk_forward_and_back_without_gaps(app, make_user, make_post):
+    post_ids = make_posts(make_user, make_post, 25)
+    expected = sorted(post_ids, reverse=True) # Новые сверху
+    with app.app_context():
+        first = server.paginate_homebrew_posts('', None, per_page=10)
+        second = server.paginate_homebrew_posts('', first.next_cursor, per_page=10)
+        third = server.paginate_homebrew_posts('', second.next_cursor, per_page=10)
+        assert ids(first) + ids(second) + ids(third) == expected
+        assert (first.number, second.number, third.number) == (1, 2, 3)
+        assert not first.has_prev and not third.has_next
+        assert first.total == 25
+
+        back = server.paginate_homebrew_posts('', third.prev_cursor, per_page=10)
+        assert ids(back) == ids(second) and back.number == 2
+        assert ids(server.paginate_homebrew_posts('', back.prev_cursor, per_page=10)) == ids(first)
+
+
+def test_category_filter(app, make_user, make_post):
+    make_posts(make_user, make_post, 3, category='spells')
+    with app.app_context():
+        page = server.paginate_homebrew_posts('classes', None)
+        assert page.items == [] and page.total == 0
+
+
+def test_tampered_cursor_falls_back_to_first_page(app, make_user, make_post):
+    make_posts(make_user, make_post, 12)
+    with app.app_context():
+        first = server.paginate_homebrew_posts('', None, per_page=10)
+        tampered = server.paginate_homebrew_posts('', first.next_cursor[:-2] + 'xx', per_page=10)
+        assert ids(tampered) == ids(first) and tampered.number == 1
+
+
+def test_index_page_uses_cursor(make_user, make_post, login):
+    make_posts(make_user, make_post, 12)
+    client = login('bob')
+    client.get('/homebrew/')
+    with client.application.app_context():
+        cursor = server.paginate_homebrew_posts('', None).next_cursor
+    html = client.get('/homebrew/', query_string={'cursor': cursor}).get_data(as_text=True)
+    assert 'Пост 0' in html # Вторая страница — два самых старых поста
+    assert 'Пост 11' not in html
@@ -0,0 +1,46 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.skipif(not server.HOMEBREW_SEARCH_AVAILABLE, reason='SQLite собран без FTS5')
+
+
+def hit_ids(app, query):
+    with app.app_context():
+        hits, _ = server.search_homebrew(query)
+        return [(hit.post.id, hit.comment_id) for hit in hits]
+
+
+def test_post_is_indexed_on_insert_update_and_delete(app, make_user, make_post):
+    post_id = make_post(make_user('bob'), title='Огненный дракон', content='Дышит пламенем на всех вокруг.')
+    assert hit_ids(app, 'огненного') == [(post_id, None)]
+
+    with app.app_context():
+        server.db.session.get(server.HomebrewPost, post_id).title = 'Ледяной дракон'
+        server.db.session.commit()
+    assert hit_ids(app, 'огненный') == []
+    assert hit_ids(app, 'ледяной') == [(post_id, None)]
+
+    with app.app_context():
+        server.db.session.delete(server.db.session.get(server.HomebrewPost, post_id))
+        server.db.session.commit()
+    assert hit_ids(app, 'ледяной') == []
+
+
+def test_comments_on_posts_are_indexed(app, make_user, make_post, make_comment):
+    author_id = make_user('bob')
+    post_id = make_post(author_id)
+    comment_id = make_comment(author_id, 'Предлагаю добавить телепортацию', post_id=post_id)
+    make_comment(author_id, 'Телепортация на странице SRD', srd_page_type='spell', srd_page_slug='misty-step')
+    assert hit_ids(app, 'телепортация') == [(post_id, comment_id)]
+
+    with app.app_context():
+        server.db.session.delete(server.db.session.get(server.Comment, comment_id))
+        server.db.session.commit()
+    assert hit_ids(app, 'телепортация') == []
+
+
+@pytest.mark.parametrize('query', ['зелёный', 'зеленый', 'ЗЕЛЁНОГО', 'всё', 'все', 'ВСЁ'])
+def test_yo_and_ye_match_each_other(app, make_user, make_post, query):
+    post_id = make_post(make_user('bob'), title='Зелёный дракон', content='Всё о зелёных драконах.')
+    assert hit_ids(app, query) == [(post_id, None)]
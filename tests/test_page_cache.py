@@ -0,0 +1,58 @@
+PAGE = '/srd/class/cleric'
+
+
+def test_new_comment_evicts_cached_page(make_user, login, client):
+    make_user('bob')
+    assert 'Первый комментарий' not in client.get(PAGE).get_data(as_text=True)
+
+    login('bob').post(PAGE, data={'content': 'Первый комментарий', 'submit_comment': 'true'})
+    assert 'Первый комментарий' in client.get(PAGE).get_data(as_text=True)
+
+
+def test_deleted_comment_disappears_from_cached_page(app, make_user, make_comment, login, client):
+    author_id = make_user('bob')
+    comment_id = make_comment(author_id, 'Удаляемый комментарий', srd_page_type='class', srd_page_slug='cleric')
+    assert 'Удаляемый комментарий' in client.get(PAGE).get_data(as_text=True)
+
+    login('bob').post(f'/comment/{comment_id}/delete')
+    assert 'Удаляемый комментарий' not in client.get(PAGE).get_data(as_text=True)
+
+
+def test_admin_user_deletion_evicts_their_comments(make_user, make_comment, login, client):
+    make_user('admin1', role='admin')
+    troll_id = make_user('troll')
+    make_comment(troll_id, 'Спам со страницы', srd_page_type='class', srd_page_slug='cleric')
+    assert 'Спам со страницы' in client.get(PAGE).get_data(as_text=True)
+
+    assert login('admin1').post(f'/admin/user/{troll_id}/delete').status_code == 302
+    assert 'Спам со страницы' not in client.get(PAGE).get_data(as_text=True)
+
+
+def test_rename_evicts_pages_with_their_comments(make_user, make_comment, login, client):
+    author_id = make_user('bob')
+    make_comment(author_id, 'Комментарий Боба', srd_page_type='class', srd_page_slug='cleric')
+    assert 'robert' not in client.get(PAGE).get_data(as_text=True)
+
+    login('bob').post('/profile/', data={'username': 'robert', 'description': '',
+                                         'submit': 'Сохранить изменения профиля'})
+    assert 'robert' in client.get(PAGE).get_data(as_text=True)
+
+
+def test_cached_body_follows_validators(make_user, make_comment, client):
+    """Комментарий, добавленный без инвалидации (как из другого воркера), все равно виден,
+    а ETag меняется вместе с телом."""
+    first = client.get(PAGE)
+    make_comment(make_user('bob'), 'Из другого воркера', srd_page_type='class', srd_page_slug='cleric')
+    second = client.get(PAGE)
+    assert 'Из другого воркера' in second.get_data(as_text=True)
+    assert second.headers['ETag'] != first.headers['ETag']
+
+
+def test_logged_in_page_is_not_served_to_anonymous(make_user, login, client):
+    make_user('bob')
+    logged_in = login('bob')
+    logged_in.get(PAGE)
+    response = logged_in.get(PAGE)
+    assert not response.headers.get('Cache-Control', '').startswith('public')
+    assert 'bob' in response.get_data(as_text=True)
+    assert 'bob' not in client.get(PAGE).get_data(as_text=True)
@@ -0,0 +1,57 @@
+import server
+
+
+def test_username_key_is_casefolded_and_nfkc(app, make_user):
+    user_id = make_user('Straße')
+    with app.app_context():
+        assert server.db.session.get(server.User, user_id).username_key == 'strasse'
+        assert server.find_user_by_username('STRASSE').id == user_id
+        assert server.find_user_by_username('ＳＴＲＡＳＳＥ').id == user_id # Полноширинные буквы (NFKC)
+        assert server.find_user_by_username('nobody') is None
+
+
+def test_login_is_case_insensitive(make_user, client):
+    make_user('bob')
+    assert client.post('/login', data={'username': 'BOB', 'password': 'secret1'}).status_code == 302
+
+
+def test_wrong_password_does_not_log_in(make_user, client):
+    make_user('bob')
+    response = client.post('/login', data={'username': 'bob', 'password': 'wrong-password'})
+    assert response.status_code == 200
+    assert 'Неверный логин или пароль.' in response.get_data(as_text=True)
+
+
+def test_registration_rejects_case_variant_of_taken_name(make_user, client):
+    make_user('bob')
+    response = client.post('/register', data={'username': 'Bob', 'password': 'secret1',
+                                              'confirm_password': 'secret1'})
+    assert 'Это имя пользователя уже занято.' in response.get_data(as_text=True)
+
+
+def test_profile_lookup_by_any_case(make_user, login):
+    make_user('bob')
+    client = login('bob')
+    assert client.get('/profile/BoB').status_code == 200
+    assert client.get('/profile/nobody').status_code == 404
+
+
+def test_username_lookup_uses_index(app):
+    with app.app_context():
+        plan = server.db.session.execute(server.db.text(
+            "EXPLAIN QUERY PLAN SELECT id FROM user WHERE username_key = 'bob'")).all()
+    assert 'ix_user_username_key' in ' '.join(str(row) for row in plan)
+
+
+def test_backfill_fills_missing_keys_and_reports_conflicts(app):
+    with app.app_context():
+        # Массовая вставка идет мимо ORM-событий — ключей нет
+        server.db.session.execute(server.db.insert(server.User), [
+            {'username': 'carol', 'password_hash': 'x', 'role': 'user'},
+            {'username': 'Carol', 'password_hash': 'x', 'role': 'user'},
+        ])
+        server.db.session.commit()
+        filled, conflicts = server.backfill_username_keys()
+        assert (filled, conflicts) == (1, ['Carol'])
+        assert server.find_user_by_username('CAROL').username == 'carol'
+        assert server.backfill_username_keys() == (0, ['Carol'])